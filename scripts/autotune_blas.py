@@ -0,0 +1,264 @@
+'''This module measures how many BLAS threads and parallel processes train
+and score a Doctor AI model fastest on this machine, and writes the
+recommendation that doctor_ai.py, sweep_doctor_ai.py and score_cohort.py
+pick up (blas_config.py).
+
+Small hidden layers give BLAS little work per call, so running several
+processes with few threads each often beats one process with all cores,
+while too many threads per core slows every process down.  For every layout
+of threads x processes that fits in the cores, the processes are started
+with the BLAS thread variables set, build a model of the given shape with
+random parameters and a batch of synthetic patients, and run calibration
+steps at the same time:
+    - train: one compiled Theano training step of doctor_ai.py (gradient
+      and adadelta update), measured only if Theano can be imported
+    - train_numpy: one training step of numpy_trainer.py, for
+      doctor_ai.py --backend numpy
+    - score: one forward pass and top-k of numpy_model.py, as in
+      score_cohort.py and select_checkpoint.py
+The throughput of a layout is the sum of the patients per second of its
+processes.  Every recommendation is only applied to the code it was
+measured with.
+
+inputs:
+    - number of unique input codes and label codes, as for doctor_ai.py
+    - (optional) the model shape: embedding size, hidden layer sizes and
+      batch size
+
+outputs:
+    - JSON recommendation, by default blas_config.config_file(), with every
+      measurement
+'''
+
+import argparse
+from datetime import datetime
+import importlib.util
+import json
+import logging
+import multiprocessing
+import os
+import random
+import time
+
+from blas_config import CONFIG_VARIABLE, WORKLOADS, config_file, load_config, set_blas_threads
+
+def candidate_layouts(cores, threads=None, processes=None):
+    '''
+    Returns the (threads, processes) layouts using at most cores cores, with
+    thread and process counts that are powers of two or cores itself unless
+    given.
+    '''
+    counts = sorted({2 ** i for i in range(cores.bit_length()) if 2 ** i <= cores} | {cores})
+    return [(t, p) for t in (threads or counts) for p in (processes or counts) if t * p <= cores]
+
+def calibration_step(workload, shape, seed):
+    '''
+    Returns the number of patients of one calibration step and a function
+    running it.
+    '''
+    from benchmark_pipeline import model_options, synthetic_patients
+    import doctor_ai
+
+    options = model_options(inputDimSize=shape['n_input_codes'], numClass=shape['n_output_codes'],\
+        embSize=shape['embed_size'], hiddenDimSize=shape['hidden_dim_size'], batchSize=shape['batch_size'])
+    if workload == 'train':
+        # before the parameters are made, in Theano's float type
+        doctor_ai.load_theano()
+    params = doctor_ai.init_params(options)
+    seqs, labels, _ = synthetic_patients(shape['batch_size'], random.Random(seed),\
+        shape['n_input_codes'], shape['n_output_codes'])
+    if workload == 'train':
+        import theano.tensor as T
+        tparams = doctor_ai.init_tparams(params, options)
+        use_noise, x, y, mask, lengths, cost = doctor_ai.build_model(tparams, options)
+        use_noise.set_value(1.)
+        grads = T.grad(cost, wrt=list(tparams.values()))
+        f_grad_shared, f_update = doctor_ai.adadelta(tparams, grads, x, y, mask, lengths, cost, options)
+        inputs = doctor_ai.padMatrixWithoutTime(seqs, labels, options)
+        def run():
+            f_grad_shared(*inputs)
+            f_update()
+    elif workload == 'train_numpy':
+        import numpy_trainer
+        tparams = numpy_trainer.init_shared_params(params, options)
+        use_noise, f_grad_shared, f_update = numpy_trainer.build_functions(tparams, options)
+        use_noise.set_value(1.)
+        inputs = doctor_ai.padMatrixWithoutTime(seqs, labels, options)
+        def run():
+            f_grad_shared(*inputs)
+            f_update()
+    else:
+        from numpy_model import batch_hidden_states, prepare_batches, topk_rows
+        batch = prepare_batches(seqs, labels, len(seqs))[0]
+        def run():
+            hidden, _ = batch_hidden_states(params, batch)
+            topk_rows(params, hidden[batch['rows']], 30)
+    return len(seqs), run
+
+def calibration_worker(queue, barrier, workload, shape, steps, seed):
+    try:
+        n_patients, run = calibration_step(workload, shape, seed)
+        run()
+        # all processes of a layout are timed together
+        barrier.wait()
+        start = time.perf_counter()
+        for _ in range(steps):
+            run()
+        queue.put(n_patients * steps / (time.perf_counter() - start))
+    except BaseException:
+        # releases the other processes and measure_layout
+        barrier.abort()
+        queue.put(None)
+        raise
+
+def measure_layout(workload, shape, threads, processes, steps):
+    '''
+    Returns the patients per second of processes running calibration steps
+    concurrently with threads BLAS threads each.
+    '''
+    # spawned processes load BLAS with these settings
+    set_blas_threads(threads)
+    context = multiprocessing.get_context('spawn')
+    queue = context.Queue()
+    barrier = context.Barrier(processes)
+    workers = [context.Process(target=calibration_worker, args=(queue, barrier, workload, shape, steps, seed))\
+        for seed in range(processes)]
+    for worker in workers:
+        worker.start()
+    throughputs = [queue.get() for _ in workers]
+    for worker in workers:
+        worker.join()
+    if None in throughputs:
+        raise RuntimeError(f'the {workload} calibration failed with {threads} threads x {processes} processes')
+    return sum(throughputs)
+
+def recommend(measurements):
+    '''
+    Returns the best layout of every workload measured: the threads and
+    processes of the highest total throughput, and the best threads of a
+    single process.
+    '''
+    recommendation = {}
+    for workload in WORKLOADS:
+        rows = [row for row in measurements if row['workload'] == workload]
+        if not rows:
+            continue
+        best = max(rows, key=lambda row: row['patients_per_second'])
+        single = [row for row in rows if row['processes'] == 1] or [best]
+        recommendation[workload] = {
+            'threads': best['threads'],
+            'processes': best['processes'],
+            'patients_per_second': best['patients_per_second'],
+            'single_process_threads': max(single, key=lambda row: row['patients_per_second'])['threads']}
+    return recommendation
+
+def parse_hidden_dim_size(value):
+    return [int(strDim) for strDim in value.strip()[1:-1].split(',')]
+
+def parse_arguments(parser):
+    parser.add_argument(\
+        'n_input_codes',
+        type=int,
+        help='The number of unique input medical codes.')
+    parser.add_argument(\
+        'n_output_codes',
+        type=int,
+        help='The number of unique label medical codes.')
+    parser.add_argument(\
+        '--embed_size',
+        type=int,
+        default=200,
+        help='The embedding size of the model (default value: 200)')
+    parser.add_argument(\
+        '--hidden_dim_size',
+        type=str,
+        default='[200,200]',
+        help='The GRU layer sizes of the model, e.g. [200,200] (default value: [200,200])')
+    parser.add_argument(\
+        '--batch_size',
+        type=int,
+        default=100,
+        help='The size of a single mini-batch (default value: 100)')
+    parser.add_argument(\
+        '--workloads',
+        type=str,
+        nargs='+',
+        default=list(WORKLOADS),
+        choices=WORKLOADS,
+        help='The workloads to tune (default value: train train_numpy score)')
+    parser.add_argument(\
+        '--threads',
+        type=int,
+        nargs='+',
+        default=None,
+        help='The BLAS thread counts to try (default value: powers of two up to all cores)')
+    parser.add_argument(\
+        '--processes',
+        type=int,
+        nargs='+',
+        default=None,
+        help='The process counts to try (default value: powers of two up to all cores)')
+    parser.add_argument(\
+        '--steps',
+        type=int,
+        default=5,
+        help='The timed calibration steps of every process, after one warm-up step (default value: 5)')
+    parser.add_argument(\
+        '--out_file',
+        type=str,
+        default='',
+        help=f'The path to the recommendation file; the commands read another path only if it is set in {CONFIG_VARIABLE} (default value: {config_file()})')
+    parser.add_argument('-v', '--verbose', action='store_true',\
+        help='Show verbose output.')
+    args = parser.parse_args()
+    return args
+
+def main():
+    parser = argparse.ArgumentParser()
+    args = parse_arguments(parser)
+    if args.verbose:
+        logging.basicConfig(level=logging.DEBUG)
+    else:
+        logging.basicConfig(level=logging.INFO)
+
+    workloads = list(args.workloads)
+    if 'train' in workloads and importlib.util.find_spec('theano') is None:
+        logging.warning("theano cannot be imported, not measuring the train workload of its backend")
+        workloads.remove('train')
+
+    cores = os.cpu_count()
+    shape = {'n_input_codes': args.n_input_codes, 'n_output_codes': args.n_output_codes,\
+        'embed_size': args.embed_size, 'hidden_dim_size': parse_hidden_dim_size(args.hidden_dim_size),\
+        'batch_size': args.batch_size}
+    layouts = candidate_layouts(cores, args.threads, args.processes)
+    logging.info("measuring %d layouts of %d cores for %s", len(layouts), cores, ' and '.join(workloads))
+
+    measurements = []
+    for workload in workloads:
+        for threads, processes in layouts:
+            throughput = measure_layout(workload, shape, threads, processes, args.steps)
+            measurements.append({'workload': workload, 'threads': threads, 'processes': processes,\
+                'patients_per_second': round(throughput, 2)})
+            logging.info("%s: %d threads x %d processes: %.1f patients/s", workload, threads, processes, throughput)
+
+    out_file = args.out_file or config_file()
+    config = load_config(out_file) or {}
+    if config.get('cores') != cores:
+        config = {}
+    config.update(recommend(measurements))
+    config.update({'cores': cores, 'created': datetime.now().isoformat(timespec='seconds'), 'shape': shape})
+    config['measurements'] = [row for row in config.get('measurements', []) if row['workload'] not in workloads]\
+        + measurements
+    if os.path.dirname(out_file):
+        os.makedirs(os.path.dirname(out_file), exist_ok=True)
+    with open(out_file, 'w', encoding='utf8') as outfile:
+        json.dump(config, outfile, indent=2)
+    for workload in workloads:
+        layout = config[workload]
+        logging.info("%s: %d threads x %d processes (%.1f patients/s), %d threads for a single process",\
+            workload, layout['threads'], layout['processes'], layout['patients_per_second'],\
+            layout['single_process_threads'])
+    logging.info("wrote %s", out_file)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,416 @@
+'''This module benchmarks the hot functions of the pipeline across scalable
+input sizes and reports time and peak memory for each.
+
+Benchmarks:
+    - convert_to_icd9:    process_mimic.convert_to_icd9 over raw MIMIC codes
+    - ccs_mapping:        process_mimic.map_codes, the ICD9 -> CCS mapping
+    - pad_matrix_*:       doctor_ai.padMatrixWithoutTime / WithTime /
+                          WithTimePrediction on one batch
+    - gru_layer_forward:  doctor_ai.gru_layer forward scan
+    - gru_layer_backward: doctor_ai.gru_layer forward and gradients
+    - train_step:         one f_grad_shared + f_update step of the full model
+    - numpy_train_step:   the same step with the numpy backend
+                          (numpy_trainer.py)
+    - visit_code_step_flat / visit_code_step_groups:
+                          padding and one training step of a model
+                          predicting the ICD-9 codes of the next visit,
+                          with the flat output layer or the two-level one
+                          over their CCS categories (label_groups.py)
+    - recall_top:         test_doctor_ai.recallTop
+    - topk_predictions:   test_doctor_ai.topk_predictions
+    - translate_numerics: translate_codes_to_text.translate_numerics
+
+Every benchmark is run at each --scales multiple of its base size.  The
+synthetic inputs are built from the CCS csv file, so no MIMIC data is needed.
+Benchmarks that need Theano are skipped if it cannot be imported.
+
+inputs:
+    - Single Level diagnosis file from CCS (dxref2015.csv).
+    - output file name.
+    - (optional) baseline results file from an earlier run.
+
+outputs:
+    - JSON file with one result per benchmark and scale.  With --baseline,
+      the run fails (exit status 1) if any median time regressed by more
+      than --threshold.
+'''
+
+import argparse
+from collections import OrderedDict
+from datetime import datetime
+import json
+import logging
+import platform
+import random
+import subprocess
+import sys
+import time
+import tracemalloc
+
+import numpy as np
+
+from code_vocab import CodeVocabulary
+from create_ccs_dict import read_code_mapping
+
+INPUT_DIM_SIZE = 4894
+NUM_CLASS = 273
+EMB_SIZE = 200
+HIDDEN_DIM_SIZE = [200, 200]
+MAX_VISITS = 10
+
+def raw_icd_codes(ccs_map):
+    return [icd for icds in ccs_map.values() for icd in icds if icd]
+
+def synthetic_patients(n_patients, rng, inputDimSize=INPUT_DIM_SIZE, numClass=NUM_CLASS):
+    '''
+    Returns seqs, labels and times of n_patients with 2 to MAX_VISITS visits.
+    '''
+    seqs = []
+    labels = []
+    times = []
+    for _ in range(n_patients):
+        n_visits = rng.randint(2, MAX_VISITS)
+        seqs.append([rng.sample(range(inputDimSize), rng.randint(1, 15)) for _ in range(n_visits)])
+        labels.append([rng.sample(range(numClass), rng.randint(1, 10)) for _ in range(n_visits)])
+        times.append([float(rng.randint(1, 365)) for _ in range(n_visits)])
+    return seqs, labels, times
+
+def model_options(**kwargs):
+    options = {
+        'timeFileTrain': '', 'embFile': '', 'embSize': EMB_SIZE,
+        'inputDimSize': INPUT_DIM_SIZE, 'numClass': NUM_CLASS,
+        'hiddenDimSize': HIDDEN_DIM_SIZE, 'predictTime': False, 'useTime': False,
+        'useLogTime': True, 'embFineTune': True, 'dropout_rate': 0.5,
+        'logEps': 1e-8, 'L2_output': 0.001, 'L2_time': 0.001, 'tradeoff': 1.0,
+        'batchSize': 100}
+    options.update(kwargs)
+    return options
+
+def bench_convert_to_icd9(scale, context):
+    from process_mimic import convert_to_icd9
+    codes = [context['rng'].choice(context['icd_codes']) for _ in range(100000 * scale)]
+    return len(codes), lambda: [convert_to_icd9(code) for code in codes]
+
+def bench_ccs_mapping(scale, context):
+    from process_mimic import convert_to_icd9, map_codes
+    rng = context['rng']
+    icd_codes = context['icd_codes']
+    seqs = [[['D_' + convert_to_icd9(rng.choice(icd_codes)) for _ in range(rng.randint(1, 15))]\
+        for _ in range(rng.randint(2, MAX_VISITS))] for _ in range(1000 * scale)]
+    n_codes = sum(len(visit) for seq in seqs for visit in seq)
+    def run():
+        # codes missing from the CCS dict are logged one by one
+        logging.disable(logging.INFO)
+        try:
+            return map_codes(seqs, context['vocab'])
+        finally:
+            logging.disable(logging.NOTSET)
+    return n_codes, run
+
+def _bench_pad_matrix(scale, context, variant):
+    import doctor_ai
+    options = model_options()
+    seqs, labels, times = synthetic_patients(10 * scale, context['rng'])
+    if variant == 'without_time':
+        run = lambda: doctor_ai.padMatrixWithoutTime(seqs, labels, options)
+    elif variant == 'with_time':
+        run = lambda: doctor_ai.padMatrixWithTime(seqs, labels, times, options)
+    else:
+        run = lambda: doctor_ai.padMatrixWithTimePrediction(seqs, labels, times, options)
+    return len(seqs), run
+
+def bench_pad_matrix_without_time(scale, context):
+    return _bench_pad_matrix(scale, context, 'without_time')
+
+def bench_pad_matrix_with_time(scale, context):
+    return _bench_pad_matrix(scale, context, 'with_time')
+
+def bench_pad_matrix_with_time_prediction(scale, context):
+    return _bench_pad_matrix(scale, context, 'with_time_prediction')
+
+def _bench_gru_layer(scale, context, backward):
+    import theano
+    import theano.tensor as T
+    from theano import config
+    import doctor_ai
+    doctor_ai.load_theano()
+    hiddenDimSize = HIDDEN_DIM_SIZE[0]
+    options = model_options(hiddenDimSize=[hiddenDimSize])
+    params = doctor_ai.init_params(options)
+    tparams = OrderedDict((key, theano.shared(value, name=key))\
+        for key, value in params.items() if key.endswith('_0'))
+
+    emb = T.tensor3('emb', dtype=config.floatX)
+    mask = T.matrix('mask', dtype=config.floatX)
+    results = doctor_ai.gru_layer(tparams, emb, '0', hiddenDimSize, mask=mask)
+    if backward:
+        grads = T.grad(results.sum(), wrt=list(tparams.values()))
+        f = theano.function([emb, mask], grads, name='gru_layer_backward')
+    else:
+        f = theano.function([emb, mask], results, name='gru_layer_forward')
+
+    n_samples = 10 * scale
+    embData = np.random.uniform(-1, 1, (MAX_VISITS, n_samples, EMB_SIZE)).astype(config.floatX)
+    maskData = np.ones((MAX_VISITS, n_samples), dtype=config.floatX)
+    return n_samples, lambda: f(embData, maskData)
+
+def bench_gru_layer_forward(scale, context):
+    return _bench_gru_layer(scale, context, False)
+
+def bench_gru_layer_backward(scale, context):
+    return _bench_gru_layer(scale, context, True)
+
+def bench_train_step(scale, context):
+    import theano.tensor as T
+    import doctor_ai
+    doctor_ai.load_theano()
+    options = model_options(batchSize=10 * scale)
+    params = doctor_ai.init_params(options)
+    tparams = doctor_ai.init_tparams(params, options)
+    use_noise, x, y, mask, lengths, cost = doctor_ai.build_model(tparams, options)
+    use_noise.set_value(1.)
+    grads = T.grad(cost, wrt=list(tparams.values()))
+    f_grad_shared, f_update = doctor_ai.adadelta(tparams, grads, x, y, mask, lengths, cost, options)
+
+    seqs, labels, _ = synthetic_patients(options['batchSize'], context['rng'])
+    batch = doctor_ai.padMatrixWithoutTime(seqs, labels, options)
+    def run():
+        f_grad_shared(*batch)
+        f_update()
+    return len(seqs), run
+
+def bench_numpy_train_step(scale, context):
+    import doctor_ai
+    import numpy_trainer
+    options = model_options(batchSize=10 * scale)
+    params = doctor_ai.init_params(options)
+    tparams = numpy_trainer.init_shared_params(params, options)
+    use_noise, f_grad_shared, f_update = numpy_trainer.build_functions(tparams, options)
+    use_noise.set_value(1.)
+
+    seqs, labels, _ = synthetic_patients(options['batchSize'], context['rng'])
+    batch = doctor_ai.padMatrixWithoutTime(seqs, labels, options)
+    def run():
+        f_grad_shared(*batch)
+        f_update()
+    return len(seqs), run
+
+def _bench_visit_code_step(scale, context, grouped):
+    import theano.tensor as T
+    import doctor_ai
+    from label_groups import LabelGroups
+    doctor_ai.load_theano()
+    groups = np.asarray(context['vocab'].icd_ccs)
+    options = model_options(batchSize=10 * scale, numClass=len(groups),\
+        labelGroups=LabelGroups(groups) if grouped else None)
+    params = doctor_ai.init_params(options)
+    tparams = doctor_ai.init_tparams(params, options)
+    use_noise, x, y, mask, lengths, cost = doctor_ai.build_model(tparams, options)
+    use_noise.set_value(1.)
+    grads = T.grad(cost, wrt=list(tparams.values()))
+    f_grad_shared, f_update = doctor_ai.adadelta(tparams, grads, x, y, mask, lengths, cost, options)
+
+    seqs, labels, _ = synthetic_patients(options['batchSize'], context['rng'], numClass=len(groups))
+    # the layers pad different targets, so the padding is timed as well
+    def run():
+        batch = doctor_ai.padMatrixWithoutTime(seqs, labels, options)
+        f_grad_shared(*batch, *doctor_ai.group_inputs(labels, options))
+        f_update()
+    return len(seqs), run
+
+def bench_visit_code_step_flat(scale, context):
+    return _bench_visit_code_step(scale, context, False)
+
+def bench_visit_code_step_groups(scale, context):
+    return _bench_visit_code_step(scale, context, True)
+
+def _predictions(n_visits, rng):
+    outputs = np.random.rand(n_visits, NUM_CLASS).astype(np.float32)
+    trueVec = [rng.sample(range(NUM_CLASS), rng.randint(1, 10)) for _ in range(n_visits)]
+    return outputs, trueVec
+
+def bench_recall_top(scale, context):
+    import test_doctor_ai
+    outputs, trueVec = _predictions(10000 * scale, context['rng'])
+    predVec = [tuple(row) for row in np.argsort(-outputs, axis=1)[:, :30].tolist()]
+    return len(trueVec), lambda: test_doctor_ai.recallTop(trueVec, predVec)
+
+def bench_topk_predictions(scale, context):
+    import test_doctor_ai
+    outputs, _ = _predictions(10000 * scale, context['rng'])
+    return len(outputs), lambda: test_doctor_ai.topk_predictions(outputs, 30)
+
+def bench_translate_numerics(scale, context):
+    from translate_codes_to_text import translate_numerics
+    rng = context['rng']
+    table = np.array(['description %d' % code for code in range(NUM_CLASS)])
+    rows = [rng.sample(range(NUM_CLASS), rng.randint(1, 10)) for _ in range(10000 * scale)]
+    return len(rows), lambda: translate_numerics(table, rows)
+
+BENCHMARKS = OrderedDict([
+    ('convert_to_icd9', bench_convert_to_icd9),
+    ('ccs_mapping', bench_ccs_mapping),
+    ('pad_matrix_without_time', bench_pad_matrix_without_time),
+    ('pad_matrix_with_time', bench_pad_matrix_with_time),
+    ('pad_matrix_with_time_prediction', bench_pad_matrix_with_time_prediction),
+    ('gru_layer_forward', bench_gru_layer_forward),
+    ('gru_layer_backward', bench_gru_layer_backward),
+    ('train_step', bench_train_step),
+    ('numpy_train_step', bench_numpy_train_step),
+    ('visit_code_step_flat', bench_visit_code_step_flat),
+    ('visit_code_step_groups', bench_visit_code_step_groups),
+    ('recall_top', bench_recall_top),
+    ('topk_predictions', bench_topk_predictions),
+    ('translate_numerics', bench_translate_numerics),
+])
+
+def measure(run, repeat):
+    '''
+    Returns the wall times of repeat runs, and the peak traced memory of one
+    extra run (tracing slows Python code down, so it is not timed).
+    '''
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        run()
+        times.append(time.perf_counter() - start)
+    tracemalloc.start()
+    run()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return times, peak
+
+def run_benchmarks(names, scales, repeat, context):
+    results = []
+    for name in names:
+        for scale in scales:
+            try:
+                n_items, run = BENCHMARKS[name](scale, context)
+            except ImportError as err:
+                logging.warning("skipping %s: %s", name, err)
+                break
+            times, peak = measure(run, repeat)
+            result = {
+                'name': name,
+                'scale': scale,
+                'n_items': n_items,
+                'seconds_median': float(np.median(times)),
+                'seconds_min': float(np.min(times)),
+                'items_per_second': n_items / max(float(np.median(times)), 1e-12),
+                'peak_bytes': peak}
+            logging.info("%s x%d: %.4fs median, %.1f MB peak", name, scale,\
+                result['seconds_median'], peak / 2**20)
+            results.append(result)
+    return results
+
+def find_regressions(results, baseline, threshold):
+    '''
+    Returns (name, scale, old, new) for every result whose median time is
+    more than threshold (a fraction) slower than the baseline.
+    '''
+    old = {(r['name'], r['scale']): r['seconds_median'] for r in baseline['results']}
+    regressions = []
+    for result in results:
+        key = (result['name'], result['scale'])
+        if key in old and result['seconds_median'] > old[key] * (1.0 + threshold):
+            regressions.append((key[0], key[1], old[key], result['seconds_median']))
+    return regressions
+
+def git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'],\
+            stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return ''
+
+def parse_arguments(parser):
+    parser.add_argument(\
+        'ccs_file',
+        type=str,
+        help='The path to the single-level CCS diagnosis csv file, used to draw realistic ICD9 codes.')
+    parser.add_argument(\
+        'out_file',
+        type=str,
+        help='The path to the JSON results file.')
+    parser.add_argument(\
+        '--n_header_rows',
+        type=int,
+        default=2,
+        help='The number of header rows in the CCS csv file (default value: 2)')
+    parser.add_argument(\
+        '--scales',
+        type=str,
+        default='1,10,100',
+        help='Comma-separated multiples of the base input size of every benchmark (default value: 1,10,100)')
+    parser.add_argument(\
+        '--only',
+        type=str,
+        default='',
+        help='Comma-separated benchmark names to run. Choices: ' + ', '.join(BENCHMARKS))
+    parser.add_argument(\
+        '--repeat',
+        type=int,
+        default=3,
+        help='The number of timed runs per benchmark and scale (default value: 3)')
+    parser.add_argument(\
+        '--baseline',
+        type=str,
+        default='',
+        help='The path to an earlier results file to compare against.')
+    parser.add_argument(\
+        '--threshold',
+        type=float,
+        default=0.25,
+        help='The allowed slowdown against the baseline as a fraction of its median time (default value: 0.25)')
+    parser.add_argument('-v', '--verbose', action='store_true',\
+        help='Show verbose output.')
+    args = parser.parse_args()
+    return args
+
+def main():
+    parser = argparse.ArgumentParser()
+    args = parse_arguments(parser)
+    if args.verbose:
+        logging.basicConfig(level=logging.DEBUG)
+    else:
+        logging.basicConfig(level=logging.INFO)
+
+    names = [name.strip() for name in args.only.split(',') if name.strip()] or list(BENCHMARKS)
+    unknown = [name for name in names if name not in BENCHMARKS]
+    if unknown:
+        parser.error('unknown benchmarks: ' + ', '.join(unknown))
+    scales = [int(scale) for scale in args.scales.split(',')]
+
+    ccs_map, ccs_translation = read_code_mapping(args.ccs_file, args.n_header_rows)
+    context = {
+        'rng': random.Random(12345),
+        'icd_codes': raw_icd_codes(ccs_map),
+        'vocab': CodeVocabulary.from_ccs_map(ccs_map, ccs_translation)}
+    np.random.seed(12345)
+
+    results = run_benchmarks(names, scales, args.repeat, context)
+    report = {
+        'meta': {
+            'timestamp': datetime.now().isoformat(),
+            'git_revision': git_revision(),
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'machine': platform.machine(),
+            'repeat': args.repeat},
+        'results': results}
+    with open(args.out_file, 'w', encoding='utf8') as outfile:
+        json.dump(report, outfile, indent=2)
+    logging.info("wrote %d results to %s", len(results), args.out_file)
+
+    if args.baseline:
+        with open(args.baseline, 'r') as infile:
+            baseline = json.load(infile)
+        regressions = find_regressions(results, baseline, args.threshold)
+        for name, scale, old, new in regressions:
+            logging.error("regression in %s x%d: %.4fs -> %.4fs", name, scale, old, new)
+        if regressions:
+            sys.exit(1)
+        logging.info("no regressions against %s", args.baseline)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,241 @@
+'''This module benchmarks how long the command-line scripts take to start,
+for wrappers that call them many times.
+
+Every command is run as a separate Python process, as a wrapper would, and
+timed from its start:
+    - help:<script>:                    <script> --help, the cost of the
+                                        imports at module load
+    - first_batch:doctor_ai:<backend>:  until doctor_ai.py has trained its
+                                        first mini-batch, with the numpy
+                                        and the theano backend
+    - first_prediction:test_doctor_ai:  a whole test_doctor_ai.py run on a
+                                        small split
+    - first_prediction:score_cohort:    a whole score_cohort.py run on a
+                                        small patient store, with one worker
+The training and test data are synthetic patients written to a temporary
+directory, and the model scored has random parameters of the given shape.
+Commands that need Theano are skipped if it is not installed.
+
+outputs:
+    - JSON file with the median and minimum seconds of every command.  With
+      --baseline, the run fails (exit status 1) if any median time
+      regressed by more than --threshold.
+'''
+
+import argparse
+from datetime import datetime
+import importlib.util
+import json
+import logging
+import os
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+SCRIPTS_DIR = os.path.dirname(os.path.abspath(__file__))
+HELP_SCRIPTS = ('create_ccs_dict.py', 'process_mimic.py', 'doctor_ai.py', 'test_doctor_ai.py',\
+    'translate_codes_to_text.py', 'score_cohort.py', 'select_checkpoint.py', 'sweep_doctor_ai.py')
+
+def time_until(command, pattern='', env=None):
+    '''
+    Returns the seconds from starting command until a line of its output
+    contains pattern, when the command is stopped, or without a pattern
+    until it exits.
+    '''
+    env = dict(os.environ if env is None else env, PYTHONUNBUFFERED='1')
+    start = time.perf_counter()
+    process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,\
+        universal_newlines=True, env=env)
+    output = []
+    for line in process.stdout:
+        if pattern and pattern in line:
+            seconds = time.perf_counter() - start
+            process.kill()
+            process.wait()
+            return seconds
+        output.append(line)
+    process.wait()
+    seconds = time.perf_counter() - start
+    if process.returncode != 0 or pattern:
+        raise RuntimeError(f'{" ".join(command)} ' + (f'exited with status {process.returncode}'\
+            if process.returncode != 0 else f'never printed {pattern!r}') + ':\n' + ''.join(output[-20:]))
+    return seconds
+
+def script(name):
+    return [sys.executable, os.path.join(SCRIPTS_DIR, name)]
+
+def write_data(work_dir, args):
+    '''
+    Writes synthetic train/valid/test splits as JSON files, the test split
+    as a patient store, and a model with random parameters.  Returns the
+    paths by name.
+    '''
+    import numpy as np
+    from benchmark_pipeline import model_options, synthetic_patients
+    import doctor_ai
+    from patient_store import write_patient_store
+
+    rng = random.Random(12345)
+    paths = {}
+    for split in ('train', 'valid', 'test'):
+        seqs, labels, _ = synthetic_patients(args.n_patients, rng, args.n_input_codes, args.n_output_codes)
+        for kind, data in (('visit', seqs), ('label', labels)):
+            paths[f'{kind}_{split}'] = os.path.join(work_dir, f'seqs_{kind}.{split}.json')
+            with open(paths[f'{kind}_{split}'], 'w', encoding='utf8') as outfile:
+                json.dump(data, outfile)
+    paths['store_test'] = os.path.join(work_dir, 'patients.test')
+    write_patient_store(paths['store_test'], list(range(len(seqs))), seqs, labels)
+
+    options = model_options(inputDimSize=args.n_input_codes, numClass=args.n_output_codes,\
+        embSize=args.embed_size, hiddenDimSize=parse_hidden_dim_size(args.hidden_dim_size))
+    paths['model'] = os.path.join(work_dir, 'model.npz')
+    np.savez_compressed(paths['model'], **doctor_ai.init_params(options))
+    return paths
+
+def startup_commands(paths, work_dir, args):
+    '''
+    Returns (name, command, pattern) for every command to time.
+    '''
+    commands = [(f'help:{name}', script(name) + ['--help'], '') for name in HELP_SCRIPTS]
+    backends = ['numpy'] + (['theano'] if importlib.util.find_spec('theano') else [])
+    for backend in backends:
+        commands.append((f'first_batch:doctor_ai:{backend}', script('doctor_ai.py') + [\
+            paths['visit_train'], paths['visit_test'], paths['visit_valid'], str(args.n_input_codes),\
+            paths['label_train'], paths['label_test'], paths['label_valid'], str(args.n_output_codes),\
+            os.path.join(work_dir, 'trained'), '--backend', backend, '--embed_size', str(args.embed_size),\
+            '--hidden_dim_size', args.hidden_dim_size, '--batch_size', str(args.batch_size), '--verbose'],\
+            'epoch:0, iteration:0'))
+    if 'theano' in backends:
+        commands.append(('first_prediction:test_doctor_ai', script('test_doctor_ai.py') + [\
+            paths['model'], paths['visit_test'], paths['label_test'], args.hidden_dim_size,\
+            '--output_file', os.path.join(work_dir, 'predictions.json')], ''))
+    commands.append(('first_prediction:score_cohort', script('score_cohort.py') + [\
+        paths['model'], paths['store_test'], os.path.join(work_dir, 'scores-{run}'), '--workers', '1'], ''))
+    return commands
+
+def find_regressions(results, baseline, threshold):
+    '''
+    Returns (name, old, new) for every result whose median time is more
+    than threshold (a fraction) slower than the baseline.
+    '''
+    old = {result['name']: result['seconds_median'] for result in baseline['results']}
+    return [(result['name'], old[result['name']], result['seconds_median']) for result in results\
+        if result['name'] in old and result['seconds_median'] > old[result['name']] * (1.0 + threshold)]
+
+def parse_hidden_dim_size(value):
+    return [int(strDim) for strDim in value.strip()[1:-1].split(',')]
+
+def parse_arguments(parser):
+    parser.add_argument(\
+        'out_file',
+        type=str,
+        help='The path to the JSON results file.')
+    parser.add_argument(\
+        '--n_patients',
+        type=int,
+        default=200,
+        help='The number of synthetic patients of every split (default value: 200)')
+    parser.add_argument(\
+        '--n_input_codes',
+        type=int,
+        default=4894,
+        help='The number of unique input codes (default value: 4894)')
+    parser.add_argument(\
+        '--n_output_codes',
+        type=int,
+        default=273,
+        help='The number of unique label codes (default value: 273)')
+    parser.add_argument(\
+        '--embed_size',
+        type=int,
+        default=200,
+        help='The embedding size of the model (default value: 200)')
+    parser.add_argument(\
+        '--hidden_dim_size',
+        type=str,
+        default='[200,200]',
+        help='The GRU layer sizes of the model (default value: [200,200])')
+    parser.add_argument(\
+        '--batch_size',
+        type=int,
+        default=100,
+        help='The size of a single mini-batch (default value: 100)')
+    parser.add_argument(\
+        '--only',
+        type=str,
+        default='',
+        help='Comma-separated prefixes of the command names to time, e.g. help,first_batch')
+    parser.add_argument(\
+        '--repeat',
+        type=int,
+        default=3,
+        help='The number of timed runs per command (default value: 3)')
+    parser.add_argument(\
+        '--baseline',
+        type=str,
+        default='',
+        help='The path to an earlier results file to compare against.')
+    parser.add_argument(\
+        '--threshold',
+        type=float,
+        default=0.25,
+        help='The allowed slowdown against the baseline as a fraction of its median time (default value: 0.25)')
+    parser.add_argument('-v', '--verbose', action='store_true',\
+        help='Show verbose output.')
+    args = parser.parse_args()
+    return args
+
+def main():
+    parser = argparse.ArgumentParser()
+    args = parse_arguments(parser)
+    if args.verbose:
+        logging.basicConfig(level=logging.DEBUG)
+    else:
+        logging.basicConfig(level=logging.INFO)
+
+    import numpy as np
+    from benchmark_pipeline import git_revision
+
+    work_dir = tempfile.mkdtemp(prefix='benchmark_startup-')
+    try:
+        paths = write_data(work_dir, args)
+        prefixes = [prefix.strip() for prefix in args.only.split(',') if prefix.strip()]
+        results = []
+        for name, command, pattern in startup_commands(paths, work_dir, args):
+            if prefixes and not any(name.startswith(prefix) for prefix in prefixes):
+                continue
+            times = [time_until([part.format(run=run) for part in command], pattern) for run in range(args.repeat)]
+            result = {'name': name, 'seconds_median': float(np.median(times)), 'seconds_min': float(np.min(times))}
+            logging.info("%s: %.3fs median, %.3fs min", name, result['seconds_median'], result['seconds_min'])
+            results.append(result)
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    report = {
+        'meta': {
+            'timestamp': datetime.now().isoformat(),
+            'git_revision': git_revision(),
+            'python': platform.python_version(),
+            'machine': platform.machine(),
+            'repeat': args.repeat},
+        'results': results}
+    with open(args.out_file, 'w', encoding='utf8') as outfile:
+        json.dump(report, outfile, indent=2)
+    logging.info("wrote %d results to %s", len(results), args.out_file)
+
+    if args.baseline:
+        with open(args.baseline, 'r') as infile:
+            baseline = json.load(infile)
+        regressions = find_regressions(results, baseline, args.threshold)
+        for name, old, new in regressions:
+            logging.error("regression in %s: %.3fs -> %.3fs", name, old, new)
+        if regressions:
+            sys.exit(1)
+        logging.info("no regressions against %s", args.baseline)
+
+if __name__ == '__main__':
+    main()
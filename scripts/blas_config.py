@@ -0,0 +1,83 @@
+'''This module holds the BLAS thread and process layout recommended by
+autotune_blas.py and applies it to the training and scoring commands.
+
+The recommendation is read from the file in DOCTOR_AI_BLAS_CONFIG, or else
+~/.doctor_ai/blas_config.json.  For every workload it holds the threads and
+processes of the layout with the best total throughput, and the best
+threads of a single process.  Every workload is measured with the code it
+is applied to:
+    - train:        the Theano training step, for doctor_ai.py and
+                    sweep_doctor_ai.py
+    - train_numpy:  the numpy_trainer.py training step, for
+                    doctor_ai.py --backend numpy
+    - score:        the numpy_model.py forward pass, for score_cohort.py
+A recommendation measured on a machine with a different number of cores is
+ignored.
+
+BLAS libraries read their thread count from the environment when they are
+loaded, so the thread variables must be set before NumPy is imported, or
+before a process pool starts its workers.  Thread variables already set in
+the environment are left alone.
+
+This module only uses the standard library, so it can be imported first.
+'''
+
+import json
+import os
+
+BLAS_THREAD_VARIABLES = ('OMP_NUM_THREADS', 'MKL_NUM_THREADS', 'OPENBLAS_NUM_THREADS')
+CONFIG_VARIABLE = 'DOCTOR_AI_BLAS_CONFIG'
+WORKLOADS = ('train', 'train_numpy', 'score')
+
+def config_file():
+    return os.environ.get(CONFIG_VARIABLE) or os.path.join(os.path.expanduser('~'), '.doctor_ai', 'blas_config.json')
+
+def load_config(path=''):
+    '''
+    Returns the configuration written by autotune_blas.py, or None if there
+    is none or it cannot be read.
+    '''
+    try:
+        with open(path or config_file(), 'r') as infile:
+            return json.load(infile)
+    except (OSError, ValueError):
+        return None
+
+def recommended_layout(workload, config=None):
+    '''
+    Returns the recommended layout of a workload, a dictionary with
+    'threads', 'processes' and 'single_process_threads', or None.
+    '''
+    config = load_config() if config is None else config
+    if not config or workload not in config or config.get('cores') != os.cpu_count():
+        return None
+    return config[workload]
+
+def train_workload(argv):
+    '''
+    Returns the workload of a doctor_ai.py command line: train_numpy with
+    --backend numpy, otherwise train.
+    '''
+    for index, arg in enumerate(argv):
+        if arg == '--backend=numpy' or (arg == '--backend' and argv[index + 1:index + 2] == ['numpy']):
+            return 'train_numpy'
+    return 'train'
+
+def threads_set():
+    return any(name in os.environ for name in BLAS_THREAD_VARIABLES)
+
+def set_blas_threads(threads):
+    for name in BLAS_THREAD_VARIABLES:
+        os.environ[name] = str(threads)
+
+def apply_single_process_threads(workload):
+    '''
+    Sets the BLAS threads of a single training or scoring process to the
+    recommended ones, unless the environment sets them.  Returns the threads
+    set, or None.
+    '''
+    layout = recommended_layout(workload)
+    if layout is None or threads_set():
+        return None
+    set_blas_threads(layout['single_process_threads'])
+    return layout['single_process_threads']
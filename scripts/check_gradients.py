@@ -0,0 +1,231 @@
+'''This module checks the hand-derived gradients of numpy_trainer.py.
+
+For every model variant (durations not used, used or also predicted; code
+embedding fine-tuned or fixed) a small model with random parameters and a
+random padded batch are made.  The gradients of
+numpy_trainer.cost_and_grads are compared with central finite differences
+of its cost in float64, with and without dropout, and, if Theano can be
+imported, the cost and gradients without dropout are compared with T.grad of
+build_model in doctor_ai.py in float32.
+
+The error of a parameter is the largest absolute difference of its
+gradients relative to the largest absolute reference gradient.
+
+outputs:
+    - the cost and largest gradient error of every variant and check
+    - exit status 1 if any error exceeds its tolerance
+'''
+
+import argparse
+from collections import OrderedDict
+import logging
+import sys
+
+import numpy as np
+
+import numpy_trainer
+
+# (predictTime, useTime, embFineTune)
+VARIANTS = [(False, False, True), (False, False, False), (False, True, True),\
+    (False, True, False), (True, True, True), (True, True, False)]
+
+def check_options(predictTime, useTime, embFineTune, args):
+    return {
+        'timeFileTrain': 'time' if useTime else '', 'predictTime': predictTime, 'useTime': useTime,
+        'embFineTune': embFineTune, 'inputDimSize': args.n_input_codes, 'numClass': args.n_output_codes,
+        'embSize': args.embed_size, 'hiddenDimSize': args.hidden_dim_size, 'dropout_rate': 0.5,
+        'logEps': 1e-8, 'L2_output': 0.01, 'L2_time': 0.01, 'tradeoff': 0.5, 'labelGroups': None,
+        'bpttWindow': 0}
+
+def random_params(options, rng, scale=0.5):
+    '''
+    Returns parameters laid out as by init_params in doctor_ai.py, drawn
+    large enough for the gradients of every parameter to matter.
+    '''
+    params = OrderedDict()
+    params['W_emb'] = rng.uniform(-scale, scale, (options['inputDimSize'], options['embSize']))
+    params['b_emb'] = rng.uniform(-scale, scale, options['embSize'])
+    prevDimSize = options['embSize'] + int(options['useTime'])
+    for count, hiddenDimSize in enumerate(options['hiddenDimSize']):
+        for name in ('W_', 'W_r_', 'W_z_'):
+            params[name + str(count)] = rng.uniform(-scale, scale, (prevDimSize, hiddenDimSize))
+        for name in ('U_', 'U_r_', 'U_z_'):
+            params[name + str(count)] = rng.uniform(-scale, scale, (hiddenDimSize, hiddenDimSize))
+        for name in ('b_', 'b_r_', 'b_z_'):
+            params[name + str(count)] = rng.uniform(-scale, scale, hiddenDimSize)
+        prevDimSize = hiddenDimSize
+    params['W_output'] = rng.uniform(-scale, scale, (prevDimSize, options['numClass']))
+    params['b_output'] = rng.uniform(-scale, scale, options['numClass'])
+    if options['predictTime']:
+        params['W_time'] = rng.uniform(-scale, scale, (prevDimSize, 1))
+        params['b_time'] = np.array([scale])
+    return params
+
+def random_inputs(options, rng, n_samples, maxlen):
+    '''
+    Returns a padded batch of n_samples patients of 1 to maxlen visits, in
+    the order of the inputs of the padMatrix functions of doctor_ai.py.
+    '''
+    lengths = rng.randint(1, maxlen + 1, n_samples).astype(np.float64)
+    lengths[0] = maxlen
+    mask = (np.arange(maxlen)[:, None] < lengths[None, :]).astype(np.float64)
+    x = (rng.rand(maxlen, n_samples, options['inputDimSize']) < 0.2) * mask[:, :, None]
+    y = (rng.rand(maxlen, n_samples, options['numClass']) < 0.2) * mask[:, :, None]
+    inputs = [x, y]
+    if options['useTime']:
+        inputs.append(rng.rand(maxlen, n_samples) * mask)
+    if options['predictTime']:
+        inputs.append(rng.rand(maxlen, n_samples) * mask)
+    return inputs + [mask, lengths]
+
+def relative_error(grad, reference):
+    return float(np.abs(grad - reference).max() / max(np.abs(reference).max(), 1e-12))
+
+def finite_difference_errors(params, inputs, options, W_emb, dropoutMasks, step=1e-4):
+    '''
+    Returns the cost and the gradient error of every parameter against
+    central finite differences.
+    '''
+    cost, grads = numpy_trainer.cost_and_grads(params, inputs, options, W_emb, dropoutMasks)
+    errors = OrderedDict()
+    for key, value in params.items():
+        numeric = np.zeros_like(value)
+        for index in np.ndindex(value.shape):
+            original = value[index]
+            value[index] = original + step
+            costPlus, _ = numpy_trainer.cost_and_grads(params, inputs, options, W_emb, dropoutMasks, False)
+            value[index] = original - step
+            costMinus, _ = numpy_trainer.cost_and_grads(params, inputs, options, W_emb, dropoutMasks, False)
+            value[index] = original
+            numeric[index] = (costPlus - costMinus) / (2 * step)
+        errors[key] = relative_error(grads[key], numeric)
+    return cost, errors
+
+def theano_errors(params, inputs, options, W_emb):
+    '''
+    Returns the relative cost difference and the gradient error of every
+    parameter against T.grad of build_model in doctor_ai.py, without
+    dropout.
+    '''
+    import theano
+    import theano.tensor as T
+    from theano import config
+    import doctor_ai
+
+    floatParams = OrderedDict((key, value.astype(config.floatX)) for key, value in params.items())
+    floatInputs = [tensor.astype(config.floatX) for tensor in inputs]
+    tparams = OrderedDict((key, theano.shared(value, name=key)) for key, value in floatParams.items())
+    sharedEmb = None if W_emb is None else theano.shared(W_emb.astype(config.floatX), name='W_emb')
+    outputs = doctor_ai.build_model(tparams, dict(options), sharedEmb)
+    grads = T.grad(outputs[-1], wrt=list(tparams.values()))
+    f = theano.function(list(outputs[1:-1]), [outputs[-1]] + grads, name='check_gradients')
+    theanoCost, *theanoGrads = f(*floatInputs)
+
+    cost, grads = numpy_trainer.cost_and_grads(floatParams, floatInputs, options,\
+        None if W_emb is None else W_emb.astype(config.floatX))
+    errors = OrderedDict((key, relative_error(grads[key], theanoGrad))\
+        for key, theanoGrad in zip(tparams, theanoGrads))
+    return abs(cost - theanoCost) / abs(theanoCost), errors
+
+def parse_arguments(parser):
+    parser.add_argument(\
+        '--n_input_codes',
+        type=int,
+        default=12,
+        help='The number of input codes of the random models (default value: 12)')
+    parser.add_argument(\
+        '--n_output_codes',
+        type=int,
+        default=7,
+        help='The number of label codes of the random models (default value: 7)')
+    parser.add_argument(\
+        '--embed_size',
+        type=int,
+        default=5,
+        help='The embedding size of the random models (default value: 5)')
+    parser.add_argument(\
+        '--hidden_dim_size',
+        type=int,
+        nargs='+',
+        default=[4, 3],
+        help='The GRU layer sizes of the random models (default value: 4 3)')
+    parser.add_argument(\
+        '--n_samples',
+        type=int,
+        default=3,
+        help='The number of patients of the random batches (default value: 3)')
+    parser.add_argument(\
+        '--max_visits',
+        type=int,
+        default=4,
+        help='The number of visits of the longest patient of the random batches (default value: 4)')
+    parser.add_argument(\
+        '--tolerance',
+        type=float,
+        default=1e-4,
+        help='The largest accepted gradient error against finite differences (default value: 1e-4)')
+    parser.add_argument(\
+        '--theano_tolerance',
+        type=float,
+        default=1e-3,
+        help='The largest accepted cost and gradient error against Theano, in float32 (default value: 1e-3)')
+    parser.add_argument(\
+        '--seed',
+        type=int,
+        default=1234,
+        help='The seed of the random models and batches (default value: 1234)')
+    parser.add_argument('-v', '--verbose', action='store_true',\
+        help='Show the error of every parameter.')
+    args = parser.parse_args()
+    return args
+
+def main():
+    parser = argparse.ArgumentParser()
+    args = parse_arguments(parser)
+    if args.verbose:
+        logging.basicConfig(level=logging.DEBUG)
+    else:
+        logging.basicConfig(level=logging.INFO)
+
+    try:
+        import theano
+    except ImportError:
+        theano = None
+        logging.warning("theano cannot be imported, checking against finite differences only")
+
+    rng = np.random.RandomState(args.seed)
+    failed = False
+    for predictTime, useTime, embFineTune in VARIANTS:
+        options = check_options(predictTime, useTime, embFineTune, args)
+        variant = f'predictTime={int(predictTime)} useTime={int(useTime)} embFineTune={int(embFineTune)}'
+        params = random_params(options, rng)
+        W_emb = None if embFineTune else params.pop('W_emb')
+        inputs = random_inputs(options, rng, args.n_samples, args.max_visits)
+        dropoutMasks = [rng.binomial(1, options['dropout_rate'], size=inputs[-2].shape + (size,)).astype(np.float64)\
+            for size in options['hiddenDimSize']]
+
+        checks = [('finite differences', 'without dropout', None), ('finite differences', 'with dropout', dropoutMasks)]
+        for reference, dropout, masks in checks:
+            cost, errors = finite_difference_errors(params, inputs, options, W_emb, masks)
+            worst = max(errors, key=errors.get)
+            failed = failed or errors[worst] > args.tolerance
+            logging.info("%s, %s, %s: cost %.6f, largest error %.2e (%s)", variant, reference, dropout,\
+                cost, errors[worst], worst)
+            for key, error in errors.items():
+                logging.debug("    %s: %.2e", key, error)
+        if theano is not None:
+            costError, errors = theano_errors(params, inputs, options, W_emb)
+            worst = max(errors, key=errors.get)
+            failed = failed or costError > args.theano_tolerance or errors[worst] > args.theano_tolerance
+            logging.info("%s, theano: cost error %.2e, largest error %.2e (%s)", variant, costError,\
+                errors[worst], worst)
+            for key, error in errors.items():
+                logging.debug("    %s: %.2e", key, error)
+
+    if failed:
+        logging.error("gradient check failed")
+        sys.exit(1)
+    logging.info("gradient check passed")
+
+if __name__ == '__main__':
+    main()
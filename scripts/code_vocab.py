@@ -0,0 +1,275 @@
+'''This module holds the code vocabulary shared by the pipeline scripts.
+
+The pipeline moves between four representations of a diagnosis code:
+    - the ICD-9 string found in MIMIC (e.g. "D_401.9"), mapped to a visit id
+    - the CCS category that ICD-9 code belongs to (e.g. 98)
+    - the label id the model is trained to predict for that CCS category
+    - the text description of the CCS category
+
+Historically each script re-read the JSON dictionaries and searched them
+linearly.  CodeVocabulary keeps every mapping as a dense NumPy table indexed
+by integer id, so a lookup is one array index (or one dict probe for ICD-9
+strings), and whole arrays of ids can be translated in a single call.
+
+The binary form is a directory of .npy files, one per table, that can be
+opened with np.load(..., mmap_mode='r') so that loading a vocabulary costs
+nothing until a table is touched.
+
+tables:
+    - icd_codes:    ICD-9 code without dot           (from create_ccs_dict.py)
+    - icd_ccs:      ICD-9 code index -> CCS category (from create_ccs_dict.py)
+    - ccs_text:     CCS category -> description      (from create_ccs_dict.py)
+    - visit_codes:  visit id -> "D_" ICD-9 string     (from process_mimic.py)
+    - visit_labels: visit id -> label id              (from process_mimic.py)
+    - label_codes:  label id -> label key string      (from process_mimic.py)
+    - label_ccs:    label id -> CCS category, -1 if the label is not CCS
+    - label_text:   label id -> description
+    - ccs_label:    CCS category -> label id, -1 if the category is unused
+    - raw_codes:    "D_" ICD-9 strings too rare to get their own visit id
+    - raw_visit_ids: the visit id (parent code or hash bucket) of each of
+                    raw_codes                        (process_mimic.py --min_code_count)
+'''
+
+import json
+import logging
+import os
+
+import numpy as np
+
+VOCAB_TABLES = (
+    'icd_codes', 'icd_ccs', 'ccs_text',
+    'visit_codes', 'visit_labels',
+    'label_codes', 'label_ccs', 'label_text', 'ccs_label',
+    'raw_codes', 'raw_visit_ids')
+
+def _str_array(values):
+    if len(values) == 0:
+        return np.zeros(0, dtype='U1')
+    return np.array(values, dtype=str)
+
+def _int_array(values):
+    return np.array(values, dtype=np.int32).reshape(-1)
+
+def label_key_to_ccs(key):
+    '''
+    Returns the CCS category for a label key, or -1 for labels that are raw
+    ICD-9 codes which were not found in the CCS dictionary.
+    '''
+    key = str(key)
+    return int(key) if key.isdigit() else -1
+
+class CodeVocabulary:
+    '''
+    Dense forward and reverse tables between visit ids, label ids, ICD-9
+    codes, CCS categories and CCS descriptions.
+    '''
+
+    def __init__(self, tables):
+        for name in VOCAB_TABLES:
+            if name in tables:
+                table = tables[name]
+            elif name in ('icd_ccs', 'visit_labels', 'label_ccs', 'ccs_label', 'raw_visit_ids'):
+                table = _int_array([])
+            else:
+                table = _str_array([])
+            setattr(self, name, table)
+        self._icd_index = None
+        self._visit_index = None
+        self._label_index = None
+
+    @property
+    def n_visit_codes(self):
+        return len(self.visit_codes)
+
+    @property
+    def n_labels(self):
+        return len(self.label_codes)
+
+    @classmethod
+    def from_ccs_map(cls, ccs_map, ccs_translation):
+        '''
+        Builds the ICD-9 and CCS tables from the {ccs: [icd9, ...]} and
+        {ccs: description} dictionaries written by create_ccs_dict.py.
+        The first CCS category listing an ICD-9 code wins, matching the
+        order in which the dictionaries were written.
+        '''
+        icd_codes = []
+        icd_ccs = []
+        seen = set()
+        for ccs, icds in ccs_map.items():
+            for icd in icds:
+                if icd in seen:
+                    continue
+                seen.add(icd)
+                icd_codes.append(icd)
+                icd_ccs.append(int(ccs))
+
+        max_ccs = max([int(ccs) for ccs in ccs_map] + [int(ccs) for ccs in ccs_translation] + [0])
+        ccs_text = [''] * (max_ccs + 1)
+        for ccs, description in ccs_translation.items():
+            ccs_text[int(ccs)] = description
+
+        return cls({
+            'icd_codes': _str_array(icd_codes),
+            'icd_ccs': _int_array(icd_ccs),
+            'ccs_text': _str_array(ccs_text)})
+
+    @classmethod
+    def from_json_files(cls, ccs_map_file='', ccs_text_file='',\
+        visit_types_file='', label_types_file=''):
+        '''
+        Builds a vocabulary from the JSON dictionaries of create_ccs_dict.py
+        and process_mimic.py.  Any of the files may be omitted.
+        '''
+        ccs_map = {}
+        ccs_translation = {}
+        if ccs_map_file:
+            with open(ccs_map_file, 'r') as infile:
+                ccs_map = json.load(infile)
+        if ccs_text_file:
+            with open(ccs_text_file, 'r') as infile:
+                ccs_translation = json.load(infile)
+        vocab = cls.from_ccs_map(ccs_map, ccs_translation)
+
+        types = {}
+        ccs_types = {}
+        if visit_types_file:
+            with open(visit_types_file, 'r') as infile:
+                types = json.load(infile)
+        if label_types_file:
+            with open(label_types_file, 'r') as infile:
+                ccs_types = json.load(infile)
+        if types or ccs_types:
+            vocab = vocab.with_types(types, ccs_types)
+        return vocab
+
+    def with_types(self, types, ccs_types, visit_ccs=None, code_map=None):
+        '''
+        Returns a copy of this vocabulary extended with the visit and label
+        id tables built by process_mimic.py.  types maps "D_" ICD-9 strings
+        to visit ids, ccs_types maps CCS categories (or unmapped ICD-9
+        strings) to label ids.  visit_ccs optionally gives the label key of
+        every visit code; otherwise it is looked up in the ICD-9 table.
+        code_map optionally maps rare ICD-9 strings to the visit code in
+        types that stands in for them.
+        '''
+        visit_codes = [''] * len(types)
+        for code, index in types.items():
+            visit_codes[index] = code
+
+        label_codes = [''] * len(ccs_types)
+        for key, index in ccs_types.items():
+            label_codes[index] = str(key)
+        label_index = {key: index for index, key in enumerate(label_codes)}
+
+        visit_labels = []
+        for code in visit_codes:
+            if visit_ccs is not None:
+                key = visit_ccs[code]
+            else:
+                key = self.icd_to_ccs(code[2:].replace('.', ''))
+                if key < 0:
+                    key = code
+            visit_labels.append(label_index.get(str(key), -1))
+
+        label_ccs = _int_array([label_key_to_ccs(key) for key in label_codes])
+        max_ccs = max(len(self.ccs_text) - 1, int(label_ccs.max()) if len(label_ccs) else 0, 0)
+        ccs_label = np.full(max_ccs + 1, -1, dtype=np.int32)
+        numeric = label_ccs >= 0
+        ccs_label[label_ccs[numeric]] = np.nonzero(numeric)[0]
+
+        tables = self.tables()
+        tables.update({
+            'visit_codes': _str_array(visit_codes),
+            'visit_labels': _int_array(visit_labels),
+            'label_codes': _str_array(label_codes),
+            'label_ccs': label_ccs,
+            'ccs_label': ccs_label})
+        if code_map:
+            tables['raw_codes'] = _str_array(list(code_map))
+            tables['raw_visit_ids'] = _int_array([types[code] for code in code_map.values()])
+        vocab = CodeVocabulary(tables)
+        vocab.label_text = vocab.ccs_to_text(label_ccs)
+        return vocab
+
+    def tables(self):
+        return {name: getattr(self, name) for name in VOCAB_TABLES}
+
+    def save(self, vocab_dir):
+        '''
+        Writes every table as <vocab_dir>/<table>.npy.
+        '''
+        os.makedirs(vocab_dir, exist_ok=True)
+        for name, table in self.tables().items():
+            np.save(os.path.join(vocab_dir, name + '.npy'), np.ascontiguousarray(table))
+        logging.debug("saved vocabulary to %s", vocab_dir)
+
+    @classmethod
+    def load(cls, vocab_dir, mmap_mode='r'):
+        '''
+        Opens a vocabulary written by save().  Tables are memory-mapped by
+        default; pass mmap_mode=None to read them into memory.
+        '''
+        tables = {}
+        for name in VOCAB_TABLES:
+            path = os.path.join(vocab_dir, name + '.npy')
+            if os.path.exists(path):
+                tables[name] = np.load(path, mmap_mode=mmap_mode)
+        logging.debug("loaded vocabulary from %s", vocab_dir)
+        return cls(tables)
+
+    def icd_to_ccs(self, icd):
+        '''
+        Returns the CCS category of an ICD-9 code (without dot), or -1.
+        '''
+        if self._icd_index is None:
+            self._icd_index = dict(zip(self.icd_codes.tolist(), self.icd_ccs.tolist()))
+        return self._icd_index.get(icd, -1)
+
+    def visit_id(self, code):
+        '''
+        Returns the visit id of a "D_" ICD-9 string, or -1.  Codes that were
+        too rare for an id of their own get the id that stands in for them.
+        '''
+        if self._visit_index is None:
+            self._visit_index = dict(zip(self.raw_codes.tolist(), self.raw_visit_ids.tolist()))
+            self._visit_index.update((code, index) for index, code in enumerate(self.visit_codes.tolist()))
+        return self._visit_index.get(code, -1)
+
+    def label_id(self, key):
+        '''
+        Returns the label id of a CCS category or label key, or -1.
+        '''
+        if self._label_index is None:
+            self._label_index = {key: index for index, key in enumerate(self.label_codes.tolist())}
+        return self._label_index.get(str(key), -1)
+
+    def label_to_ccs(self, label_ids):
+        return self.label_ccs[np.asarray(label_ids, dtype=np.intp)]
+
+    def label_to_text(self, label_ids):
+        return self.label_text[np.asarray(label_ids, dtype=np.intp)]
+
+    def visit_to_label(self, visit_ids):
+        return self.visit_labels[np.asarray(visit_ids, dtype=np.intp)]
+
+    def ccs_to_label(self, ccs_codes):
+        ccs_codes = np.asarray(ccs_codes, dtype=np.intp)
+        valid = (ccs_codes >= 0) & (ccs_codes < len(self.ccs_label))
+        return np.where(valid, self.ccs_label[np.where(valid, ccs_codes, 0)], -1)
+
+    def ccs_to_text(self, ccs_codes):
+        ccs_codes = np.asarray(ccs_codes, dtype=np.intp)
+        if len(self.ccs_text) == 0:
+            return np.full(ccs_codes.shape, '', dtype='U1')
+        valid = (ccs_codes >= 0) & (ccs_codes < len(self.ccs_text))
+        return np.where(valid, self.ccs_text[np.where(valid, ccs_codes, 0)], '')
+
+def open_vocabulary(vocab_dir='', **json_files):
+    '''
+    Opens the binary vocabulary in vocab_dir if given, otherwise builds one
+    from the JSON files accepted by CodeVocabulary.from_json_files.
+    '''
+    if vocab_dir:
+        return CodeVocabulary.load(vocab_dir)
+    return CodeVocabulary.from_json_files(**json_files)
@@ -11,6 +11,8 @@ inputs:
 outputs:
     - Dictionary of ICD to CCS codes as JSON file.
     - Dictionary of CCS codes to their descriptions as JSON file.
+    - Binary code vocabulary directory (<basename>_vocab/) holding the same
+      mappings as dense tables, see code_vocab.py.
 
 '''
 
@@ -18,8 +20,11 @@ import argparse
 import json
 import os
 
-def get_code_mapping(in_file, out_dir, n_header_rows):
-
+def read_code_mapping(in_file, n_header_rows):
+    '''
+    Reads the single-level CCS csv file into {ccs: [icd9, ...]} and
+    {ccs: description} dictionaries.
+    '''
     ccs_map = {}
     ccs_translation = {}
     with open(in_file, 'r') as ref:
@@ -36,6 +41,10 @@ def get_code_mapping(in_file, out_dir, n_header_rows):
             else:
                 ccs_map[int(ccs)] = [icd.strip()]
                 ccs_translation[int(ccs)] = str(ccs_description)
+    return ccs_map, ccs_translation
+
+def get_code_mapping(in_file, out_dir, n_header_rows):
+    ccs_map, ccs_translation = read_code_mapping(in_file, n_header_rows)
 
     # output as dict to be read in and used to 'translate' diagnosis codes in doctorai
     basename = os.path.splitext(os.path.basename(in_file))[0]
@@ -46,6 +55,12 @@ def get_code_mapping(in_file, out_dir, n_header_rows):
     with open(ccs_translation_path, 'w', encoding='utf8') as ccs_translation_file:
         json.dump(ccs_translation, ccs_translation_file, indent=2)
 
+    # binary form of both dicts for constant time lookups in later scripts;
+    # imported here so that read_code_mapping does not load NumPy
+    from code_vocab import CodeVocabulary
+    vocab = CodeVocabulary.from_ccs_map(ccs_map, ccs_translation)
+    vocab.save(os.path.join(out_dir, basename + '_vocab'))
+
 def parse_arguments(parser):
     parser.add_argument(\
         'in_file',
@@ -20,6 +20,13 @@ The outputs:
     by lookup to get ICD9 codes.  Note: no other fields or data are used for
     this model! We're only using ICD9 Diagnostic codes by default.
 
+    Instead of the JSON files, the visit file arguments may be shard
+    directories (shards.<split>/) written by process_mimic.py --shard_size.
+    The splits are then streamed shard by shard through a bounded shuffle
+    buffer, so training memory does not grow with the size of the cohort.
+    They may also be patient stores (patients.<split>/), which are
+    memory-mapped and read batch by batch.
+
     The ICD9 codes were first mapped to integers to keep the overhead down.
     The label codes could be anything.  Here, we decided to collapse
     ICD9 codes together into CCS codes, which represent categories
@@ -33,16 +40,46 @@ The outputs:
 import argparse
 from collections import OrderedDict
 from datetime import datetime
+import itertools
 import json
+import multiprocessing
+import os
 import random
 import sys
+import time
 
+import blas_config
+# BLAS reads its thread count when NumPy loads it, before the backend is
+# known from the parsed arguments
+blas_config.apply_single_process_threads(blas_config.train_workload(sys.argv))
 import numpy as np
 
-import theano
-import theano.tensor as T
-from theano import config
-from theano.sandbox.rng_mrg import MRG_RandomStreams as RandomStreams
+from code_vocab import CodeVocabulary
+from label_groups import LabelGroups
+from memory_planner import BatchPlan, peak_rss
+from patient_store import PatientStore, ShardedDataset, is_patient_store, is_sharded_dataset
+from training_metrics import TrainingMetrics
+
+# Theano is imported by load_theano when the first Theano model is built.
+# Importing it sets up its configuration and compilation directory, which
+# --help, argument errors and the numpy backend do not need.
+theano = None
+T = None
+RandomStreams = None
+
+def load_theano():
+    global theano, T, RandomStreams
+    if theano is None:
+        import theano
+        import theano.tensor as T
+        from theano.sandbox.rng_mrg import MRG_RandomStreams as RandomStreams
+
+def floatX():
+    '''
+    Returns the float type of Theano once it is loaded, and float32 for the
+    numpy backend.
+    '''
+    return 'float32' if theano is None else theano.config.floatX
 
 def unzip(zipped):
     new_params = OrderedDict()
@@ -51,10 +88,35 @@ def unzip(zipped):
     return new_params
 
 def numpy_floatX(data):
-    return np.asarray(data, dtype=config.floatX)
-
-def load_embedding(infile):
-    Wemb = np.array(json.load(open(infile, 'r'))).astype(config.floatX)
+    return np.asarray(data, dtype=floatX())
+
+def load_embedding(infile, inputDimSize=None):
+    '''
+    Reads a code embedding matrix (inputDimSize, embSize) from a .npy file,
+    a raw file of float32 values (.bin or .raw, row-major with inputDimSize
+    rows), or a JSON list of rows.  Binary files are memory-mapped read-only
+    and returned without a copy when they already hold floatX values.
+    '''
+    if infile.endswith('.npy'):
+        Wemb = np.load(infile, mmap_mode='r')
+    elif infile.endswith('.bin') or infile.endswith('.raw'):
+        # raw files hold float32 values whatever floatX is, as written by
+        # pretrain_embeddings.py; a file size that is not a whole number of
+        # float32 rows is refused
+        size = os.path.getsize(infile)
+        itemsize = np.dtype(np.float32).itemsize
+        if inputDimSize is None or size % (itemsize * inputDimSize) != 0:
+            raise ValueError(f'{infile} holds {size} bytes, not a whole number of float32 values in {inputDimSize} rows')
+        Wemb = np.memmap(infile, dtype=np.float32, mode='r', shape=(inputDimSize, size // (itemsize * inputDimSize)))
+    else:
+        Wemb = np.array(json.load(open(infile, 'r')))
+
+    if Wemb.ndim != 2 or (inputDimSize is not None and Wemb.shape[0] != inputDimSize):
+        raise ValueError(f'{infile} has shape {Wemb.shape}, expected ({inputDimSize}, embSize)')
+    if not np.issubdtype(Wemb.dtype, np.floating):
+        raise ValueError(f'{infile} holds {Wemb.dtype} values, expected floating point')
+    if Wemb.dtype != floatX():
+        Wemb = Wemb.astype(floatX())
     return Wemb
 
 def init_params(options):
@@ -67,38 +129,46 @@ def init_params(options):
 
     if len(embFile) > 0:
         print('using external code embedding')
-        params['W_emb'] = load_embedding(embFile)
+        params['W_emb'] = load_embedding(embFile, inputDimSize)
+        if params['W_emb'].shape[1] != embSize:
+            print(f'using the embedding size of {embFile}: {params["W_emb"].shape[1]} instead of {embSize}')
         embSize = params['W_emb'].shape[1]
     else:
         print('using randomly initialized code embedding')
-        params['W_emb'] = np.random.uniform(-0.01, 0.01, (inputDimSize, embSize)).astype(config.floatX)
-    params['b_emb'] = np.zeros(embSize).astype(config.floatX)
+        params['W_emb'] = np.random.uniform(-0.01, 0.01, (inputDimSize, embSize)).astype(floatX())
+    params['b_emb'] = np.zeros(embSize).astype(floatX())
 
     prevDimSize = embSize
     if len(timeFileTrain) > 0:
         prevDimSize += 1 #We need to consider an extra dimension for the duration information
     for count, hiddenDimSize in enumerate(options['hiddenDimSize']):
-        params['W_'+str(count)] = np.random.uniform(-0.01, 0.01, (prevDimSize, hiddenDimSize)).astype(config.floatX)
-        params['W_r_'+str(count)] = np.random.uniform(-0.01, 0.01, (prevDimSize, hiddenDimSize)).astype(config.floatX)
-        params['W_z_'+str(count)] = np.random.uniform(-0.01, 0.01, (prevDimSize, hiddenDimSize)).astype(config.floatX)
-        params['U_'+str(count)] = np.random.uniform(-0.01, 0.01, (hiddenDimSize, hiddenDimSize)).astype(config.floatX)
-        params['U_r_'+str(count)] = np.random.uniform(-0.01, 0.01, (hiddenDimSize, hiddenDimSize)).astype(config.floatX)
-        params['U_z_'+str(count)] = np.random.uniform(-0.01, 0.01, (hiddenDimSize, hiddenDimSize)).astype(config.floatX)
-        params['b_'+str(count)] = np.zeros(hiddenDimSize).astype(config.floatX)
-        params['b_r_'+str(count)] = np.zeros(hiddenDimSize).astype(config.floatX)
-        params['b_z_'+str(count)] = np.zeros(hiddenDimSize).astype(config.floatX)
+        params['W_'+str(count)] = np.random.uniform(-0.01, 0.01, (prevDimSize, hiddenDimSize)).astype(floatX())
+        params['W_r_'+str(count)] = np.random.uniform(-0.01, 0.01, (prevDimSize, hiddenDimSize)).astype(floatX())
+        params['W_z_'+str(count)] = np.random.uniform(-0.01, 0.01, (prevDimSize, hiddenDimSize)).astype(floatX())
+        params['U_'+str(count)] = np.random.uniform(-0.01, 0.01, (hiddenDimSize, hiddenDimSize)).astype(floatX())
+        params['U_r_'+str(count)] = np.random.uniform(-0.01, 0.01, (hiddenDimSize, hiddenDimSize)).astype(floatX())
+        params['U_z_'+str(count)] = np.random.uniform(-0.01, 0.01, (hiddenDimSize, hiddenDimSize)).astype(floatX())
+        params['b_'+str(count)] = np.zeros(hiddenDimSize).astype(floatX())
+        params['b_r_'+str(count)] = np.zeros(hiddenDimSize).astype(floatX())
+        params['b_z_'+str(count)] = np.zeros(hiddenDimSize).astype(floatX())
         prevDimSize = hiddenDimSize
 
-    params['W_output'] = np.random.uniform(-0.01, 0.01, (prevDimSize, numClass)).astype(config.floatX)
-    params['b_output'] = np.zeros(numClass).astype(config.floatX)
+    params['W_output'] = np.random.uniform(-0.01, 0.01, (prevDimSize, numClass)).astype(floatX())
+    params['b_output'] = np.zeros(numClass).astype(floatX())
+
+    labelGroups = options.get('labelGroups')
+    if labelGroups is not None:
+        params['W_group'] = np.random.uniform(-0.01, 0.01, (prevDimSize, labelGroups.n_groups)).astype(floatX())
+        params['b_group'] = np.zeros(labelGroups.n_groups).astype(floatX())
 
     if options['predictTime']:
-        params['W_time'] = np.random.uniform(-0.01, 0.01, (prevDimSize, 1)).astype(config.floatX)
-        params['b_time'] = np.zeros(1).astype(config.floatX)
+        params['W_time'] = np.random.uniform(-0.01, 0.01, (prevDimSize, 1)).astype(floatX())
+        params['b_time'] = np.zeros(1).astype(floatX())
 
     return params
 
 def init_tparams(params, options):
+    load_theano()
     tparams = OrderedDict()
     for key, value in params.items():
         if not options['embFineTune'] and key == 'W_emb':
@@ -106,6 +176,96 @@ def init_tparams(params, options):
         tparams[key] = theano.shared(value, name=key)
     return tparams
 
+def codes_file(modelFile):
+    '''
+    Returns the path of the codes file of the run that saved a model file:
+    <outFile>.codes.json for <outFile>.<epoch>.npz.
+    '''
+    if modelFile.endswith('.npz'):
+        modelFile = modelFile[:-len('.npz')]
+    prefix, _, epoch = modelFile.rpartition('.')
+    return (prefix if prefix and epoch.isdigit() else modelFile) + '.codes.json'
+
+def save_codes(outFile, vocabDir):
+    '''
+    Writes the code of every input row and label column of the models of
+    this run, from the vocabulary of process_mimic.py.
+    '''
+    vocab = CodeVocabulary.load(vocabDir)
+    with open(outFile + '.codes.json', 'w', encoding='utf8') as codesFile:
+        json.dump({'visit_codes': vocab.visit_codes.tolist(), 'label_codes': vocab.label_codes.tolist()}, codesFile)
+
+def check_codes(initModel, vocabDir, grown):
+    '''
+    Checks that the input and label ids of a model file mean the same codes
+    in the vocabulary of the training data, which may only have appended
+    new codes.  Without the codes of both, a grown vocabulary is refused.
+    '''
+    savedFile = codes_file(initModel)
+    if not vocabDir or not os.path.exists(savedFile):
+        if grown:
+            raise ValueError(f'the input or label codes have grown since {initModel}, but their ids cannot be checked: '
+                             f'pass --vocab_dir, and continue from a model trained with --vocab_dir ({savedFile})')
+        print(f'the codes of {initModel} are not checked against the training data, pass --vocab_dir to check them')
+        return
+    with open(savedFile, 'r') as codesFile:
+        saved = json.load(codesFile)
+    vocab = CodeVocabulary.load(vocabDir)
+    for name in ('visit_codes', 'label_codes'):
+        current = getattr(vocab, name).tolist()
+        changed = [i for i, code in enumerate(saved[name]) if i >= len(current) or current[i] != code]
+        if changed:
+            raise ValueError(f'{len(changed)} {name} ids of {initModel} mean different codes in {vocabDir}, '
+                             f'the first is id {changed[0]}: process the new data with '
+                             f'process_mimic.py --previous_dir to keep the earlier ids')
+
+def load_checkpoint_params(params, initModel, vocabDir=''):
+    '''
+    Replaces the initial values of params with those of a model file from
+    doctor_ai.py.  If the vocabulary has grown since, W_emb keeps the random
+    rows of the new input codes after the rows of the model, and W_output
+    and b_output the random columns of the new labels; the codes of the rows
+    and columns are checked first (check_codes).
+    '''
+    # the axis of the parameters that follows the input or label codes
+    codeAxes = {'W_emb': 0, 'W_output': 1, 'b_output': 0}
+    with np.load(initModel) as model:
+        grown = any(key in model.files and model[key].shape[axis] < params[key].shape[axis]\
+            for key, axis in codeAxes.items())
+        check_codes(initModel, vocabDir, grown)
+        for key, value in params.items():
+            if key not in model.files:
+                print(f'{key} is not in {initModel}, keeping its initial value')
+                continue
+            saved = model[key].astype(floatX())
+            axis = codeAxes.get(key)
+            if axis is not None and saved.shape[axis] < value.shape[axis]\
+                and np.delete(saved.shape, axis).tolist() == np.delete(value.shape, axis).tolist():
+                print(f'appending {value.shape[axis] - saved.shape[axis]} new codes to {key}')
+                params[key] = np.concatenate([saved, np.take(value, range(saved.shape[axis], value.shape[axis]), axis=axis)], axis=axis)
+            elif saved.shape != value.shape:
+                raise ValueError(f'{key} has shape {saved.shape} in {initModel}, the model needs {value.shape}')
+            else:
+                params[key] = saved
+    return params
+
+def optimizer_state_file(modelFile):
+    if modelFile.endswith('.npz'):
+        modelFile = modelFile[:-len('.npz')]
+    return modelFile + '.adadelta.npz'
+
+def load_optimizer_state(optimizerState, stateFile):
+    '''
+    Sets the adadelta accumulators from a file saved next to a model.  The
+    accumulators of the rows and columns of new codes start at zero.
+    '''
+    with np.load(stateFile) as state:
+        for key, shared in optimizerState.items():
+            value = shared.get_value()
+            saved = state[key].astype(floatX())
+            value[tuple(slice(0, size) for size in saved.shape)] = saved
+            shared.set_value(value)
+
 def dropout_layer(state_before, use_noise, trng, dropout_rate):
     proj = T.switch(\
         use_noise,
@@ -113,7 +273,8 @@ def dropout_layer(state_before, use_noise, trng, dropout_rate):
         state_before * 0.5)
     return proj
 
-def gru_layer(tparams, emb, layerIndex, hiddenDimSize, mask=None):
+def gru_layer(tparams, emb, layerIndex, hiddenDimSize, mask=None, h0=None):
+    load_theano()
     timesteps = emb.shape[0]
     if emb.ndim == 3:
         n_samples = emb.shape[1]
@@ -132,16 +293,40 @@ def gru_layer(tparams, emb, layerIndex, hiddenDimSize, mask=None):
         h_new = stepMask[:, None] * h_new + (1. - stepMask)[:, None] * h
         return h_new
 
+    if h0 is None:
+        h0 = T.alloc(numpy_floatX(0.0), n_samples, hiddenDimSize)
     results, updates = theano.scan(\
         fn=stepFn,
         sequences=[mask, W_rx, W_zx, Wx],
-        outputs_info=T.alloc(numpy_floatX(0.0), n_samples, hiddenDimSize),
+        outputs_info=h0,
         name='gru_layer'+layerIndex,
         n_steps=timesteps)
 
     return results
 
-def build_model(tparams, options, W_emb=None):
+def init_hidden_states(options, n_samples=1):
+    '''
+    Returns the shared initial hidden state of every GRU layer, used to carry
+    the hidden state from one truncated-BPTT window to the next.
+    '''
+    load_theano()
+    return [theano.shared(np.zeros((n_samples, hiddenDimSize), dtype=floatX()), name='h0_'+str(i))\
+        for i, hiddenDimSize in enumerate(options['hiddenDimSize'])]
+
+def reset_hidden_states(hiddenStates, n_samples):
+    for h0 in hiddenStates:
+        h0.set_value(np.zeros((n_samples, h0.get_value(borrow=True).shape[1]), dtype=floatX()))
+
+def build_model(tparams, options, W_emb=None, hiddenStates=None):
+    '''
+    With hiddenStates from init_hidden_states, the GRU layers start from
+    those states instead of zeros, and the (state, last hidden state) pairs
+    are left in options['hiddenUpdates'] for f_grad_shared to carry the
+    state into the next window.  No gradient flows into the states.  The
+    L2 terms are then weighted by the shared options['regWeight'], so a
+    batch split into n windows can apply them 1/n per window.
+    '''
+    load_theano()
     trng = RandomStreams(123)
     use_noise = theano.shared(numpy_floatX(0.))
     if len(options['timeFileTrain']) > 0:
@@ -149,12 +334,12 @@ def build_model(tparams, options, W_emb=None):
     else:
         useTime = False
 
-    x = T.tensor3('x', dtype=config.floatX)
-    t = T.matrix('t', dtype=config.floatX)
-    y = T.tensor3('y', dtype=config.floatX)
-    t_label = T.matrix('t_label', dtype=config.floatX)
-    mask = T.matrix('mask', dtype=config.floatX)
-    lengths = T.vector('lengths', dtype=config.floatX)
+    x = T.tensor3('x', dtype=floatX())
+    t = T.matrix('t', dtype=floatX())
+    y = T.tensor3('y', dtype=floatX())
+    t_label = T.matrix('t_label', dtype=floatX())
+    mask = T.matrix('mask', dtype=floatX())
+    lengths = T.vector('lengths', dtype=floatX())
 
     n_timesteps = x.shape[0]
     n_samples = x.shape[1]
@@ -167,8 +352,12 @@ def build_model(tparams, options, W_emb=None):
         emb = T.concatenate([t.reshape([n_timesteps, n_samples, 1]), emb], axis=2) #Adding the time element to the embedding
 
     inputVector = emb
+    hiddenUpdates = []
     for i, hiddenDimSize in enumerate(options['hiddenDimSize']):
-        memories = gru_layer(tparams, inputVector, str(i), hiddenDimSize, mask=mask)
+        h0 = None if hiddenStates is None else hiddenStates[i]
+        memories = gru_layer(tparams, inputVector, str(i), hiddenDimSize, mask=mask, h0=h0)
+        if h0 is not None:
+            hiddenUpdates.append((h0, memories[-1]))
         memories = dropout_layer(memories, use_noise, trng, options['dropout_rate'])
         inputVector = memories
 
@@ -176,18 +365,69 @@ def build_model(tparams, options, W_emb=None):
         return T.nnet.softmax(T.dot(memory2d, tparams['W_output']) + tparams['b_output'])
 
     logEps = options['logEps']
-    results, updates = theano.scan(fn=softmaxStep, sequences=[inputVector], outputs_info=None, name='softmax_layer', n_steps=n_timesteps)
-    results = results * mask[:, :, None]
-    cross_entropy = -(y * T.log(results + logEps) + (1. - y) * T.log(1. - results + logEps))
-    prediction_loss = cross_entropy.sum(axis=2).sum(axis=0) / lengths
+    options['extraInputs'] = []
+    L2_output = (tparams['W_output'] ** 2).sum()
+    if options.get('labelGroups') is not None:
+        # two-level output layer (see label_groups.py): y holds the targets of
+        # the groups, and the softmax within a group is only computed at the
+        # visits where the group is a target, one entry per label of the group
+        from theano.sparse import CSR, csm_data, sampling_dot
+        pairRow = T.ivector('pairRow')
+        pairEntries = T.imatrix('pairEntries')
+        entryPair = T.ivector('entryPair')
+        entryLabel = T.ivector('entryLabel')
+        rowEntries = T.ivector('rowEntries')
+        entryY = T.vector('entryY', dtype=floatX())
+        options['extraInputs'] = [pairRow, pairEntries, entryPair, entryLabel, rowEntries, entryY]
+
+        def groupSoftmaxStep(memory2d):
+            return T.nnet.softmax(T.dot(memory2d, tparams['W_group']) + tparams['b_group'])
+
+        groupResults, updates = theano.scan(fn=groupSoftmaxStep, sequences=[inputVector], outputs_info=None, name='group_softmax_layer', n_steps=n_timesteps)
+        groupResults = groupResults * mask[:, :, None]
+        group_entropy = -(y * T.log(groupResults + logEps) + (1. - y) * T.log(1. - groupResults + logEps))
+
+        # the logits of the entries only: the entries are the nonzeros of a
+        # sparse (rows, labels) matrix, whose products of the hidden states
+        # and output weights sampling_dot computes in the order of the entries
+        hidden = inputVector.reshape([n_timesteps * n_samples, inputVector.shape[2]])
+        entries = CSR(T.ones_like(entryY), entryLabel, rowEntries,\
+            T.cast(T.stack([hidden.shape[0], tparams['W_output'].shape[1]]), 'int32'))
+        logits = csm_data(sampling_dot(hidden, tparams['W_output'].T, entries)) + tparams['b_output'][entryLabel]
+        # the max and sum of every pair are taken over its row of
+        # pairEntries, whose padding points past the logits at a value that
+        # adds nothing.  The largest logit of every pair is subtracted within
+        # the pair: with a larger shift every exp of the pair can underflow
+        # to 0 and its softmax be 0/0.  The shift does not change the
+        # softmax, so no gradient flows through it
+        padded = T.concatenate([logits, T.constant(np.array([-1e30], dtype=floatX()))])[pairEntries]
+        pairMax = theano.gradient.disconnected_grad(padded.max(axis=1))
+        pairSums = T.exp(padded - pairMax[:, None]).sum(axis=1)
+        results = T.exp(logits - pairMax[entryPair]) / pairSums[entryPair]
+        cross_entropy = -(entryY * T.log(results + logEps) + (1. - entryY) * T.log(1. - results + logEps))
+        # the rows of a patient are patient, patient + n_samples, ...
+        patient_entropy = T.inc_subtensor(T.zeros_like(lengths)[pairRow[entryPair] % n_samples], cross_entropy)
+        prediction_loss = (group_entropy.sum(axis=2).sum(axis=0) + patient_entropy) / lengths
+        L2_output += (tparams['W_group'] ** 2).sum()
+    else:
+        results, updates = theano.scan(fn=softmaxStep, sequences=[inputVector], outputs_info=None, name='softmax_layer', n_steps=n_timesteps)
+        results = results * mask[:, :, None]
+        cross_entropy = -(y * T.log(results + logEps) + (1. - y) * T.log(1. - results + logEps))
+        prediction_loss = cross_entropy.sum(axis=2).sum(axis=0) / lengths
 
+    regWeight = None if hiddenStates is None else theano.shared(numpy_floatX(1.), name='reg_weight')
     if options['predictTime']:
         duration = T.maximum(T.dot(inputVector, tparams['W_time']) + tparams['b_time'], 0) #ReLU
         duration = duration.reshape([n_timesteps, n_samples]) * mask
         duration_loss = 0.5 * ((duration - t_label) ** 2).sum(axis=0) / lengths
-        cost = T.mean(prediction_loss) + options['tradeoff'] * T.mean(duration_loss) + options['L2_output'] * (tparams['W_output'] ** 2).sum() + options['L2_time'] * (tparams['W_time'] ** 2).sum()
+        L2 = options['L2_output'] * L2_output + options['L2_time'] * (tparams['W_time'] ** 2).sum()
+        cost = T.mean(prediction_loss) + options['tradeoff'] * T.mean(duration_loss)
     else:
-        cost = T.mean(prediction_loss) + options['L2_output'] * (tparams['W_output'] ** 2).sum()
+        L2 = options['L2_output'] * L2_output
+        cost = T.mean(prediction_loss)
+    cost += L2 if regWeight is None else regWeight * L2
+    options['hiddenUpdates'] = hiddenUpdates
+    options['regWeight'] = regWeight
 
     if options['predictTime']:
         return use_noise, x, y, t, t_label, mask, lengths, cost
@@ -203,13 +443,18 @@ def adadelta(tparams, grads, x, y, mask, lengths, cost, options, t=None, t_label
 
     zgup = list(zip(zipped_grads, grads))
     rg2up = [(rg2, 0.95 * rg2 + 0.05 * (g ** 2)) for (rg2, g) in zip(running_grads2, grads)]
+    stateUp = options.get('hiddenUpdates', [])
+    extraInputs = options.get('extraInputs', [])
+    # saved with every checkpoint, to resume training with the same step sizes
+    options['optimizerState'] = OrderedDict(\
+        [(rup2.name, rup2) for rup2 in running_up2] + [(rgrad2.name, rgrad2) for rgrad2 in running_grads2])
 
     if options['predictTime']:
-        f_grad_shared = theano.function([x, y, t, t_label, mask, lengths], cost, updates=zgup + rg2up, name='adadelta_f_grad_shared')
+        f_grad_shared = theano.function([x, y, t, t_label, mask, lengths] + extraInputs, cost, updates=zgup + rg2up + stateUp, name='adadelta_f_grad_shared')
     elif len(options['timeFileTrain']) > 0:
-        f_grad_shared = theano.function([x, y, t, mask, lengths], cost, updates=zgup + rg2up, name='adadelta_f_grad_shared')
+        f_grad_shared = theano.function([x, y, t, mask, lengths] + extraInputs, cost, updates=zgup + rg2up + stateUp, name='adadelta_f_grad_shared')
     else:
-        f_grad_shared = theano.function([x, y, mask, lengths], cost, updates=zgup + rg2up, name='adadelta_f_grad_shared')
+        f_grad_shared = theano.function([x, y, mask, lengths] + extraInputs, cost, updates=zgup + rg2up + stateUp, name='adadelta_f_grad_shared')
 
     updir = [-T.sqrt(ru2 + 1e-6) / T.sqrt(rg2 + 1e-6) * zg for (zg, ru2, rg2) in zip(zipped_grads, running_up2, running_grads2)]
     ru2up = [(ru2, 0.95 * ru2 + 0.05 * (ud ** 2)) for (ru2, ud) in zip(running_up2, updir)]
@@ -223,23 +468,26 @@ def padMatrixWithTimePrediction(seqs, labels, times, options):
     n_samples = len(seqs)
     maxlen = np.max(lengths)
     inputDimSize = options['inputDimSize']
-    numClass = options['numClass']
-
-    x = np.zeros((maxlen, n_samples, inputDimSize)).astype(config.floatX)
-    y = np.zeros((maxlen, n_samples, numClass)).astype(config.floatX)
-    t = np.zeros((maxlen, n_samples)).astype(config.floatX)
-    t_label = np.zeros((maxlen, n_samples)).astype(config.floatX)
-    mask = np.zeros((maxlen, n_samples)).astype(config.floatX)
+    # the two-level output layer (label_groups.py) takes the groups of the
+    # labels as y, the labels themselves go into group_inputs
+    labelGroups = options.get('labelGroups')
+    numClass = options['numClass'] if labelGroups is None else labelGroups.n_groups
+
+    x = np.zeros((maxlen, n_samples, inputDimSize)).astype(floatX())
+    y = np.zeros((maxlen, n_samples, numClass)).astype(floatX())
+    t = np.zeros((maxlen, n_samples)).astype(floatX())
+    t_label = np.zeros((maxlen, n_samples)).astype(floatX())
+    mask = np.zeros((maxlen, n_samples)).astype(floatX())
     for idx, (seq, time, label) in enumerate(zip(seqs, times, labels)):
         for xvec, subseq in zip(x[:, idx, :], seq[:-1]):
             xvec[subseq] = 1.
         for yvec, subseq in zip(y[:, idx, :], label[1:]):
-            yvec[subseq] = 1.
+            yvec[subseq if labelGroups is None else labelGroups.groups[subseq]] = 1.
         mask[:lengths[idx], idx] = 1.
         t[:lengths[idx], idx] = time[:-1]
         t_label[:lengths[idx], idx] = time[1:]
 
-    lengths = np.array(lengths, dtype=config.floatX)
+    lengths = np.array(lengths, dtype=floatX())
     if options['useLogTime']:
         t = np.log(t + options['logEps'])
         t_label = np.log(t_label + options['logEps'])
@@ -251,21 +499,24 @@ def padMatrixWithTime(seqs, labels, times, options):
     n_samples = len(seqs)
     maxlen = np.max(lengths)
     inputDimSize = options['inputDimSize']
-    numClass = options['numClass']
-
-    x = np.zeros((maxlen, n_samples, inputDimSize)).astype(config.floatX)
-    y = np.zeros((maxlen, n_samples, numClass)).astype(config.floatX)
-    t = np.zeros((maxlen, n_samples)).astype(config.floatX)
-    mask = np.zeros((maxlen, n_samples)).astype(config.floatX)
+    # the two-level output layer (label_groups.py) takes the groups of the
+    # labels as y, the labels themselves go into group_inputs
+    labelGroups = options.get('labelGroups')
+    numClass = options['numClass'] if labelGroups is None else labelGroups.n_groups
+
+    x = np.zeros((maxlen, n_samples, inputDimSize)).astype(floatX())
+    y = np.zeros((maxlen, n_samples, numClass)).astype(floatX())
+    t = np.zeros((maxlen, n_samples)).astype(floatX())
+    mask = np.zeros((maxlen, n_samples)).astype(floatX())
     for idx, (seq, time, label) in enumerate(zip(seqs, times, labels)):
         for xvec, subseq in zip(x[:, idx, :], seq[:-1]):
             xvec[subseq] = 1.
         for yvec, subseq in zip(y[:, idx, :], label[1:]):
-            yvec[subseq] = 1.
+            yvec[subseq if labelGroups is None else labelGroups.groups[subseq]] = 1.
         mask[:lengths[idx], idx] = 1.
         t[:lengths[idx], idx] = time[:-1]
 
-    lengths = np.array(lengths, dtype=config.floatX)
+    lengths = np.array(lengths, dtype=floatX())
     if options['useLogTime']:
         t = np.log(t + options['logEps'])
 
@@ -276,19 +527,22 @@ def padMatrixWithoutTime(seqs, labels, options):
     n_samples = len(seqs)
     maxlen = np.max(lengths)
     inputDimSize = options['inputDimSize']
-    numClass = options['numClass']
-
-    x = np.zeros((maxlen, n_samples, inputDimSize)).astype(config.floatX)
-    y = np.zeros((maxlen, n_samples, numClass)).astype(config.floatX)
-    mask = np.zeros((maxlen, n_samples)).astype(config.floatX)
+    # the two-level output layer (label_groups.py) takes the groups of the
+    # labels as y, the labels themselves go into group_inputs
+    labelGroups = options.get('labelGroups')
+    numClass = options['numClass'] if labelGroups is None else labelGroups.n_groups
+
+    x = np.zeros((maxlen, n_samples, inputDimSize)).astype(floatX())
+    y = np.zeros((maxlen, n_samples, numClass)).astype(floatX())
+    mask = np.zeros((maxlen, n_samples)).astype(floatX())
     for idx, (seq, label) in enumerate(zip(seqs, labels)):
         for xvec, subseq in zip(x[:, idx, :], seq[:-1]):
             xvec[subseq] = 1.
         for yvec, subseq in zip(y[:, idx, :], label[1:]):
-            yvec[subseq] = 1.
+            yvec[subseq if labelGroups is None else labelGroups.groups[subseq]] = 1.
         mask[:lengths[idx], idx] = 1.
 
-    lengths = np.array(lengths, dtype=config.floatX)
+    lengths = np.array(lengths, dtype=floatX())
 
     return x, y, mask, lengths
 
@@ -335,32 +589,255 @@ def load_data(seqFileTrain, seqFileTest, seqFileValid, labelFileTrain,\
 
     return train_set, valid_set, test_set
 
-def calculate_auc(test_model, dataset, options):
+def load_sharded_data(seqFileTrain, seqFileTest, seqFileValid):
+    return ShardedDataset(seqFileTrain), ShardedDataset(seqFileValid), ShardedDataset(seqFileTest)
+
+def load_store_data(seqFileTrain, seqFileTest, seqFileValid):
+    return PatientStore(seqFileTrain), PatientStore(seqFileValid), PatientStore(seqFileTest)
+
+def dataset_size(dataset):
+    if isinstance(dataset, (ShardedDataset, PatientStore)):
+        return len(dataset)
+    return len(dataset[0])
+
+def dataset_lengths(dataset, maxHistory=0):
+    if isinstance(dataset, ShardedDataset):
+        lengths = dataset.visit_counts()
+    elif isinstance(dataset, PatientStore):
+        lengths = np.diff(dataset.patient_offsets)
+    else:
+        lengths = [len(seq) for seq in dataset[0]]
+    if maxHistory > 0:
+        lengths = [min(length, maxHistory + 1) for length in lengths]
+    return lengths
+
+def truncate_history(seqs, maxHistory):
+    '''
+    Keeps the visits of every patient from which the last maxHistory visits
+    are predicted.
+    '''
+    if seqs is None or maxHistory <= 0:
+        return seqs
+    return [seq[-(maxHistory + 1):] for seq in seqs]
+
+def iter_batches(dataset, options, shuffle=False, plan=None):
     batchSize = options['batchSize']
+    maxHistory = options['maxHistory']
+    if isinstance(dataset, ShardedDataset):
+        for batchX, batchY in dataset.iter_batches(batchSize, shuffle, options['shuffleBufferSize'], plan=plan):
+            yield truncate_history(batchX, maxHistory), truncate_history(batchY, maxHistory), None
+        return
+
+    if isinstance(dataset, PatientStore):
+        # the store is memory-mapped, patients are read batch by batch in
+        # length order as load_data sorts them
+        lengths = np.asarray(dataset_lengths(dataset, maxHistory))
+        order = np.argsort(lengths, kind='stable')
+        lengths = lengths[order]
+    else:
+        lengths = dataset_lengths(dataset, maxHistory)
+    if plan is None:
+        n_batches = int(np.ceil(float(len(lengths)) / float(batchSize)))
+        bounds = [(index*batchSize, (index+1)*batchSize) for index in range(n_batches)]
+    else:
+        bounds = plan.bounds(lengths)
+    if shuffle:
+        bounds = random.sample(bounds, len(bounds))
+    for start, stop in bounds:
+        if isinstance(dataset, PatientStore):
+            batchX, batchY, _ = dataset.patients(order[start:stop])
+            yield truncate_history(batchX, maxHistory), truncate_history(batchY, maxHistory), None
+            continue
+        batchX = dataset[0][start:stop]
+        batchY = dataset[1][start:stop]
+        batchT = None
+        if dataset[2] is not None:
+            batchT = dataset[2][start:stop]
+        yield truncate_history(batchX, maxHistory), truncate_history(batchY, maxHistory),\
+            truncate_history(batchT, maxHistory)
+
+def group_inputs(labels, options, start=0, stop=None):
+    '''
+    Returns the extra inputs of the two-level output layer for the predicted
+    visits start..stop of a batch with these label lists (empty without).
+    '''
+    labelGroups = options.get('labelGroups')
+    if labelGroups is None:
+        return []
+    *indices, entryY = labelGroups.batch_inputs(labels, start, stop)
+    return indices + [entryY.astype(floatX())]
+
+def calculate_auc(test_model, dataset, options, plan=None, hiddenStates=None):
     useTime = options['useTime']
     predictTime = options['predictTime']
 
-    n_batches = int(np.ceil(float(len(dataset[0])) / float(batchSize)))
     aucSum = 0.0
     dataCount = 0.0
-    for index in range(n_batches):
-        batchX = dataset[0][index*batchSize:(index+1)*batchSize]
-        batchY = dataset[1][index*batchSize:(index+1)*batchSize]
+    for batchX, batchY, batchT in iter_batches(dataset, options, plan=plan):
+        if hiddenStates is not None:
+            reset_hidden_states(hiddenStates, len(batchX))
         if predictTime:
-            batchT = dataset[2][index*batchSize:(index+1)*batchSize]
-            x, y, t, t_label, mask, lengths = padMatrixWithTimePrediction(batchX, batchY, batchT, options)
-            auc = test_model(x, y, t, t_label, mask, lengths)
+            inputs = padMatrixWithTimePrediction(batchX, batchY, batchT, options)
         elif useTime:
-            batchT = dataset[2][index*batchSize:(index+1)*batchSize]
-            x, y, t, mask, lengths = padMatrixWithTime(batchX, batchY, batchT, options)
-            auc = test_model(x, y, t, mask, lengths)
+            inputs = padMatrixWithTime(batchX, batchY, batchT, options)
         else:
-            x, y, mask, lengths = padMatrixWithoutTime(batchX, batchY, options)
-            auc = test_model(x, y, mask, lengths)
+            inputs = padMatrixWithoutTime(batchX, batchY, options)
+        auc = test_model(*inputs, *group_inputs(batchY, options))
         aucSum += auc * len(batchX)
         dataCount += float(len(batchX))
     return aucSum / dataCount
 
+def subsample_dataset(dataset, n_patients, seed=1234):
+    '''
+    Returns a fixed random subset of n_patients of a dataset as a
+    length-sorted (x, y, t) tuple.
+    '''
+    rng = random.Random(seed)
+    if isinstance(dataset, ShardedDataset):
+        patients = list(itertools.islice(dataset.iter_patients(shuffle=True, rng=rng), n_patients))
+        x = [patient[0] for patient in patients]
+        y = [patient[1] for patient in patients]
+        t = None
+    elif isinstance(dataset, PatientStore):
+        indices = sorted(rng.sample(range(len(dataset)), min(n_patients, len(dataset))))
+        x, y, _ = dataset.patients(indices)
+        t = None
+    else:
+        indices = sorted(rng.sample(range(len(dataset[0])), min(n_patients, len(dataset[0]))))
+        x = [dataset[0][i] for i in indices]
+        y = [dataset[1][i] for i in indices]
+        t = None if dataset[2] is None else [dataset[2][i] for i in indices]
+    order = sorted(range(len(x)), key=lambda i: len(x[i]))
+    return [x[i] for i in order], [y[i] for i in order], None if t is None else [t[i] for i in order]
+
+def save_checkpoint(params, options, outFile, epoch, optimizerState=None):
+    tempParams = dict(params)
+    if options['labelGroups'] is not None:
+        tempParams['label_groups'] = options['labelGroups'].groups
+    np.savez_compressed(outFile + '.' + str(epoch), **tempParams)
+    if optimizerState is not None:
+        np.savez_compressed(optimizer_state_file(outFile + '.' + str(epoch)), **optimizerState)
+
+def select_changed_patients(store, changedSince):
+    '''
+    Returns the patients of a patient store with a visit on or after
+    changedSince as a length-sorted (x, y, t) tuple.
+    '''
+    since = np.datetime64(changedSince, 's')
+    dates = np.asarray(store.dates)
+    patientOfVisit = np.repeat(np.arange(len(store)), np.diff(store.patient_offsets))
+    changed = np.bincount(patientOfVisit[dates >= since], minlength=len(store)) > 0
+    x, y, _ = store.patients(np.nonzero(changed)[0])
+    order = sorted(range(len(x)), key=lambda i: len(x[i]))
+    return [x[i] for i in order], [y[i] for i in order], None
+
+def validation_worker(conn, params, options, validSet, testSet, validSample, plan):
+    '''
+    Runs in the validation process: compiles its own test model, then
+    evaluates the parameter snapshots it receives until it receives None.
+    The test set is evaluated whenever the validation cross entropy
+    improves, in the order the snapshots were sent, so the same epochs are
+    tested as in the synchronous loop.
+    '''
+    options = dict(options)
+    hiddenStates = None
+    if options['backend'] == 'numpy':
+        import numpy_trainer
+        tparams = numpy_trainer.init_shared_params(params, options)
+        W_emb = None if options['embFineTune'] else params['W_emb']
+        test_model = numpy_trainer.build_test_model(tparams, options, W_emb)
+    else:
+        tparams = init_tparams(params, options)
+        W_emb = None if options['embFineTune'] else theano.shared(params['W_emb'], name='W_emb', borrow=True)
+        hiddenStates = init_hidden_states(options) if options['bpttWindow'] > 0 else None
+        outputs = build_model(tparams, options, W_emb, hiddenStates)
+        test_model = theano.function(inputs=list(outputs[1:-1]) + options['extraInputs'], outputs=outputs[-1], name='test_model')
+
+    bestValidCrossEntropy = 1e20
+    while True:
+        request = conn.recv()
+        if request is None:
+            break
+        kind, epoch, iteration, snapshot = request
+        for key, value in snapshot.items():
+            tparams[key].set_value(value, borrow=True)
+        start = time.perf_counter()
+        result = {'kind': kind, 'epoch': epoch, 'iteration': iteration, 'test': None}
+        if kind == 'sample':
+            result['valid'] = calculate_auc(test_model, validSample, options, plan, hiddenStates)
+        else:
+            result['valid'] = calculate_auc(test_model, validSet, options, plan, hiddenStates)
+        result['valid_s'] = time.perf_counter() - start
+        if kind == 'valid' and result['valid'] < bestValidCrossEntropy:
+            bestValidCrossEntropy = result['valid']
+            if not options['testFinalOnly']:
+                start = time.perf_counter()
+                result['test'] = calculate_auc(test_model, testSet, options, plan, hiddenStates)
+                result['test_s'] = time.perf_counter() - start
+        conn.send(result)
+    conn.close()
+
+class ValidationWorker:
+    '''
+    Evaluates snapshots of the parameters in a separate process while
+    training goes on.  Snapshots waiting for their results are kept until
+    the results are received, so the parameters of an improved epoch can be
+    saved then.  At most maxPending snapshots are outstanding; submitting
+    another waits for the oldest result.
+    '''
+
+    def __init__(self, params, options, validSet, testSet, validSample=None, plan=None, maxPending=2):
+        # the process inherits the datasets and the options when it is forked
+        context = multiprocessing.get_context('fork')
+        self.conn, childConn = context.Pipe()
+        self.process = context.Process(target=validation_worker,\
+            args=(childConn, params, options, validSet, testSet, validSample, plan), daemon=True)
+        self.process.start()
+        childConn.close()
+        self.pending = OrderedDict()
+        self.maxPending = maxPending
+
+    def busy(self):
+        return len(self.pending) >= self.maxPending
+
+    def submit(self, kind, epoch, iteration, snapshot, state=None):
+        '''
+        Sends a snapshot for evaluation and returns the results received
+        while waiting for room.  state (e.g. the optimizer state) stays in
+        this process and is returned with the result.
+        '''
+        results = []
+        while self.busy():
+            results.append(self._receive())
+        self.conn.send((kind, epoch, iteration, snapshot))
+        self.pending[(kind, epoch, iteration)] = (snapshot, state)
+        return results
+
+    def poll(self):
+        '''
+        Returns the results that are ready, without waiting.
+        '''
+        results = []
+        while self.pending and self.conn.poll():
+            results.append(self._receive())
+        return results
+
+    def drain(self):
+        results = []
+        while self.pending:
+            results.append(self._receive())
+        return results
+
+    def close(self):
+        self.conn.send(None)
+        self.process.join()
+        self.conn.close()
+
+    def _receive(self):
+        result = self.conn.recv()
+        result['params'], result['state'] = self.pending.pop((result['kind'], result['epoch'], result['iteration']))
+        return result
+
 def train_doctorAI(\
         seqFileTrain='seqFileTrain.json', seqFileTest='seqFileTest.json',\
         seqFileValid='seqFileValid.json', inputDimSize=20000, labelFileTrain='labelFileTrain.json',\
@@ -370,130 +847,350 @@ def train_doctorAI(\
         predictTime=False, tradeoff=1.0, useLogTime=True, embFile='embFile.txt',\
         embSize=200, embFineTune=True, hiddenDimSize=[200, 200], batchSize=100,\
         max_epochs=10, L2_output=0.001, L2_time=0.001, dropout_rate=0.5,\
-        logEps=1e-8, verbose=False):
+        logEps=1e-8, shuffleBufferSize=10000, metricsFile='', metricsInterval=0,\
+        memoryBudget=0, bpttWindow=0, maxHistory=0, labelGroupsDir='', asyncValidation=False,\
+        validSampleSize=0, validSampleInterval=0, patience=0, minDelta=0.0, testFinalOnly=False,\
+        timeBudget=0, initModel='', changedSince='', maxSteps=0, vocabDir='', backend='theano',\
+        epochCallback=None, verbose=False):
+    '''
+    Trains the model and returns the best validation cross entropy, its
+    epoch and the test cross entropy at that epoch.  epochCallback, if set,
+    is called with the epoch and its validation cross entropy after every
+    epoch, and stops training by returning True.
+
+    With asyncValidation, every epoch is validated on a snapshot of the
+    parameters in a ValidationWorker while the next epoch trains; the best
+    model is tracked and saved when its result comes back.  With
+    validSampleSize and validSampleInterval, the worker also validates on a
+    fixed subsample of validSampleSize patients every validSampleInterval
+    mini-batches.
+
+    Training stops early when the validation cross entropy has not improved
+    by more than minDelta for patience epochs, or when the next epoch would
+    end after timeBudget seconds of training.  The best model is selected
+    as without early stopping among the epochs that were trained.  With
+    testFinalOnly the test set is evaluated once, on the best parameters,
+    instead of at every improvement.
+
+    With initModel, training continues from a model file and the optimizer
+    state saved next to it, for example on a delta dataset of new visits or,
+    with changedSince, on the patients of a patient store with a visit on or
+    after that date.  maxSteps bounds the number of mini-batch updates.
+    With vocabDir, the codes of the input rows and label columns are saved
+    as <outFile>.codes.json, and those of initModel are checked against it.
+
+    With backend='numpy' the model is trained by numpy_trainer.py instead
+    of a compiled Theano graph, in float32, and Theano is not imported.
+    '''
     options = locals().copy()
 
+    options['labelGroups'] = None
+    if len(labelGroupsDir) > 0:
+        labelGroups = LabelGroups.from_vocabulary(labelGroupsDir)
+        if labelGroups.n_labels != numClass:
+            print(f'The vocabulary in {labelGroupsDir} has {labelGroups.n_labels} codes, the labels {numClass}')
+            sys.exit()
+        print(f'two-level output layer over {labelGroups.n_groups} label groups')
+        options['labelGroups'] = labelGroups
+
+    if len(vocabDir) > 0:
+        vocab = CodeVocabulary.load(vocabDir)
+        if vocab.n_visit_codes != inputDimSize:
+            print(f'The vocabulary in {vocabDir} has {vocab.n_visit_codes} visit codes, the inputs {inputDimSize}')
+            sys.exit()
+
     if len(timeFileTrain) > 0:
         useTime = True
     else:
         useTime = False
     options['useTime'] = useTime
 
+    if backend != 'numpy':
+        # before the parameters are made, in Theano's float type
+        load_theano()
+
     print('Initializing the parameters ... ',)
     params = init_params(options)
-    tparams = init_tparams(params, options)
+    if len(initModel) > 0:
+        print(f'continuing from {initModel}')
+        params = load_checkpoint_params(params, initModel, vocabDir)
+    if len(vocabDir) > 0:
+        # after the codes of initModel were checked, which may be of this run
+        save_codes(outFile, vocabDir)
+    if backend == 'numpy':
+        # imported here as it loads scipy.sparse, which the theano backend
+        # and --help do not need
+        import numpy_trainer
+        tparams = numpy_trainer.init_shared_params(params, options)
+    else:
+        tparams = init_tparams(params, options)
 
     print('Building the model ... ',)
+    hiddenStates = init_hidden_states(options) if bpttWindow > 0 else None
     f_grad_shared = None
     f_update = None
-    if predictTime and embFineTune:
+    if backend == 'numpy':
+        print('training with the numpy backend')
+        W_emb = None if embFineTune else params['W_emb']
+        use_noise, f_grad_shared, f_update = numpy_trainer.build_functions(tparams, options, W_emb)
+    elif predictTime and embFineTune:
         print('predicting duration, fine-tuning code representations')
-        use_noise, x, y, t, t_label, mask, lengths, cost = build_model(tparams, options)
+        use_noise, x, y, t, t_label, mask, lengths, cost = build_model(tparams, options, hiddenStates=hiddenStates)
         grads = T.grad(cost, wrt=list(tparams.values()))
         f_grad_shared, f_update = adadelta(tparams, grads, x, y, mask, lengths, cost, options, t, t_label)
     elif predictTime and not embFineTune:
         print('predicting duration, not fine-tuning code representations')
-        W_emb = theano.shared(params['W_emb'], name='W_emb')
-        use_noise, x, y, t, t_label, mask, lengths, cost = build_model(tparams, options, W_emb)
+        W_emb = theano.shared(params['W_emb'], name='W_emb', borrow=True)
+        use_noise, x, y, t, t_label, mask, lengths, cost = build_model(tparams, options, W_emb, hiddenStates)
         grads = T.grad(cost, wrt=list(tparams.values()))
         f_grad_shared, f_update = adadelta(tparams, grads, x, y, mask, lengths, cost, options, t, t_label)
     elif useTime and embFineTune:
         print('using duration information, fine-tuning code representations')
-        use_noise, x, y, t, mask, lengths, cost = build_model(tparams, options)
+        use_noise, x, y, t, mask, lengths, cost = build_model(tparams, options, hiddenStates=hiddenStates)
         grads = T.grad(cost, wrt=list(tparams.values()))
         f_grad_shared, f_update = adadelta(tparams, grads, x, y, mask, lengths, cost, options, t)
     elif useTime and not embFineTune:
         print('using duration information, not fine-tuning code representations')
-        W_emb = theano.shared(params['W_emb'], name='W_emb')
-        use_noise, x, y, t, mask, lengths, cost = build_model(tparams, options, W_emb)
+        W_emb = theano.shared(params['W_emb'], name='W_emb', borrow=True)
+        use_noise, x, y, t, mask, lengths, cost = build_model(tparams, options, W_emb, hiddenStates)
         grads = T.grad(cost, wrt=list(tparams.values()))
         f_grad_shared, f_update = adadelta(tparams, grads, x, y, mask, lengths, cost, options, t)
     elif not useTime and embFineTune:
         print('not using duration information, fine-tuning code representations')
-        use_noise, x, y, mask, lengths, cost = build_model(tparams, options)
+        use_noise, x, y, mask, lengths, cost = build_model(tparams, options, hiddenStates=hiddenStates)
         grads = T.grad(cost, wrt=list(tparams.values()))
         f_grad_shared, f_update = adadelta(tparams, grads, x, y, mask, lengths, cost, options)
     elif not useTime and not embFineTune:
         print('not using duration information, not fine-tuning code representations')
-        W_emb = theano.shared(params['W_emb'], name='W_emb')
-        use_noise, x, y, mask, lengths, cost = build_model(tparams, options, W_emb)
+        W_emb = theano.shared(params['W_emb'], name='W_emb', borrow=True)
+        use_noise, x, y, mask, lengths, cost = build_model(tparams, options, W_emb, hiddenStates)
         grads = T.grad(cost, wrt=list(tparams.values()))
         f_grad_shared, f_update = adadelta(tparams, grads, x, y, mask, lengths, cost, options)
 
+    if len(initModel) > 0:
+        if os.path.exists(optimizer_state_file(initModel)):
+            load_optimizer_state(options['optimizerState'], optimizer_state_file(initModel))
+        else:
+            print(f'{optimizer_state_file(initModel)} not found, starting with empty optimizer state')
+
     print('Loading data ... ',)
-    trainSet, validSet, testSet = load_data(\
-        seqFileTrain, seqFileTest, seqFileValid,\
-        labelFileTrain, labelFileTest, labelFileValid,\
-        timeFileTrain, timeFileTest, timeFileValid)
-    n_batches = int(np.ceil(float(len(trainSet[0])) / float(batchSize)))
+    if is_sharded_dataset(seqFileTrain):
+        trainSet, validSet, testSet = load_sharded_data(seqFileTrain, seqFileTest, seqFileValid)
+    elif is_patient_store(seqFileTrain):
+        trainSet, validSet, testSet = load_store_data(seqFileTrain, seqFileTest, seqFileValid)
+    else:
+        trainSet, validSet, testSet = load_data(\
+            seqFileTrain, seqFileTest, seqFileValid,\
+            labelFileTrain, labelFileTest, labelFileValid,\
+            timeFileTrain, timeFileTest, timeFileValid)
+    if len(changedSince) > 0:
+        trainSet = select_changed_patients(trainSet, changedSince)
+        print(f'training on {dataset_size(trainSet)} patients with visits since {changedSince}')
+    n_batches = int(np.ceil(float(dataset_size(trainSet)) / float(batchSize)))
     print('done')
 
-    if predictTime:
-        test_model = theano.function(inputs=[x, y, t, t_label, mask, lengths], outputs=cost, name='test_model')
+    plan = None
+    predictedPeak = 0
+    if memoryBudget > 0:
+        print(f'Planning batches for a memory budget of {memoryBudget // 2**20}MB ... ')
+        plan = BatchPlan(options, memoryBudget, itemsize=np.dtype(floatX()).itemsize)
+        for name, dataset in (('train', trainSet), ('valid', validSet), ('test', testSet)):
+            lengths = sorted(dataset_lengths(dataset, maxHistory))
+            print(f'{name}: {plan.summary(lengths)}')
+            predictedPeak = max(predictedPeak, plan.predicted_peak(lengths, plan.bounds(lengths)))
+            if name == 'train':
+                n_batches = len(plan.bounds(lengths))
+
+    if backend == 'numpy':
+        test_model = numpy_trainer.build_test_model(tparams, options, W_emb)
+    elif predictTime:
+        test_model = theano.function(inputs=[x, y, t, t_label, mask, lengths] + options['extraInputs'], outputs=cost, name='test_model')
     elif useTime:
-        test_model = theano.function(inputs=[x, y, t, mask, lengths], outputs=cost, name='test_model')
+        test_model = theano.function(inputs=[x, y, t, mask, lengths] + options['extraInputs'], outputs=cost, name='test_model')
     else:
-        test_model = theano.function(inputs=[x, y, mask, lengths], outputs=cost, name='test_model')
+        test_model = theano.function(inputs=[x, y, mask, lengths] + options['extraInputs'], outputs=cost, name='test_model')
 
     bestValidCrossEntropy = 1e20
     bestValidEpoch = 0
+    bestParams = None
     testCrossEntropy = 0.0
+    # the best validation cross entropy that counts as an improvement for
+    # patience, which must improve by more than minDelta
+    patienceBest = 1e20
+    epochsWithoutImprovement = 0
+    metrics = TrainingMetrics(metricsFile, metricsInterval)
+
+    def record_validation(epoch, validAuc, testAuc=None, epochParams=None, epochState=None):
+        '''
+        Tracks the best model, evaluates the test set and saves the
+        parameters of an improved epoch.  Returns True to stop training.
+        '''
+        nonlocal bestValidCrossEntropy, bestValidEpoch, bestParams, testCrossEntropy
+        nonlocal patienceBest, epochsWithoutImprovement
+        print(f'Validation cross entropy:{validAuc} at epoch:{epoch}')
+        if validAuc < bestValidCrossEntropy:
+            bestValidCrossEntropy = validAuc
+            bestValidEpoch = epoch
+            bestParams = unzip(tparams) if epochParams is None else epochParams
+            if epochParams is None:
+                epochState = unzip(options['optimizerState'])
+            if testAuc is None and not testFinalOnly:
+                metrics.begin_evaluation()
+                testAuc = calculate_auc(test_model, testSet, options, plan, hiddenStates)
+                metrics.end_evaluation(epoch, 'test', testAuc)
+            if testAuc is not None:
+                testCrossEntropy = testAuc
+                print(f'Test cross entropy:{testCrossEntropy} at epoch:{epoch}')
+            save_checkpoint(bestParams, options, outFile, epoch, epochState)
+        if validAuc < patienceBest - minDelta:
+            patienceBest = validAuc
+            epochsWithoutImprovement = 0
+        else:
+            epochsWithoutImprovement += 1
+        stop = epochCallback is not None and epochCallback(epoch, validAuc)
+        if patience > 0 and epochsWithoutImprovement >= patience:
+            print(f'No improvement of more than {minDelta} for {patience} epochs')
+            stop = True
+        return stop
+
+    def record_results(results):
+        stop = False
+        for result in results:
+            if result['kind'] == 'sample':
+                metrics.end_evaluation(result['epoch'], 'valid_sample', result['valid'], result['valid_s'])
+                print(f'Subsample validation cross entropy:{result["valid"]} at epoch:{result["epoch"]}, iteration:{result["iteration"]}')
+                continue
+            metrics.end_evaluation(result['epoch'], 'valid', result['valid'], result['valid_s'])
+            if result['test'] is not None:
+                metrics.end_evaluation(result['epoch'], 'test', result['test'], result['test_s'])
+            stop = record_validation(result['epoch'], result['valid'], result['test'], result['params'], result['state']) or stop
+        return stop
+
+    validator = None
+    if asyncValidation:
+        print('Starting the validation worker ... ')
+        validSample = subsample_dataset(validSet, validSampleSize) if validSampleSize > 0 else None
+        validator = ValidationWorker(params, options, validSet, testSet, validSample, plan)
+
+    stop = False
+    steps = 0
+    trainStart = time.perf_counter()
     print('Optimization start !!')
     for epoch in range(max_epochs):
         iteration = 0
         costVector = []
-        for index in random.sample(list(range(n_batches)), n_batches):
+        metrics.begin_epoch()
+        metrics.begin_iteration()
+        for batchX, batchY, batchT in iter_batches(trainSet, options, shuffle=True, plan=plan):
+            metrics.mark('fetch')
             use_noise.set_value(1.)
-            batchX = trainSet[0][index*batchSize:(index+1)*batchSize]
-            batchY = trainSet[1][index*batchSize:(index+1)*batchSize]
             if predictTime:
-                batchT = trainSet[2][index*batchSize:(index+1)*batchSize]
-                x, y, t, t_label, mask, lengths = padMatrixWithTimePrediction(batchX, batchY, batchT, options)
-                cost = f_grad_shared(x, y, t, t_label, mask, lengths)
+                inputs = padMatrixWithTimePrediction(batchX, batchY, batchT, options)
             elif useTime:
-                batchT = trainSet[2][index*batchSize:(index+1)*batchSize]
-                x, y, t, mask, lengths = padMatrixWithTime(batchX, batchY, batchT, options)
-                cost = f_grad_shared(x, y, t, mask, lengths)
+                inputs = padMatrixWithTime(batchX, batchY, batchT, options)
             else:
-                x, y, mask, lengths = padMatrixWithoutTime(batchX, batchY, options)
-                cost = f_grad_shared(x, y, mask, lengths)
+                inputs = padMatrixWithoutTime(batchX, batchY, options)
+            mask = inputs[-2]
+            if bpttWindow > 0:
+                starts = range(0, mask.shape[0], bpttWindow)
+                windowGroups = [group_inputs(batchY, options, start, start + bpttWindow) for start in starts]
+            else:
+                groupInputs = group_inputs(batchY, options)
+            metrics.mark('pad')
+            if bpttWindow > 0:
+                # one update per window of visits; the hidden state is carried
+                # into the next window by f_grad_shared, the per-patient
+                # lengths stay those of the whole sequence, and every window
+                # takes its share of the L2 terms, so the windows add up to
+                # the cost of the whole batch
+                reset_hidden_states(hiddenStates, len(batchX))
+                options['regWeight'].set_value(numpy_floatX(1. / len(starts)))
+                cost = 0.0
+                for start, groups in zip(starts, windowGroups):
+                    window = [tensor[start:start + bpttWindow] for tensor in inputs[:-1]]
+                    cost += f_grad_shared(*window, inputs[-1], *groups)
+                    metrics.mark('grad')
+                    f_update()
+                    metrics.mark('update')
+                # the test model shares the graph and evaluates whole sequences
+                options['regWeight'].set_value(numpy_floatX(1.))
+            else:
+                cost = f_grad_shared(*inputs, *groupInputs)
+                metrics.mark('grad')
+                f_update()
+                metrics.mark('update')
             costVector.append(cost)
-            f_update()
             if (iteration % 10 == 0) and verbose:
                 print(f'epoch:{epoch}, iteration:{iteration}/{n_batches}, cost:{cost}')
+            metrics.end_iteration(epoch, iteration, cost, mask)
             iteration += 1
+            steps += 1
+            if maxSteps > 0 and steps >= maxSteps:
+                print(f'Reached {maxSteps} steps at epoch:{epoch}, iteration:{iteration}')
+                break
+            if validator is not None:
+                if validSampleInterval > 0 and iteration % validSampleInterval == 0 and not validator.busy():
+                    validator.submit('sample', epoch, iteration, unzip(tparams))
+                stop = record_results(validator.poll())
+                if stop:
+                    break
+        metrics.end_epoch(epoch)
 
         print(f'epoch:{epoch}, mean_cost:{np.mean(costVector)}')
+        if not stop:
+            use_noise.set_value(0.)
+            if validator is None:
+                metrics.begin_evaluation()
+                validAuc = calculate_auc(test_model, validSet, options, plan, hiddenStates)
+                metrics.end_evaluation(epoch, 'valid', validAuc)
+                stop = record_validation(epoch, validAuc)
+            else:
+                stop = record_results(validator.submit('valid', epoch, iteration, unzip(tparams),\
+                    unzip(options['optimizerState'])))
+        if plan is not None:
+            print(f'peak RSS:{peak_rss() / 2**20:.0f}MB, predicted:{predictedPeak / 2**20:.0f}MB at epoch:{epoch}')
+        elapsed = time.perf_counter() - trainStart
+        # stop if one more epoch of the average length would exceed the budget
+        if maxSteps > 0 and steps >= maxSteps:
+            stop = True
+        if timeBudget > 0 and not stop and epoch + 1 < max_epochs and elapsed * (epoch + 2) / (epoch + 1) > timeBudget:
+            print(f'The next epoch would exceed the time budget of {timeBudget}s after {elapsed:.0f}s')
+            stop = True
+        if stop:
+            print(f'Stopped at epoch:{epoch}')
+            break
+    if validator is not None:
+        # the epochs still being validated may hold the best model
+        record_results(validator.drain())
+        validator.close()
+    if testFinalOnly and bestParams is not None:
+        for key, value in bestParams.items():
+            tparams[key].set_value(value)
         use_noise.set_value(0.)
-        validAuc = calculate_auc(test_model, validSet, options)
-        print(f'Validation cross entropy:{validAuc} at epoch:{epoch}')
-        if validAuc < bestValidCrossEntropy:
-            bestValidCrossEntropy = validAuc
-            bestValidEpoch = epoch
-            bestParams = unzip(tparams)
-            testCrossEntropy = calculate_auc(test_model, testSet, options)
-            print(f'Test cross entropy:{testCrossEntropy} at epoch:{epoch}')
-            tempParams = unzip(tparams)
-            np.savez_compressed(outFile + '.' + str(epoch), **tempParams)
+        metrics.begin_evaluation()
+        testCrossEntropy = calculate_auc(test_model, testSet, options, plan, hiddenStates)
+        metrics.end_evaluation(bestValidEpoch, 'test', testCrossEntropy)
+    metrics.close()
     print(f'The best valid cross entropy:{bestValidCrossEntropy} at epoch:{bestValidEpoch}')
     print(f'The test cross entropy: {testCrossEntropy}')
+    return bestValidCrossEntropy, bestValidEpoch, testCrossEntropy
 
 def parse_arguments(parser):
     parser.add_argument(\
         'seq_file_train',
         type=str,
         metavar='<visit_file_train>',
-        help='The path to the file containing visit information of patients, train set')
+        help='The path to the file containing visit information of patients, train set, or to a shard directory (shards.train/) or patient store (patients.train/) from process_mimic.py. With shard directories and patient stores the label file arguments are ignored')
     parser.add_argument(\
         'seq_file_test',
         type=str,
         metavar='<visit_file_test>',
-        help='The path to the file containing visit information of patients, test set')
+        help='The path to the file containing visit information of patients, test set, or to a shard directory or patient store')
     parser.add_argument(\
         'seq_file_valid',
         type=str,
         metavar='<visit_file_valid>',
-        help='The path to the file containing visit information of patients, valid set')
+        help='The path to the file containing visit information of patients, valid set, or to a shard directory or patient store')
     parser.add_argument(\
         'n_input_codes',
         type=int,
@@ -559,7 +1256,7 @@ def parse_arguments(parser):
         '--embed_file',
         type=str,
         default='',
-        help='The path to the file containing the representation vectors of medical codes. If you are not using medical code representations, do not use this option')
+        help='The path to the file containing the representation vectors of medical codes: a .npy file, a raw .bin/.raw file of float32 values with one row per input code, or a JSON list of rows. Binary files are memory-mapped, and used without a copy if --embed_finetune is 0. If you are not using medical code representations, do not use this option')
     parser.add_argument(\
         '--embed_size',
         type=int,
@@ -606,6 +1303,104 @@ def parse_arguments(parser):
         type=float,
         default=1e-8,
         help='A small value to prevent log(0) (default value: 1e-8)')
+    parser.add_argument(\
+        '--shuffle_buffer_size',
+        type=int,
+        default=10000,
+        help='The number of patients shuffled and length-sorted together when streaming a sharded dataset (default value: 10000)')
+    parser.add_argument(\
+        '--memory_budget',
+        type=int,
+        default=0,
+        help='The memory in megabytes training may use. Batches of long patients are made smaller than the batch size so that the estimated peak memory stays within the budget, and the actual peak is printed next to the estimate after every epoch. 0 for no budget (default value: 0)')
+    parser.add_argument(\
+        '--bptt_window',
+        type=int,
+        default=0,
+        help='Truncated backpropagation through time: split the visits of a mini-batch into windows of this many visits, with one update per window. The hidden state is carried from one window to the next without gradient. 0 for full backpropagation (default value: 0)')
+    parser.add_argument(\
+        '--max_history',
+        type=int,
+        default=0,
+        help='Train and validate on the most recent max_history predicted visits of every patient only. 0 for the whole history (default value: 0)')
+    parser.add_argument(\
+        '--label_groups',
+        type=str,
+        default='',
+        help='The path to the binary vocabulary directory (vocab/) from process_mimic.py. Use this option when the label files hold visit codes (seqs_visit.*.json) instead of CCS categories: the output layer then predicts the CCS category of a code first and the code within its category second, so training cost follows the number of categories instead of the number of codes. If you are predicting CCS categories, do not use this option')
+    parser.add_argument(\
+        '--init_model',
+        type=str,
+        default='',
+        help='The path to a model file (.npz) from doctor_ai.py to continue training from, together with the optimizer state saved next to it (<model>.adadelta.npz). Input codes added to the vocabulary since get new rows in W_emb, see --vocab_dir. If you are training from scratch, do not use this option')
+    parser.add_argument(\
+        '--vocab_dir',
+        type=str,
+        default='',
+        help='The path to the binary vocabulary directory (vocab/) from process_mimic.py of the training data. The code of every input row and label column is saved as <out_file>.codes.json, and with --init_model the codes of the model are checked against the vocabulary, which is required when input codes were added')
+    parser.add_argument(\
+        '--changed_since',
+        type=str,
+        default='',
+        help='With a patient store as the training visit file, train only on the patients with a visit on or after this date (YYYY-MM-DD). Typically used with --init_model to refresh a model on new visits')
+    parser.add_argument(\
+        '--max_steps',
+        type=int,
+        default=0,
+        help='Stop training after this many mini-batch updates, then validate. 0 for no limit (default value: 0)')
+    parser.add_argument(\
+        '--patience',
+        type=int,
+        default=0,
+        help='Stop training when the validation cross entropy has not improved by more than --min_delta for this many epochs. The best model is still the epoch with the lowest validation cross entropy. 0 to always train --n_epochs epochs (default value: 0)')
+    parser.add_argument(\
+        '--min_delta',
+        type=float,
+        default=0.0,
+        help='The decrease of the validation cross entropy that counts as an improvement for --patience (default value: 0.0)')
+    parser.add_argument(\
+        '--test_final_only',
+        type=int,
+        default=0,
+        choices=[0, 1],
+        help='Evaluate the test set once, on the best parameters after training, instead of every time the validation cross entropy improves (0 for false, 1 for true) (default value: 0)')
+    parser.add_argument(\
+        '--time_budget',
+        type=float,
+        default=0,
+        help='The training time in minutes: training stops after the last epoch that is expected to end within the budget. 0 for no budget (default value: 0)')
+    parser.add_argument(\
+        '--backend',
+        type=str,
+        default='theano',
+        choices=['theano', 'numpy'],
+        help='The training backend: theano compiles the model graph, numpy (numpy_trainer.py) needs no compilation and starts at once but supports neither --label_groups nor --bptt_window (default value: theano)')
+    parser.add_argument(\
+        '--async_validation',
+        type=int,
+        default=0,
+        choices=[0, 1],
+        help='Validate every epoch on a snapshot of the parameters in a separate process while the next epoch trains; the best model is tracked and saved when the result comes back (0 for false, 1 for true) (default value: 0)')
+    parser.add_argument(\
+        '--valid_sample_size',
+        type=int,
+        default=0,
+        help='With --async_validation, the number of validation patients of a fixed random subsample that is also validated every --valid_sample_interval mini-batches (default value: 0)')
+    parser.add_argument(\
+        '--valid_sample_interval',
+        type=int,
+        default=0,
+        help='With --async_validation and --valid_sample_size, validate the subsample every this many mini-batches, 0 for never (default value: 0)')
+    parser.add_argument(\
+        '--metrics_file',
+        type=str,
+        default='',
+        help='The path to a JSON lines file receiving per-iteration phase timings (data fetch, padding, gradient, update), batch shapes, padding ratio, throughput and evaluation times. If you do not need training metrics, do not use this option')
+    parser.add_argument(\
+        '--metrics_interval',
+        type=int,
+        default=0,
+        help='Print a summary of the training metrics every this many mini-batches, 0 for never (default value: 0)')
     parser.add_argument(\
         '--verbose',
         action='store_true',
@@ -622,6 +1417,22 @@ def main():
         print('Cannot predict time duration without time file')
         sys.exit()
 
+    if args.time_file_train and (is_sharded_dataset(args.seq_file_train) or is_patient_store(args.seq_file_train)):
+        print('Duration information is not supported with sharded datasets and patient stores')
+        sys.exit()
+
+    if args.changed_since and not is_patient_store(args.seq_file_train):
+        print('--changed_since needs a patient store (patients.train/) as the training visit file')
+        sys.exit()
+
+    if args.backend == 'numpy' and (args.label_groups or args.bptt_window > 0):
+        print('The numpy backend supports neither --label_groups nor --bptt_window')
+        sys.exit()
+
+    if (args.valid_sample_size > 0 or args.valid_sample_interval > 0) and not args.async_validation:
+        print('Subsample validation runs in the validation worker, use --async_validation 1')
+        sys.exit()
+
     train_doctorAI(
         seqFileTrain=args.seq_file_train,
         seqFileTest=args.seq_file_test,
@@ -648,6 +1459,25 @@ def main():
         L2_time=args.L2_time,
         dropout_rate=args.dropout_rate,
         logEps=args.log_eps,
+        shuffleBufferSize=args.shuffle_buffer_size,
+        metricsFile=args.metrics_file,
+        metricsInterval=args.metrics_interval,
+        memoryBudget=args.memory_budget * 2**20,
+        bpttWindow=args.bptt_window,
+        maxHistory=args.max_history,
+        labelGroupsDir=args.label_groups,
+        asyncValidation=args.async_validation,
+        validSampleSize=args.valid_sample_size,
+        validSampleInterval=args.valid_sample_interval,
+        patience=args.patience,
+        minDelta=args.min_delta,
+        testFinalOnly=args.test_final_only,
+        timeBudget=args.time_budget * 60,
+        initModel=args.init_model,
+        changedSince=args.changed_since,
+        maxSteps=args.max_steps,
+        vocabDir=args.vocab_dir,
+        backend=args.backend,
         verbose=args.verbose
     )
 
@@ -0,0 +1,184 @@
+'''This module writes synthetic ADMISSIONS.csv and DIAGNOSES_ICD.csv files in
+the column layout of MIMIC-III, so that the pipeline can be run and scaled
+without access to the real data.
+
+The distributions follow MIMIC-III v1.4 (46,520 patients, 58,976 admissions,
+651,047 diagnoses):
+    - admissions per patient are geometric with a mean of about 1.27, with a
+      small heavy-tailed group of frequent visitors (up to 50 admissions)
+    - diagnoses per admission are 1 + Poisson(10), capped at 39
+    - ICD9 codes are drawn from the CCS diagnosis file with Zipf-like
+      frequencies, so a few hundred codes cover most diagnoses
+    - admissions of a patient are spaced by exponential gaps (mean 400 days)
+
+Patients are generated and written in chunks, so millions of patients can
+be written with constant memory.
+
+inputs:
+    - Single Level diagnosis file from CCS (dxref2015.csv).
+    - output directory.
+
+outputs:
+    - <out_dir>/ADMISSIONS.csv
+    - <out_dir>/DIAGNOSES_ICD.csv
+'''
+
+import argparse
+import logging
+import os
+
+import numpy as np
+
+from create_ccs_dict import read_code_mapping
+
+MIMIC_N_PATIENTS = 46520
+ADMISSIONS_HEADER = '"ROW_ID","SUBJECT_ID","HADM_ID","ADMITTIME","DISCHTIME","DEATHTIME",'\
+    '"ADMISSION_TYPE","ADMISSION_LOCATION","DISCHARGE_LOCATION","INSURANCE","LANGUAGE",'\
+    '"RELIGION","MARITAL_STATUS","ETHNICITY","EDREGTIME","EDOUTTIME","DIAGNOSIS",'\
+    '"HOSPITAL_EXPIRE_FLAG","HAS_CHARTEVENTS_DATA"\n'
+DIAGNOSES_HEADER = '"ROW_ID","SUBJECT_ID","HADM_ID","SEQ_NUM","ICD9_CODE"\n'
+ADMISSION_TYPES = np.array(['EMERGENCY', 'ELECTIVE', 'URGENT', 'NEWBORN'])
+ADMISSION_TYPE_P = [0.72, 0.13, 0.02, 0.13]
+INSURANCES = np.array(['Medicare', 'Private', 'Medicaid', 'Government', 'Self Pay'])
+INSURANCE_P = [0.48, 0.38, 0.10, 0.03, 0.01]
+# 2100-01-01 to 2200-01-01 in seconds since the epoch, MIMIC's shifted years
+FIRST_ADMIT = np.datetime64('2100-01-01T00:00:00').astype(np.int64)
+LAST_ADMIT = np.datetime64('2200-01-01T00:00:00').astype(np.int64)
+DAY = 24 * 3600
+
+def code_distribution(icd_codes, rng, exponent=1.1):
+    '''
+    Returns the codes in a random frequency order and their Zipf-like
+    probabilities.
+    '''
+    codes = np.array(icd_codes)[rng.permutation(len(icd_codes))]
+    weights = 1.0 / np.arange(1, len(codes) + 1) ** exponent
+    return codes, weights / weights.sum()
+
+def visit_counts(n_patients, rng):
+    counts = rng.geometric(0.79, n_patients)
+    frequent = rng.random(n_patients) < 0.01
+    counts[frequent] = np.minimum(2 + rng.zipf(1.8, frequent.sum()), 50)
+    return counts
+
+def format_times(seconds):
+    return np.char.replace(np.datetime_as_string(seconds.astype('datetime64[s]'), unit='s'), 'T', ' ')
+
+def generate_chunk(first_pid, n_patients, first_hadm, first_row, codes, code_p, rng):
+    '''
+    Returns the ADMISSIONS and DIAGNOSES_ICD lines of n_patients patients.
+    '''
+    counts = visit_counts(n_patients, rng)
+    n_adm = int(counts.sum())
+    pids = np.repeat(np.arange(first_pid, first_pid + n_patients), counts)
+    hadm_ids = np.arange(first_hadm, first_hadm + n_adm)
+
+    # first admission at a random time, later ones after exponential gaps
+    starts = rng.integers(FIRST_ADMIT, LAST_ADMIT - 20 * 365 * DAY, n_patients)
+    gaps = (rng.exponential(400.0, n_adm) * DAY).astype(np.int64)
+    first_of_patient = np.concatenate([[0], np.cumsum(counts)[:-1]])
+    gaps[first_of_patient] = 0
+    cumulative = np.cumsum(gaps)
+    admit = np.repeat(starts, counts) + cumulative - np.repeat(cumulative[first_of_patient], counts)
+    discharge = admit + (rng.exponential(7.0, n_adm) * DAY).astype(np.int64) + 3600
+    admit_str = format_times(admit)
+    discharge_str = format_times(discharge)
+    adm_types = ADMISSION_TYPES[rng.choice(len(ADMISSION_TYPES), n_adm, p=ADMISSION_TYPE_P)]
+    insurances = INSURANCES[rng.choice(len(INSURANCES), n_adm, p=INSURANCE_P)]
+
+    adm_lines = [
+        f'{first_row[0] + i},{pids[i]},{hadm_ids[i]},{admit_str[i]},{discharge_str[i]},,'
+        f'{adm_types[i]},EMERGENCY ROOM ADMIT,HOME,{insurances[i]},ENGL,NOT SPECIFIED,'
+        f'MARRIED,WHITE,,,SYNTHETIC,0,1\n'
+        for i in range(n_adm)]
+
+    n_dx = np.minimum(1 + rng.poisson(10.0, n_adm), 39)
+    total_dx = int(n_dx.sum())
+    dx_codes = codes[rng.choice(len(codes), total_dx, p=code_p)]
+    dx_pids = np.repeat(pids, n_dx)
+    dx_hadm = np.repeat(hadm_ids, n_dx)
+    seq_nums = np.arange(total_dx) - np.repeat(np.cumsum(n_dx) - n_dx, n_dx) + 1
+    dx_lines = [
+        f'{first_row[1] + i},{dx_pids[i]},{dx_hadm[i]},{seq_nums[i]},"{dx_codes[i]}"\n'
+        for i in range(total_dx)]
+
+    return adm_lines, dx_lines
+
+def generate(ccs_file, out_dir, n_patients, chunk_size=100000, seed=12345, n_header_rows=2):
+    '''
+    Writes the two csv files and returns (patients, admissions, diagnoses).
+    '''
+    rng = np.random.default_rng(seed)
+    ccs_map, _ = read_code_mapping(ccs_file, n_header_rows)
+    icd_codes = [icd for ccs, icds in ccs_map.items() if int(ccs) > 0 for icd in icds if icd]
+    codes, code_p = code_distribution(icd_codes, rng)
+
+    os.makedirs(out_dir, exist_ok=True)
+    n_adm = 0
+    n_dx = 0
+    with open(os.path.join(out_dir, 'ADMISSIONS.csv'), 'w') as adm_file,\
+        open(os.path.join(out_dir, 'DIAGNOSES_ICD.csv'), 'w') as dx_file:
+        adm_file.write(ADMISSIONS_HEADER)
+        dx_file.write(DIAGNOSES_HEADER)
+        for first_pid in range(0, n_patients, chunk_size):
+            chunk_patients = min(chunk_size, n_patients - first_pid)
+            adm_lines, dx_lines = generate_chunk(\
+                first_pid + 1, chunk_patients, 100000 + n_adm, (n_adm + 1, n_dx + 1),\
+                codes, code_p, rng)
+            adm_file.writelines(adm_lines)
+            dx_file.writelines(dx_lines)
+            n_adm += len(adm_lines)
+            n_dx += len(dx_lines)
+            logging.debug("wrote %d patients", first_pid + chunk_patients)
+    return n_patients, n_adm, n_dx
+
+def parse_arguments(parser):
+    parser.add_argument(\
+        'ccs_file',
+        type=str,
+        help='The path to the single-level CCS diagnosis csv file the ICD9 codes are drawn from.')
+    parser.add_argument(\
+        'out_dir',
+        type=str,
+        help='The output directory.')
+    parser.add_argument(\
+        '--scale',
+        type=float,
+        default=1.0,
+        help='The number of patients as a multiple of MIMIC-III (46,520 patients) (default value: 1.0)')
+    parser.add_argument(\
+        '--n_patients',
+        type=int,
+        default=0,
+        help='The number of patients. Overrides --scale.')
+    parser.add_argument(\
+        '--chunk_size',
+        type=int,
+        default=100000,
+        help='The number of patients generated and written at a time (default value: 100000)')
+    parser.add_argument(\
+        '--seed',
+        type=int,
+        default=12345,
+        help='The random seed (default value: 12345)')
+    parser.add_argument('-v', '--verbose', action='store_true',\
+        help='Show verbose output.')
+    args = parser.parse_args()
+    return args
+
+def main():
+    parser = argparse.ArgumentParser()
+    args = parse_arguments(parser)
+    if args.verbose:
+        logging.basicConfig(level=logging.DEBUG)
+    else:
+        logging.basicConfig(level=logging.INFO)
+
+    n_patients = args.n_patients or int(round(MIMIC_N_PATIENTS * args.scale))
+    n_patients, n_adm, n_dx = generate(args.ccs_file, args.out_dir, n_patients,\
+        args.chunk_size, args.seed)
+    logging.info("wrote %d patients, %d admissions, %d diagnoses to %s",\
+        n_patients, n_adm, n_dx, args.out_dir)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,144 @@
+'''This module implements the two-level output layer used when Doctor AI
+predicts a large label vocabulary, such as the ICD-9 visit codes
+(seqs_visit.*.json as label files) instead of the ~275 CCS categories.
+
+Every label belongs to a group, by default the CCS category of the ICD-9
+code (visit_labels of the binary vocabulary).  The model predicts
+
+    P(code) = P(group | h) * P(code | group, h)
+
+with a softmax over the groups and a softmax within every group.  During
+training the within-group softmax of a visit is only computed for the
+groups of its labels, so the cost of the output layer per visit follows the
+number of groups plus the codes of its target groups instead of the whole
+code vocabulary (see the visit_code_step_* benchmarks of
+benchmark_pipeline.py).
+At inference, topk() expands groups best first and stops as soon as no
+unexpanded group can hold a better code, which gives the exact top k codes
+without scoring the whole vocabulary.
+
+The group of every label is saved in the model file as 'label_groups', so
+test_doctor_ai.py rebuilds the same output layer.
+'''
+
+import numpy as np
+
+from code_vocab import CodeVocabulary
+
+class LabelGroups:
+    '''
+    The partition of the labels into groups, with the labels sorted by
+    group so that the labels of a group are one contiguous slice of order.
+    '''
+
+    def __init__(self, groups):
+        groups = np.asarray(groups, dtype=np.int64)
+        # labels without a group share one extra group
+        groups = np.where(groups < 0, groups.max(initial=-1) + 1, groups)
+        # number the groups that have labels 0..n_groups-1
+        used, self.groups = np.unique(groups, return_inverse=True)
+        self.n_groups = len(used)
+        self.n_labels = len(groups)
+        self.order = np.argsort(self.groups, kind='stable').astype(np.int32)
+        sizes = np.bincount(self.groups, minlength=self.n_groups)
+        self.starts = np.zeros(self.n_groups + 1, dtype=np.int64)
+        np.cumsum(sizes, out=self.starts[1:])
+
+    @classmethod
+    def from_vocabulary(cls, vocab_dir):
+        '''
+        Groups the visit codes of a binary vocabulary by their CCS label.
+        '''
+        return cls(np.asarray(CodeVocabulary.load(vocab_dir).visit_labels))
+
+    def group_labels(self, active):
+        return np.concatenate([self.order[self.starts[g]:self.starts[g + 1]] for g in active])
+
+    def batch_inputs(self, labels, start=0, stop=None):
+        '''
+        Returns the inputs of the within-group softmax for the predicted
+        visits start..stop of a batch, from the label lists of its patients
+        (the first visit of a patient is not predicted).  A group is only
+        scored at the visits where it is a target, with one entry per label
+        of the group for every such (visit, group) pair.  The visits are the
+        rows (visit - start) * n_samples + patient of the flattened
+        (visits, n_samples) hidden states, and the entries are ordered by
+        row, the entries of a pair being contiguous:
+            - pairRow:      (pairs,) the row of every pair
+            - pairEntries:  (pairs, largest group) the entries of every
+                            pair, padded with the number of entries
+            - entryPair:    (entries,) the pair of every entry
+            - entryLabel:   (entries,) the label of every entry
+            - rowEntries:   (rows + 1,) where the entries of every row start
+            - entryY:       (entries,) 1 for the labels of the visit
+        '''
+        n_samples = len(labels)
+        windows = [visits[1 + start:None if stop is None else 1 + stop] for visits in labels]
+        n_rows = max([len(window) for window in windows], default=0) * n_samples
+        pairRow = []
+        pairGroups = []
+        entryY = []
+        for row in range(n_rows):
+            visit, patient = divmod(row, n_samples)
+            if visit >= len(windows[patient]):
+                continue
+            codes = np.asarray(windows[patient][visit], dtype=np.int64)
+            groups = np.unique(self.groups[codes])
+            if len(groups) == 0:
+                continue
+            pairRow.extend([row] * len(groups))
+            pairGroups.append(groups)
+            entryY.append(np.isin(self.group_labels(groups), codes))
+        pairRow = np.array(pairRow, dtype=np.int64)
+        pairGroups = np.concatenate(pairGroups) if pairGroups else np.zeros(0, dtype=np.int64)
+        sizes = self.starts[pairGroups + 1] - self.starts[pairGroups]
+        n_entries = int(sizes.sum())
+        entryPair = np.repeat(np.arange(len(pairGroups)), sizes)
+        entryLabel = self.group_labels(pairGroups) if len(pairGroups) > 0 else np.zeros(0, dtype=np.int64)
+        pairEntries = np.full((len(pairGroups), max(sizes.max(initial=0), 1)), n_entries, dtype=np.int32)
+        pairStarts = np.cumsum(sizes) - sizes
+        pairEntries[entryPair, np.arange(n_entries) - pairStarts[entryPair]] = np.arange(n_entries)
+        rowEntries = np.zeros(n_rows + 1, dtype=np.int64)
+        np.cumsum(np.bincount(pairRow, minlength=n_rows, weights=sizes).astype(np.int64), out=rowEntries[1:])
+        entryY = np.concatenate(entryY) if entryY else np.zeros(0, dtype=bool)
+        return pairRow.astype(np.int32), pairEntries, entryPair.astype(np.int32),\
+            entryLabel.astype(np.int32), rowEntries.astype(np.int32), entryY
+
+    def topk(self, groupProbs, hidden, W_output, b_output, k=30):
+        '''
+        Returns the ids and probabilities of the k most probable labels of
+        every row, best first, from the group probabilities (rows, n_groups)
+        and the last hidden states (rows, hidden size).
+        '''
+        k = min(k, self.n_labels)
+        topCodes = np.zeros((len(groupProbs), k), dtype=np.int64)
+        topProbs = np.zeros((len(groupProbs), k), dtype=groupProbs.dtype)
+        for row in range(len(groupProbs)):
+            ranked = np.argsort(-groupProbs[row], kind='stable')
+            codes = np.zeros(0, dtype=np.int64)
+            probs = np.zeros(0, dtype=groupProbs.dtype)
+            expanded = 0
+            step = k
+            while expanded < self.n_groups:
+                batch = ranked[expanded:expanded + step]
+                expanded += len(batch)
+                step *= 2
+                newCodes = self.group_labels(batch)
+                logits = hidden[row].dot(W_output[:, newCodes]) + b_output[newCodes]
+                bounds = np.concatenate([[0], np.cumsum(self.starts[batch + 1] - self.starts[batch])])
+                logits = logits - np.repeat(np.maximum.reduceat(logits, bounds[:-1]), np.diff(bounds))
+                expLogits = np.exp(logits)
+                sums = np.add.reduceat(expLogits, bounds[:-1])
+                newProbs = expLogits / np.repeat(sums, np.diff(bounds)) * np.repeat(groupProbs[row, batch], np.diff(bounds))
+                codes = np.concatenate([codes, newCodes])
+                probs = np.concatenate([probs, newProbs])
+                if len(codes) > k:
+                    keep = np.argpartition(-probs, k - 1)[:k]
+                    codes, probs = codes[keep], probs[keep]
+                # no code of a group is more probable than the group itself
+                if len(codes) == k and (expanded == self.n_groups or probs.min() >= groupProbs[row, ranked[expanded]]):
+                    break
+            best = np.argsort(-probs, kind='stable')
+            topCodes[row, :len(best)] = codes[best]
+            topProbs[row, :len(best)] = probs[best]
+        return topCodes, topProbs
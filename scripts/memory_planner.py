@@ -0,0 +1,139 @@
+'''This module estimates the memory a training mini-batch needs and cuts the
+length-sorted patients into batches that fit a memory budget.
+
+The padMatrix* functions build dense (maxlen, n_samples, inputDimSize) and
+(maxlen, n_samples, numClass) tensors, and the model keeps several tensors
+of the same shape per layer for the backward pass, so the memory of a batch
+grows with the number of visits of its longest patient.  BatchPlan
+estimates the bytes needed per padded visit from the model dimensions and
+caps the batch size of every length so that
+
+    resident memory before training + maxlen * n_samples * bytes per visit
+
+stays below the budget.  Batches of short patients keep the configured
+batch size; batches of long patients get smaller.  A patient too long to
+fit even alone still gets a batch of one, and is reported.
+
+The per-visit factors below are estimates of what Theano keeps alive; the
+actual peak RSS is printed next to the prediction after every epoch so they
+can be checked on a given machine.
+'''
+
+import os
+import resource
+
+# float64 arrays made by np.zeros before the astype to floatX
+PAD_ITEMSIZE = 8
+# tensors of embedding size per visit: dot product, tanh, gradient
+EMB_TENSORS = 3
+# tensors of hidden size per visit and GRU layer: three input projections,
+# r, z, h_tilde, h and dropout in the forward pass, and their gradients
+GRU_TENSORS = 14
+# tensors of label size per visit: softmax, masked softmax, two logs, cross
+# entropy and their gradients
+SOFTMAX_TENSORS = 8
+
+def current_rss():
+    '''
+    Returns the resident set size of this process in bytes.
+    '''
+    try:
+        with open('/proc/self/statm', 'r') as infile:
+            return int(infile.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        return peak_rss()
+
+def peak_rss():
+    '''
+    Returns the peak resident set size of this process in bytes.
+    '''
+    # ru_maxrss is reported in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+class BatchPlan:
+    '''
+    Batch sizes per patient length for a memory budget in bytes.  With a
+    budget of 0, every batch has batchSize patients, as without a plan.
+    '''
+
+    def __init__(self, options, budgetBytes=0, baseBytes=None, itemsize=4):
+        self.batchSize = options['batchSize']
+        self.budgetBytes = budgetBytes
+        self.baseBytes = current_rss() if baseBytes is None else baseBytes
+        inputDimSize = options['inputDimSize']
+        numClass = options['numClass']
+        hiddenSize = sum(options['hiddenDimSize'])
+        # with truncated BPTT only one window of visits is in the model at a time
+        self.window = options.get('bpttWindow', 0)
+
+        self.padBytes = max((PAD_ITEMSIZE + itemsize) * inputDimSize,\
+            itemsize * inputDimSize + (PAD_ITEMSIZE + itemsize) * numClass)
+        self.inputBytes = itemsize * (inputDimSize + numClass)
+        self.modelBytes = itemsize * (EMB_TENSORS * options['embSize']\
+            + GRU_TENSORS * hiddenSize + SOFTMAX_TENSORS * numClass)
+        self.bytesPerVisit = max(self.padBytes, self.inputBytes + self.modelBytes)
+
+    def batch_bytes(self, maxlen, n_samples):
+        maxlen = max(maxlen, 1)
+        modelVisits = min(maxlen, self.window) if self.window > 0 else maxlen
+        return n_samples * max(maxlen * self.padBytes,\
+            maxlen * self.inputBytes + modelVisits * self.modelBytes)
+
+    def batch_size(self, maxlen):
+        '''
+        Returns the largest batch size within budget for patients of maxlen
+        padded visits.
+        '''
+        if self.budgetBytes <= 0:
+            return self.batchSize
+        available = self.budgetBytes - self.baseBytes
+        fits = int(available // self.batch_bytes(maxlen, 1))
+        return max(1, min(self.batchSize, fits))
+
+    def bounds(self, lengths):
+        '''
+        Returns the (start, stop) ranges of the batches over patients with
+        the given numbers of visits, in order.  The patients are expected to
+        be sorted by length, as load_data and the shard buffers do.
+        '''
+        n = len(lengths)
+        if self.budgetBytes <= 0:
+            return [(start, min(start + self.batchSize, n)) for start in range(0, n, self.batchSize)]
+        bounds = []
+        start = 0
+        maxlen = 0
+        for stop, length in enumerate(lengths):
+            maxlen = max(maxlen, length - 1)
+            if stop > start and stop - start + 1 > self.batch_size(maxlen):
+                bounds.append((start, stop))
+                start = stop
+                maxlen = length - 1
+        if start < n:
+            bounds.append((start, n))
+        return bounds
+
+    def predicted_peak(self, lengths, bounds):
+        '''
+        Returns the predicted peak RSS in bytes over the batches of bounds.
+        '''
+        largest = 0
+        for start, stop in bounds:
+            maxlen = max(lengths[start:stop]) - 1
+            largest = max(largest, self.batch_bytes(maxlen, stop - start))
+        return self.baseBytes + largest
+
+    def summary(self, lengths):
+        '''
+        Returns a printable report of the plan for a length-sorted dataset.
+        '''
+        bounds = self.bounds(lengths)
+        capped = sum(1 for start, stop in bounds if stop - start < self.batchSize and stop < len(lengths))
+        tooLong = [lengths[start] for start, stop in bounds if stop - start == 1\
+            and self.budgetBytes > 0 and self.baseBytes + self.batch_bytes(lengths[start] - 1, 1) > self.budgetBytes]
+        lines = [f'{len(bounds)} batches, {capped} capped below batch size {self.batchSize}, '
+                 f'{self.bytesPerVisit / 2**10:.0f}KB per padded visit, '
+                 f'predicted peak RSS:{self.predicted_peak(lengths, bounds) / 2**20:.0f}MB '
+                 f'(resident now:{self.baseBytes / 2**20:.0f}MB)']
+        if tooLong:
+            lines.append(f'{len(tooLong)} patients exceed the memory budget alone, the longest with {max(tooLong)} visits')
+        return '\n'.join(lines)
@@ -0,0 +1,199 @@
+'''This module exports a Doctor AI checkpoint as a compact inference-only
+model, and reports how much accuracy the export costs.
+
+A checkpoint (<out_file>.<epoch>.npz from doctor_ai.py) holds every
+parameter at full precision in one compressed archive that must be fully
+decompressed to be used.  An exported model is a directory of .npy files
+that can be memory-mapped:
+    - manifest.json:       format, weight type and the shape of every parameter
+    - <param>.npy:         the weights, as float16, or as int8 with
+    - <param>.scale.npy:   one float32 scale per row of an int8 matrix
+                           (weight = int8 value * scale of its row)
+
+Only the parameters test_doctor_ai.py uses are exported (b_emb, which the
+inference graph does not use, is dropped); vectors such as biases stay
+float32 in int8 exports.  test_doctor_ai.py accepts an exported model
+directory in place of the .npz file.
+
+inputs:
+    - .npz model file from doctor_ai.py
+    - output directory
+    - (optional) visit and label files to measure recall@10/20/30 of the
+      float and the exported model with numpy_model.py
+
+outputs:
+    - the exported model directory
+    - (optional) JSON report of sizes and recall of both models
+'''
+
+import argparse
+import json
+import logging
+import os
+import re
+
+import numpy as np
+
+from numpy_model import evaluate_recall
+
+MANIFEST = 'manifest.json'
+EXPORT_DTYPES = ('float16', 'int8')
+INFERENCE_PARAMS = re.compile(r'^(W_emb|(W|W_r|W_z|U|U_r|U_z|b|b_r|b_z)_\d+|[Wb]_(output|time|group)|label_groups)$')
+
+def is_exported_model(path):
+    return os.path.isdir(path) and os.path.exists(os.path.join(path, MANIFEST))
+
+def quantize_rows(matrix):
+    '''
+    Returns the int8 values and float32 row scales of a matrix.
+    '''
+    scale = np.abs(matrix).max(axis=1).astype(np.float32) / 127.
+    scale[scale == 0] = 1.
+    values = np.clip(np.round(matrix / scale[:, None]), -127, 127).astype(np.int8)
+    return values, scale
+
+def export_model(params, out_dir, dtype='float16'):
+    '''
+    Writes the inference parameters of params to out_dir.  Returns the
+    manifest.
+    '''
+    os.makedirs(out_dir, exist_ok=True)
+    manifest = {'format': 1, 'dtype': dtype, 'params': {}}
+    for name, value in params.items():
+        if not INFERENCE_PARAMS.match(name):
+            logging.debug("dropping %s", name)
+            continue
+        value = np.asarray(value)
+        entry = {'shape': list(value.shape)}
+        if name == 'label_groups':
+            value = value.astype(np.int32)
+        elif dtype == 'int8' and value.ndim == 2:
+            value, scale = quantize_rows(value)
+            np.save(os.path.join(out_dir, name + '.scale.npy'), scale)
+            entry['scaled'] = True
+        elif dtype == 'int8':
+            value = value.astype(np.float32)
+        else:
+            value = value.astype(np.float16)
+        entry['dtype'] = value.dtype.name
+        np.save(os.path.join(out_dir, name + '.npy'), value)
+        manifest['params'][name] = entry
+    with open(os.path.join(out_dir, MANIFEST), 'w', encoding='utf8') as outfile:
+        json.dump(manifest, outfile, indent=2)
+    return manifest
+
+def load_model(path, dtype=np.float32, mmap_mode='r'):
+    '''
+    Returns the parameters of a model .npz file or an exported model
+    directory as a dictionary.  Exported weights are memory-mapped and
+    converted to dtype; with dtype=None they are returned as stored (int8
+    matrices without their scales applied).
+    '''
+    if not is_exported_model(path):
+        with np.load(path) as models:
+            return {name: models[name] for name in models.files}
+    with open(os.path.join(path, MANIFEST), 'r') as infile:
+        manifest = json.load(infile)
+    params = {}
+    for name, entry in manifest['params'].items():
+        value = np.load(os.path.join(path, name + '.npy'), mmap_mode=mmap_mode)
+        if dtype is not None and name != 'label_groups':
+            if entry.get('scaled'):
+                scale = np.load(os.path.join(path, name + '.scale.npy'))
+                value = value.astype(dtype) * scale.astype(dtype)[:, None]
+            else:
+                value = value.astype(dtype)
+        params[name] = value
+    return params
+
+def model_bytes(path):
+    if os.path.isdir(path):
+        return sum(os.path.getsize(os.path.join(path, name)) for name in os.listdir(path))
+    return os.path.getsize(path)
+
+def parse_arguments(parser):
+    parser.add_argument(\
+        'model_file',
+        type=str,
+        help='The path to the model file saved by doctor_ai.py.')
+    parser.add_argument(\
+        'out_dir',
+        type=str,
+        help='The output directory of the exported model.')
+    parser.add_argument(\
+        '--dtype',
+        type=str,
+        default='float16',
+        choices=EXPORT_DTYPES,
+        help='The type of the exported weights; int8 matrices get one scale per row (default value: float16)')
+    parser.add_argument(\
+        '--visit_file',
+        type=str,
+        default='',
+        help='The path to a JSON visit file (e.g. seqs_visit.test.json) to compare the recall of the float and the exported model on. If you do not need the accuracy report, do not use this option')
+    parser.add_argument(\
+        '--label_file',
+        type=str,
+        default='',
+        help='The path to the JSON label file matching --visit_file.')
+    parser.add_argument(\
+        '--time_file',
+        type=str,
+        default='',
+        help='The path to the JSON duration file matching --visit_file, for models trained with durations.')
+    parser.add_argument(\
+        '--report_file',
+        type=str,
+        default='',
+        help='The path to the JSON accuracy and size report.')
+    parser.add_argument(\
+        '--batch_size',
+        type=int,
+        default=100,
+        help='The size of a single mini-batch for the accuracy report (default value: 100)')
+    parser.add_argument('-v', '--verbose', action='store_true',\
+        help='Show verbose output.')
+    args = parser.parse_args()
+    return args
+
+def main():
+    parser = argparse.ArgumentParser()
+    args = parse_arguments(parser)
+    if args.verbose:
+        logging.basicConfig(level=logging.DEBUG)
+    else:
+        logging.basicConfig(level=logging.INFO)
+
+    params = load_model(args.model_file)
+    export_model(params, args.out_dir, args.dtype)
+    report = {
+        'model_file': args.model_file,
+        'out_dir': args.out_dir,
+        'dtype': args.dtype,
+        'model_bytes': model_bytes(args.model_file),
+        'export_bytes': model_bytes(args.out_dir)}
+    logging.info("exported %s (%d bytes) to %s (%d bytes)", args.model_file,\
+        report['model_bytes'], args.out_dir, report['export_bytes'])
+
+    if args.visit_file:
+        with open(args.visit_file, 'r') as infile:
+            seqs = json.load(infile)
+        with open(args.label_file, 'r') as infile:
+            labels = json.load(infile)
+        times = None
+        if args.time_file:
+            with open(args.time_file, 'r') as infile:
+                times = json.load(infile)
+        ranks = [10, 20, 30]
+        floatRecall, _ = evaluate_recall(params, seqs, labels, args.batch_size, ranks, times)
+        exportRecall, _ = evaluate_recall(load_model(args.out_dir), seqs, labels, args.batch_size, ranks, times)
+        for rank, before, after in zip(ranks, floatRecall, exportRecall):
+            report[f'recall@{rank}'] = {'float': before, 'export': after, 'change': after - before}
+            logging.info("recall@%d: float %.4f, %s %.4f (%+.4f)", rank, before, args.dtype, after, after - before)
+
+    if args.report_file:
+        with open(args.report_file, 'w', encoding='utf8') as outfile:
+            json.dump(report, outfile, indent=2)
+
+if __name__ == '__main__':
+    main()
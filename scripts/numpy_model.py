@@ -0,0 +1,259 @@
+'''This module runs a trained Doctor AI model forward with NumPy only.
+
+It mirrors the inference graph of test_doctor_ai.py (code embedding, GRU
+layers with the dropout scaling of 0.5, softmax output or the two-level
+output of label_groups.py) so that models can be scored without compiling
+Theano functions, for example to compare an exported model with the float
+checkpoint it came from.
+
+params is any mapping from parameter name to array: the dictionary of a
+model .npz file, or of an exported model (model_export.py).
+'''
+
+import numpy as np
+
+from label_groups import LabelGroups
+
+def sigmoid(x):
+    return 1. / (1. + np.exp(-x))
+
+def softmax(x):
+    e = np.exp(x - x.max(axis=-1, keepdims=True))
+    return e / e.sum(axis=-1, keepdims=True)
+
+def n_layers(params):
+    count = 0
+    while 'W_' + str(count) in params:
+        count += 1
+    return count
+
+def pad_visits(seqs, inputDimSize, dtype=np.float32, times=None, useLogTime=True, logEps=1e-8):
+    '''
+    Returns the padded (x, t, mask, lengths) of a batch, as padMatrixWithTime
+    and padMatrixWithoutTime of test_doctor_ai.py; t is None without times.
+    '''
+    lengths = np.array([len(seq) for seq in seqs]) - 1
+    n_samples = len(seqs)
+    maxlen = np.max(lengths)
+
+    x = np.zeros((maxlen, n_samples, inputDimSize), dtype=dtype)
+    mask = np.zeros((maxlen, n_samples), dtype=dtype)
+    t = None if times is None else np.zeros((maxlen, n_samples), dtype=dtype)
+    for idx, seq in enumerate(seqs):
+        for xvec, subseq in zip(x[:, idx, :], seq[:-1]):
+            xvec[subseq] = 1.
+        mask[:lengths[idx], idx] = 1.
+        if t is not None:
+            t[:lengths[idx], idx] = times[idx][:-1]
+    if t is not None and useLogTime:
+        t = np.log(t + logEps)
+    return x, t, mask, lengths
+
+def gru_layer(params, emb, layerIndex, mask):
+    W_rx = emb.dot(params['W_r_' + layerIndex])
+    W_zx = emb.dot(params['W_z_' + layerIndex])
+    Wx = emb.dot(params['W_' + layerIndex])
+    U_r = params['U_r_' + layerIndex]
+    U_z = params['U_z_' + layerIndex]
+    U = params['U_' + layerIndex]
+    b_r = params['b_r_' + layerIndex]
+    b_z = params['b_z_' + layerIndex]
+    b = params['b_' + layerIndex]
+
+    h = np.zeros((emb.shape[1], U.shape[0]), dtype=emb.dtype)
+    results = np.zeros((emb.shape[0], emb.shape[1], U.shape[0]), dtype=emb.dtype)
+    for step in range(emb.shape[0]):
+        r = sigmoid(W_rx[step] + h.dot(U_r) + b_r)
+        z = sigmoid(W_zx[step] + h.dot(U_z) + b_z)
+        h_tilde = np.tanh(Wx[step] + (r * h).dot(U) + b)
+        h_new = z * h + (1. - z) * h_tilde
+        stepMask = mask[step][:, None]
+        h = stepMask * h_new + (1. - stepMask) * h
+        results[step] = h
+    return results
+
+def hidden_states(params, x, mask, t=None):
+    '''
+    Returns the output of the last GRU layer, scaled as after dropout.
+    '''
+    return recurrent_states(params, x.dot(params['W_emb']), mask, t)
+
+def embed_codes(params, codeIndex, maxlen, n_samples):
+    '''
+    Returns the visit embeddings x.dot(W_emb) of a batch from the code index
+    of prepare_batches, without building the one-hot x.
+    '''
+    positions, starts, codes = codeIndex
+    W_emb = params['W_emb']
+    emb = np.zeros((maxlen * n_samples, W_emb.shape[1]), dtype=W_emb.dtype)
+    if len(codes) > 0:
+        emb[positions] = np.add.reduceat(W_emb[codes], starts, axis=0)
+    return emb.reshape(maxlen, n_samples, W_emb.shape[1])
+
+def recurrent_states(params, emb, mask, t=None):
+    if t is not None:
+        emb = np.concatenate([t[:, :, None], emb], axis=2)
+    inputVector = emb
+    for i in range(n_layers(params)):
+        inputVector = gru_layer(params, inputVector, str(i), mask) * 0.5
+    return inputVector
+
+def predict_codes(params, hidden, mask):
+    '''
+    Returns the (maxlen, n_samples, numClass) code probabilities of a
+    softmax output layer.
+    '''
+    return softmax(hidden.dot(params['W_output']) + params['b_output']) * mask[:, :, None]
+
+def predict_durations(params, hidden, mask):
+    duration = np.maximum(hidden.dot(params['W_time']) + params['b_time'], 0)
+    return duration.reshape(mask.shape) * mask
+
+def topk_rows(params, hidden, k=30, labelGroups=None):
+    '''
+    Returns the ids and probabilities of the k most probable codes for
+    every row of last hidden states, best first.
+    '''
+    if labelGroups is not None:
+        groupProbs = softmax(hidden.dot(params['W_group']) + params['b_group'])
+        return labelGroups.topk(groupProbs, hidden, params['W_output'], params['b_output'], k)
+    outputs = softmax(hidden.dot(params['W_output']) + params['b_output'])
+    k = min(k, outputs.shape[1])
+    top = np.argpartition(-outputs, k - 1, axis=1)[:, :k]
+    probs = np.take_along_axis(outputs, top, axis=1)
+    order = np.argsort(-probs, axis=1, kind='stable')
+    return np.take_along_axis(top, order, axis=1), np.take_along_axis(probs, order, axis=1)
+
+def prepare_batches(seqs, labels, batchSize=100, times=None, useLogTime=True, logEps=1e-8, latest=False):
+    '''
+    Returns the batches of seqs in the form evaluate_batches takes.  They do
+    not depend on the model, so the same batches can score any number of
+    models.  Patients are sorted by length to keep padding small.  Every
+    batch holds the input codes of its visits as the rows of W_emb to sum
+    per padded position (code index), the mask, the log durations, the
+    position of its patients in seqs, and the label codes and durations of
+    every predicted visit.  With latest, every visit is an input and only
+    the visit after the last one is predicted, for every patient and
+    without labels.
+    '''
+    # the number of visits at the end of every patient that are not inputs
+    held = 0 if latest else 1
+    order = sorted(range(len(seqs)), key=lambda i: len(seqs[i]))
+    batches = []
+    for start in range(0, len(order), batchSize):
+        indices = order[start:start + batchSize]
+        batchX = [seqs[i] for i in indices]
+        lengths = np.array([len(seq) for seq in batchX]) - held
+        n_samples = len(batchX)
+        maxlen = int(np.max(lengths))
+
+        # a code listed twice in a visit counts once, as in the one-hot x
+        keys = np.array(sorted({(step * n_samples + idx, code)\
+            for idx, seq in enumerate(batchX) for step, visit in enumerate(seq[:len(seq) - held]) for code in visit}),\
+            dtype=np.int64).reshape(-1, 2)
+        positions, starts = np.unique(keys[:, 0], return_index=True)
+        mask = np.zeros((maxlen, n_samples), dtype=np.float32)
+        for idx in range(n_samples):
+            mask[:lengths[idx], idx] = 1.
+
+        t = None
+        trueTimes = []
+        if times is not None:
+            t = np.zeros((maxlen, n_samples), dtype=np.float32)
+            for idx, i in enumerate(indices):
+                t[:lengths[idx], idx] = times[i][:lengths[idx]]
+                if not latest:
+                    trueTimes.extend(times[i][1:])
+            if useLogTime:
+                t = np.log(t + logEps)
+
+        batchTrue = []
+        sampleIndex = []
+        visitIndex = []
+        for idx, i in enumerate(indices):
+            if latest:
+                batchTrue.append([])
+                sampleIndex.append(idx)
+                visitIndex.append(lengths[idx] - 1)
+                continue
+            thisY = labels[i][1:]
+            for timeIndex in range(lengths[idx]):
+                if len(thisY[timeIndex]) == 0:
+                    continue
+                batchTrue.append(thisY[timeIndex])
+                sampleIndex.append(idx)
+                visitIndex.append(timeIndex)
+        batches.append({
+            'patients': np.array(indices, dtype=np.int64),
+            'codeIndex': (positions, starts, keys[:, 1]),
+            'mask': mask,
+            'lengths': lengths,
+            't': t,
+            'trueTimes': trueTimes,
+            'labels': batchTrue,
+            'rows': (np.array(visitIndex, dtype=np.int64), np.array(sampleIndex, dtype=np.int64))})
+    return batches
+
+def uses_time(params):
+    # the duration is an extra input of the first GRU layer
+    return params['W_0'].shape[0] == params['W_emb'].shape[1] + 1
+
+def batch_hidden_states(params, batch):
+    '''
+    Returns the last hidden states and the mask of a prepare_batches batch.
+    '''
+    if uses_time(params) and batch['t'] is None:
+        raise ValueError('the model was trained with durations, times are required')
+    mask = batch['mask'].astype(params['W_emb'].dtype, copy=False)
+    emb = embed_codes(params, batch['codeIndex'], mask.shape[0], mask.shape[1])
+    t = batch['t'].astype(emb.dtype, copy=False) if uses_time(params) else None
+    return recurrent_states(params, emb, mask, t), mask
+
+def evaluate_batches(params, batches, ranks=(10, 20, 30)):
+    '''
+    Returns recall@rank for every rank over the visits of prepare_batches
+    batches, defined as recallTop in test_doctor_ai.py, and the true and
+    predicted durations if the model predicts durations (empty lists
+    otherwise).  Models trained with durations need batches with times.
+    '''
+    labelGroups = LabelGroups(params['label_groups']) if 'label_groups' in params else None
+    predictTime = uses_time(params) and 'W_time' in params
+    recallSum = np.zeros(len(ranks))
+    n_visits = 0
+    trueTimes = []
+    predTimes = []
+    for batch in batches:
+        hidden, mask = batch_hidden_states(params, batch)
+
+        if batch['labels']:
+            topCodes, _ = topk_rows(params, hidden[batch['rows']], max(ranks), labelGroups)
+            for codes, tops in zip(batch['labels'], topCodes.tolist()):
+                codes = set(codes)
+                recallSum += [len(codes.intersection(tops[:rank])) / len(codes) for rank in ranks]
+            n_visits += len(batch['labels'])
+        if predictTime:
+            durations = predict_durations(params, hidden, mask)
+            trueTimes.extend(batch['trueTimes'])
+            for idx, length in enumerate(batch['lengths']):
+                predTimes.extend(durations[:length, idx].tolist())
+    recall = (recallSum / max(n_visits, 1)).tolist()
+    return recall, (trueTimes, predTimes)
+
+def evaluate_recall(params, seqs, labels, batchSize=100, ranks=(10, 20, 30), times=None,\
+    useLogTime=True, logEps=1e-8):
+    '''
+    Returns evaluate_batches of seqs for one model.
+    '''
+    batches = prepare_batches(seqs, labels, batchSize, times, useLogTime, logEps)
+    return evaluate_batches(params, batches, ranks)
+
+def r_squared(trueTimes, predTimes, mean_duration=20.0, useLogTime=True, logEps=1e-8):
+    '''
+    Returns the R2 of predicted durations, as calculate_r_squared in
+    test_doctor_ai.py.
+    '''
+    trueTimes = np.array(trueTimes, dtype=np.float64)
+    if useLogTime:
+        trueTimes = np.log(trueTimes + logEps)
+    predTimes = np.array(predTimes, dtype=np.float64)
+    return 1.0 - ((trueTimes - predTimes) ** 2).sum() / ((trueTimes - mean_duration) ** 2).sum()
@@ -0,0 +1,273 @@
+'''This module trains the Doctor AI model with NumPy only, as an alternative
+to the Theano graph of doctor_ai.py (train_doctorAI(backend='numpy'),
+--backend numpy).
+
+It computes the same cost as build_model in doctor_ai.py: the tanh code
+embedding, the GRU layers with the dropout of dropout_layer (units kept with
+probability dropout_rate while training, scaled by 0.5 otherwise), the
+softmax output with the logEps cross entropy, the ReLU duration head and the
+L2 penalties, and trains it with the same adadelta updates.  The gradients
+are derived by hand; check_gradients.py compares them with finite
+differences and, where Theano is installed, with T.grad.
+
+Nothing is compiled, so training starts at once.  The one-hot inputs are
+multiplied as sparse matrices, the GRU input projections of all time steps
+are computed in one matrix product per layer, and the reset and update
+gates share one product with the previous hidden state.
+
+Not supported: the two-level output layer (--label_groups) and truncated
+backpropagation through time (--bptt_window).
+'''
+
+from collections import OrderedDict
+
+import numpy as np
+from scipy import sparse
+
+class SharedArray:
+    '''
+    A NumPy array with the get_value/set_value interface of theano.shared,
+    so that train_doctorAI handles the parameters of both backends alike.
+    '''
+
+    def __init__(self, value, name=None):
+        self.value = np.array(value)
+        self.name = name
+
+    def get_value(self, borrow=False):
+        return self.value if borrow else self.value.copy()
+
+    def set_value(self, value, borrow=False):
+        self.value = value if borrow else np.array(value, dtype=self.value.dtype)
+
+def sigmoid(x):
+    return 1. / (1. + np.exp(-x))
+
+def softmax(x):
+    e = np.exp(x - x.max(axis=-1, keepdims=True))
+    return e / e.sum(axis=-1, keepdims=True)
+
+def unpack_inputs(inputs, options):
+    '''
+    Returns (x, y, t, t_label, mask, lengths) of the padded inputs of
+    padMatrixWithTimePrediction, padMatrixWithTime or padMatrixWithoutTime,
+    with None for the tensors the model does not use.
+    '''
+    if options['predictTime']:
+        return inputs
+    if options['useTime']:
+        x, y, t, mask, lengths = inputs
+        return x, y, t, None, mask, lengths
+    x, y, mask, lengths = inputs
+    return x, y, None, None, mask, lengths
+
+def flat(tensor):
+    return tensor.reshape(-1, tensor.shape[-1])
+
+def dot3(tensor, matrix):
+    '''
+    Returns tensor.dot(matrix) for a (T, N, D) tensor as one matrix product,
+    which ndarray.dot does not use for more than two dimensions.
+    '''
+    return flat(tensor).dot(matrix).reshape(tensor.shape[:-1] + (matrix.shape[1],))
+
+# the gates of a GRU layer in the order their weights are stacked
+GATES = ('', 'r_', 'z_')
+
+def gru_forward(params, layerIndex, X, mask):
+    '''
+    Returns the hidden states (T, N, H) of a GRU layer over the inputs X
+    (T, N, D), and what gru_backward needs.  The input projections of the
+    candidate state and the reset and update gates are computed for all
+    time steps in one product with the stacked W, W_r and W_z.
+    '''
+    W_all = np.concatenate([params['W_' + gate + layerIndex] for gate in GATES], axis=1)
+    b_all = np.concatenate([params['b_' + gate + layerIndex] for gate in GATES])
+    U = params['U_' + layerIndex]
+    U_rz = np.concatenate([params['U_r_' + layerIndex], params['U_z_' + layerIndex]], axis=1)
+    n_steps, n_samples = mask.shape
+    hiddenSize = U.shape[0]
+
+    projected = dot3(X, W_all) + b_all
+    Wx = projected[:, :, :hiddenSize]
+    Wrzx = projected[:, :, hiddenSize:]
+    hs = np.zeros((n_steps + 1, n_samples, hiddenSize), dtype=X.dtype)
+    r = np.empty((n_steps, n_samples, hiddenSize), dtype=X.dtype)
+    z = np.empty_like(r)
+    h_tilde = np.empty_like(r)
+    for step in range(n_steps):
+        h = hs[step]
+        rz = sigmoid(Wrzx[step] + h.dot(U_rz))
+        r[step] = rz[:, :hiddenSize]
+        z[step] = rz[:, hiddenSize:]
+        h_tilde[step] = np.tanh(Wx[step] + (r[step] * h).dot(U))
+        h_new = z[step] * h + (1. - z[step]) * h_tilde[step]
+        stepMask = mask[step][:, None]
+        hs[step + 1] = stepMask * h_new + (1. - stepMask) * h
+    return hs[1:], (X, W_all, hs, r, z, h_tilde)
+
+def gru_backward(params, layerIndex, dH, cache, mask, grads):
+    '''
+    Adds the gradients of the parameters of a GRU layer to grads given the
+    gradient dH of its hidden states, and returns the gradient of its inputs.
+    '''
+    X, W_all, hs, r, z, h_tilde = cache
+    U = params['U_' + layerIndex]
+    U_rz = np.concatenate([params['U_r_' + layerIndex], params['U_z_' + layerIndex]], axis=1)
+    n_steps, n_samples = mask.shape
+    hiddenSize = U.shape[0]
+    # the gradients of the pre-activations, stacked as W_all
+    dProjected = np.empty((n_steps, n_samples, 3 * hiddenSize), dtype=r.dtype)
+    dh = np.zeros_like(hs[0])
+    for step in reversed(range(n_steps)):
+        dh = dh + dH[step]
+        h = hs[step]
+        stepMask = mask[step][:, None]
+        dh_new = stepMask * dh
+        da_h = dh_new * (1. - z[step]) * (1. - h_tilde[step] ** 2)
+        drh = da_h.dot(U.T)
+        dPre = dProjected[step]
+        dPre[:, :hiddenSize] = da_h
+        dPre[:, hiddenSize:2 * hiddenSize] = drh * h * r[step] * (1. - r[step])
+        dPre[:, 2 * hiddenSize:] = dh_new * (h - h_tilde[step]) * z[step] * (1. - z[step])
+        dh = (1. - stepMask) * dh + dh_new * z[step] + drh * r[step] + dPre[:, hiddenSize:].dot(U_rz.T)
+
+    dFlat = flat(dProjected)
+    grads['U_' + layerIndex] = flat(r * hs[:-1]).T.dot(dFlat[:, :hiddenSize])
+    dU_rz = flat(hs[:-1]).T.dot(dFlat[:, hiddenSize:])
+    grads['U_r_' + layerIndex] = dU_rz[:, :hiddenSize]
+    grads['U_z_' + layerIndex] = dU_rz[:, hiddenSize:]
+    dW_all = flat(X).T.dot(dFlat)
+    db_all = dFlat.sum(axis=0)
+    for i, gate in enumerate(GATES):
+        grads['W_' + gate + layerIndex] = dW_all[:, i * hiddenSize:(i + 1) * hiddenSize]
+        grads['b_' + gate + layerIndex] = db_all[i * hiddenSize:(i + 1) * hiddenSize]
+    return dot3(dProjected, W_all.T)
+
+def cost_and_grads(params, inputs, options, W_emb=None, dropoutMasks=None, computeGrads=True):
+    '''
+    Returns the cost of build_model in doctor_ai.py for one padded batch and
+    the gradients of the parameters in params (None without computeGrads).
+    W_emb is the fixed embedding when it is not in params.  dropoutMasks
+    holds the kept units of every GRU layer while training, None to scale
+    by 0.5 as with use_noise off.
+    '''
+    x, y, t, t_label, mask, lengths = unpack_inputs(inputs, options)
+    logEps = options['logEps']
+    n_steps, n_samples = mask.shape
+    W_emb = params['W_emb'] if W_emb is None else W_emb
+
+    xs = sparse.csr_matrix(x.reshape(n_steps * n_samples, -1))
+    emb = np.tanh(xs.dot(W_emb).reshape(n_steps, n_samples, -1) + params['b_emb'])
+    inputVector = emb if t is None else np.concatenate([t[:, :, None], emb], axis=2)
+
+    layers = []
+    for i in range(len(options['hiddenDimSize'])):
+        hidden, cache = gru_forward(params, str(i), inputVector, mask)
+        keep = 0.5 if dropoutMasks is None else dropoutMasks[i]
+        layers.append((cache, keep))
+        inputVector = hidden * keep
+
+    probs = softmax(dot3(inputVector, params['W_output']) + params['b_output'])
+    results = probs * mask[:, :, None]
+    cross_entropy = -(y * np.log(results + logEps) + (1. - y) * np.log(1. - results + logEps))
+    cost = np.mean(cross_entropy.sum(axis=2).sum(axis=0) / lengths)\
+        + options['L2_output'] * (params['W_output'] ** 2).sum()
+    if options['predictTime']:
+        durationPre = dot3(inputVector, params['W_time']) + params['b_time']
+        duration = np.maximum(durationPre, 0).reshape(n_steps, n_samples) * mask
+        cost += options['tradeoff'] * np.mean(0.5 * ((duration - t_label) ** 2).sum(axis=0) / lengths)\
+            + options['L2_time'] * (params['W_time'] ** 2).sum()
+    if not computeGrads:
+        return cost, None
+
+    grads = OrderedDict()
+    flatOutput = inputVector.reshape(n_steps * n_samples, -1)
+    # every sample's loss is divided by its length and averaged over samples
+    weight = (1. / (n_samples * lengths))[None, :, None]
+    dResults = -(y / (results + logEps) - (1. - y) / (1. - results + logEps)) * weight * mask[:, :, None]
+    dLogits = probs * (dResults - (dResults * probs).sum(axis=2, keepdims=True))
+    grads['W_output'] = flatOutput.T.dot(dLogits.reshape(n_steps * n_samples, -1))\
+        + 2. * options['L2_output'] * params['W_output']
+    grads['b_output'] = dLogits.sum(axis=(0, 1))
+    dInput = dot3(dLogits, params['W_output'].T)
+    if options['predictTime']:
+        dDuration = options['tradeoff'] * (duration - t_label) / (n_samples * lengths)[None, :]
+        dDurationPre = (dDuration * mask * (durationPre[:, :, 0] > 0))[:, :, None]
+        grads['W_time'] = flatOutput.T.dot(dDurationPre.reshape(-1, 1))\
+            + 2. * options['L2_time'] * params['W_time']
+        grads['b_time'] = dDurationPre.sum(axis=(0, 1))
+        dInput += dot3(dDurationPre, params['W_time'].T)
+
+    for i in reversed(range(len(layers))):
+        cache, keep = layers[i]
+        dInput = gru_backward(params, str(i), dInput * keep, cache, mask, grads)
+
+    if t is not None:
+        dInput = dInput[:, :, 1:]
+    dEmbPre = (dInput * (1. - emb ** 2)).reshape(n_steps * n_samples, -1)
+    grads['b_emb'] = dEmbPre.sum(axis=0)
+    if 'W_emb' in params:
+        grads['W_emb'] = np.asarray(xs.T.dot(dEmbPre))
+    return cost, OrderedDict((key, grads[key].astype(params[key].dtype, copy=False)) for key in params)
+
+def init_shared_params(params, options):
+    '''
+    Returns the trained parameters as SharedArrays, as init_tparams in
+    doctor_ai.py does with theano.shared.
+    '''
+    return OrderedDict((key, SharedArray(value, key)) for key, value in params.items()\
+        if options['embFineTune'] or key != 'W_emb')
+
+def build_test_model(tparams, options, W_emb=None):
+    '''
+    Returns the cost of the padded inputs without dropout, as the test_model
+    of train_doctorAI.
+    '''
+    def test_model(*inputs):
+        params = OrderedDict((key, p.get_value(borrow=True)) for key, p in tparams.items())
+        cost, _ = cost_and_grads(params, inputs, options, W_emb, computeGrads=False)
+        return cost
+    return test_model
+
+def build_functions(tparams, options, W_emb=None, seed=123):
+    '''
+    Returns use_noise, f_grad_shared and f_update with the interfaces of
+    the Theano functions of train_doctorAI, for the
+    SharedArray parameters in tparams.  The adadelta accumulators are left
+    in options['optimizerState'], as by adadelta in doctor_ai.py.
+    '''
+    if options.get('labelGroups') is not None or options.get('bpttWindow', 0) > 0:
+        raise ValueError('the numpy backend does not support label groups or truncated BPTT')
+    rng = np.random.RandomState(seed)
+    use_noise = SharedArray(np.float32(0.))
+    zipped_grads = OrderedDict((key, np.zeros_like(p.get_value(borrow=True))) for key, p in tparams.items())
+    running_up2 = [SharedArray(np.zeros_like(p.get_value(borrow=True)), f'{key}_rup2') for key, p in tparams.items()]
+    running_grads2 = [SharedArray(np.zeros_like(p.get_value(borrow=True)), f'{key}_rgrad2') for key, p in tparams.items()]
+    options['optimizerState'] = OrderedDict(\
+        [(rup2.name, rup2) for rup2 in running_up2] + [(rgrad2.name, rgrad2) for rgrad2 in running_grads2])
+    options['extraInputs'] = []
+    options['hiddenUpdates'] = []
+
+    def current_params():
+        return OrderedDict((key, p.get_value(borrow=True)) for key, p in tparams.items())
+
+    def f_grad_shared(*inputs):
+        dropoutMasks = None
+        if use_noise.get_value(borrow=True):
+            mask = inputs[-2]
+            dropoutMasks = [rng.binomial(1, options['dropout_rate'], size=mask.shape + (hiddenDimSize,)).astype(mask.dtype)\
+                for hiddenDimSize in options['hiddenDimSize']]
+        cost, grads = cost_and_grads(current_params(), inputs, options, W_emb, dropoutMasks)
+        for rg2, (key, grad) in zip(running_grads2, grads.items()):
+            zipped_grads[key] = grad
+            rg2.set_value(0.95 * rg2.get_value(borrow=True) + 0.05 * grad ** 2, borrow=True)
+        return cost
+
+    def f_update():
+        for (key, p), ru2, rg2 in zip(tparams.items(), running_up2, running_grads2):
+            updir = -np.sqrt(ru2.get_value(borrow=True) + 1e-6) / np.sqrt(rg2.get_value(borrow=True) + 1e-6) * zipped_grads[key]
+            ru2.set_value(0.95 * ru2.get_value(borrow=True) + 0.05 * updir ** 2, borrow=True)
+            p.set_value(p.get_value(borrow=True) + updir, borrow=True)
+
+    return use_noise, f_grad_shared, f_update
@@ -0,0 +1,290 @@
+'''This module stores a split of patients on disk indexed by subject id, so
+that any set of patients can be read without loading the rest of the split.
+
+A patient store is a directory of flat .npy arrays that are memory-mapped
+when opened:
+    - pids:            subject id of every patient (n_patients)
+    - pid_order:       argsort of pids, used to look patients up by id
+    - sorted_pids:     pids in pid_order, searched with a binary search
+    - patient_offsets: visit range of every patient (n_patients + 1)
+    - dates:           admission time of every visit (datetime64[s])
+    - visit_offsets:   code range of every visit (n_visits + 1)
+    - visit_codes:     visit (input) codes of all visits, concatenated
+    - label_offsets:   label range of every visit (n_visits + 1)
+    - label_codes:     label codes of all visits, concatenated
+
+Reading one patient touches two offsets and the few pages holding that
+patient's codes, so lookups stay fast however large the split is.
+
+process_mimic.py writes a store for every split (patients.<split>/).  With
+--shard_size it also writes each split as fixed-size shards (shards.<split>/),
+every shard being a patient store of its own; ShardedDataset streams them
+for training with bounded memory.  Splits that were processed before can be
+converted with:
+python patient_store.py pids.test.json seqs_visit.test.json seqs_label.test.json date.test.json patients.test
+'''
+
+import argparse
+from datetime import datetime
+import json
+import logging
+import os
+import random
+
+import numpy as np
+
+STORE_ARRAYS = (
+    'pids', 'pid_order', 'sorted_pids', 'patient_offsets', 'dates',
+    'visit_offsets', 'visit_codes', 'label_offsets', 'label_codes')
+SHARD_MANIFEST = 'shards.json'
+SHARD_FORMAT = 'shard-{:05d}'
+
+def lengths_to_offsets(lengths):
+    offsets = np.zeros(len(lengths) + 1, dtype=np.int64)
+    np.cumsum(lengths, out=offsets[1:])
+    return offsets
+
+def flatten_codes(visits, n_codes):
+    return np.fromiter((code for visit in visits for code in visit), dtype=np.int32, count=n_codes)
+
+def write_patient_store(store_dir, pids, seqs, labels, dates=None):
+    '''
+    Writes the patients of one split.  seqs and labels are the nested
+    [patient[visit[code, ...], ...], ...] lists of process_mimic.py, dates
+    the matching per visit datetimes (or ISO strings).
+    '''
+    os.makedirs(store_dir, exist_ok=True)
+    pids = np.asarray(pids, dtype=np.int64)
+    pid_order = np.argsort(pids, kind='stable')
+    patient_offsets = lengths_to_offsets([len(seq) for seq in seqs])
+    visits = [visit for seq in seqs for visit in seq]
+    label_visits = [visit for label in labels for visit in label]
+    visit_offsets = lengths_to_offsets([len(visit) for visit in visits])
+    label_offsets = lengths_to_offsets([len(visit) for visit in label_visits])
+
+    if dates is None:
+        flat_dates = np.full(len(visits), np.datetime64('NaT'), dtype='datetime64[s]')
+    else:
+        flat_dates = np.array([np.datetime64(date) for date_list in dates for date in date_list],\
+            dtype='datetime64[s]')
+
+    arrays = {
+        'pids': pids,
+        'pid_order': pid_order,
+        'sorted_pids': pids[pid_order],
+        'patient_offsets': patient_offsets,
+        'dates': flat_dates,
+        'visit_offsets': visit_offsets,
+        'visit_codes': flatten_codes(visits, visit_offsets[-1]),
+        'label_offsets': label_offsets,
+        'label_codes': flatten_codes(label_visits, label_offsets[-1])}
+    for name, array in arrays.items():
+        np.save(os.path.join(store_dir, name + '.npy'), array)
+    logging.debug("wrote %d patients, %d visits to %s", len(pids), len(visits), store_dir)
+
+def is_patient_store(path):
+    return os.path.isdir(path) and os.path.exists(os.path.join(path, 'patient_offsets.npy'))
+
+class PatientStore:
+    '''
+    Read access to a patient store by position or by subject id.
+    '''
+
+    def __init__(self, store_dir, mmap_mode='r'):
+        self.store_dir = store_dir
+        for name in STORE_ARRAYS:
+            setattr(self, name, np.load(os.path.join(store_dir, name + '.npy'), mmap_mode=mmap_mode))
+
+    def __len__(self):
+        return len(self.pids)
+
+    def index_of(self, pids):
+        '''
+        Returns the position of every subject id in the store, -1 if absent.
+        '''
+        pids = np.asarray(pids, dtype=np.int64)
+        if len(self.pids) == 0:
+            return np.full(pids.shape, -1, dtype=np.int64)
+        sorted_pids = self.sorted_pids
+        where = np.searchsorted(sorted_pids, pids)
+        where = np.minimum(where, len(sorted_pids) - 1)
+        found = sorted_pids[where] == pids
+        return np.where(found, self.pid_order[where], -1)
+
+    def _codes(self, offsets, codes, start, stop):
+        bounds = np.asarray(offsets[start:stop + 1])
+        flat = np.asarray(codes[bounds[0]:bounds[-1]]).tolist()
+        base = bounds[0]
+        return [flat[lo - base:hi - base] for lo, hi in zip(bounds[:-1].tolist(), bounds[1:].tolist())]
+
+    def patient(self, index):
+        '''
+        Returns (visit codes, label codes, dates) of the patient at a position.
+        '''
+        start, stop = (int(v) for v in self.patient_offsets[index:index + 2])
+        seq = self._codes(self.visit_offsets, self.visit_codes, start, stop)
+        label = self._codes(self.label_offsets, self.label_codes, start, stop)
+        return seq, label, np.asarray(self.dates[start:stop])
+
+    def patients(self, indices):
+        '''
+        Returns the seqs, labels and dates lists of several patients.
+        '''
+        seqs = []
+        labels = []
+        dates = []
+        for index in indices:
+            seq, label, date = self.patient(int(index))
+            seqs.append(seq)
+            labels.append(label)
+            dates.append(date)
+        return seqs, labels, dates
+
+    def iter_patients(self):
+        for index in range(len(self)):
+            yield self.patient(index)
+
+def write_shards(shards_dir, pids, seqs, labels, dates=None, shard_size=10000):
+    '''
+    Writes a split as consecutive patient stores of shard_size patients each
+    plus a shards.json manifest.
+    '''
+    os.makedirs(shards_dir, exist_ok=True)
+    n_shards = 0
+    for start in range(0, len(pids), shard_size):
+        stop = start + shard_size
+        write_patient_store(os.path.join(shards_dir, SHARD_FORMAT.format(n_shards)),\
+            pids[start:stop], seqs[start:stop], labels[start:stop],\
+            None if dates is None else dates[start:stop])
+        n_shards += 1
+    manifest = {'n_shards': n_shards, 'n_patients': len(pids), 'shard_size': shard_size}
+    with open(os.path.join(shards_dir, SHARD_MANIFEST), 'w', encoding='utf8') as outfile:
+        json.dump(manifest, outfile, indent=2)
+    logging.debug("wrote %d patients in %d shards to %s", len(pids), n_shards, shards_dir)
+
+def is_sharded_dataset(path):
+    return os.path.isdir(path) and os.path.exists(os.path.join(path, SHARD_MANIFEST))
+
+class ShardedDataset:
+    '''
+    Streams the patients of a sharded split.  Only one shard and one shuffle
+    buffer of patients are held in memory at a time.
+    '''
+
+    def __init__(self, shards_dir):
+        self.shards_dir = shards_dir
+        with open(os.path.join(shards_dir, SHARD_MANIFEST), 'r') as infile:
+            manifest = json.load(infile)
+        self.n_shards = manifest['n_shards']
+        self.n_patients = manifest['n_patients']
+
+    def __len__(self):
+        return self.n_patients
+
+    def shard(self, index):
+        return PatientStore(os.path.join(self.shards_dir, SHARD_FORMAT.format(index)), mmap_mode=None)
+
+    def visit_counts(self):
+        '''
+        Returns the number of visits of every patient, read from the shard
+        offsets only.
+        '''
+        counts = [np.diff(PatientStore(os.path.join(self.shards_dir, SHARD_FORMAT.format(index))).patient_offsets)\
+            for index in range(self.n_shards)]
+        return np.concatenate(counts) if counts else np.zeros(0, dtype=np.int64)
+
+    def iter_patients(self, shuffle=False, rng=random):
+        '''
+        Yields (visit codes, label codes) of every patient, shard by shard.
+        With shuffle, both the shard order and the patients within a shard
+        are permuted.
+        '''
+        shard_order = list(range(self.n_shards))
+        if shuffle:
+            rng.shuffle(shard_order)
+        for shard_index in shard_order:
+            store = self.shard(shard_index)
+            indices = list(range(len(store)))
+            if shuffle:
+                rng.shuffle(indices)
+            for index in indices:
+                seq, label, _ = store.patient(index)
+                yield seq, label
+
+    def iter_batches(self, batchSize, shuffle=False, bufferSize=10000, rng=random, plan=None):
+        '''
+        Yields (seqs, labels) batches.  Patients are collected into a buffer
+        of bufferSize, which is sorted by length and cut into batches, as
+        load_data does for a whole split, so padding stays small; with
+        shuffle the batches of a buffer are emitted in random order.  A
+        plan (memory_planner.BatchPlan) caps the batch size of long patients.
+        '''
+        buffer = []
+        for patient in self.iter_patients(shuffle, rng):
+            buffer.append(patient)
+            if len(buffer) >= bufferSize:
+                for batch in self._buffer_batches(buffer, batchSize, shuffle, rng, plan):
+                    yield batch
+                buffer = []
+        for batch in self._buffer_batches(buffer, batchSize, shuffle, rng, plan):
+            yield batch
+
+    def _buffer_batches(self, buffer, batchSize, shuffle, rng, plan):
+        buffer.sort(key=lambda patient: len(patient[0]))
+        if plan is None:
+            bounds = [(start, start + batchSize) for start in range(0, len(buffer), batchSize)]
+        else:
+            bounds = plan.bounds([len(patient[0]) for patient in buffer])
+        batches = [buffer[start:stop] for start, stop in bounds]
+        if shuffle:
+            rng.shuffle(batches)
+        for batch in batches:
+            yield [patient[0] for patient in batch], [patient[1] for patient in batch]
+
+def parse_arguments(parser):
+    parser.add_argument(\
+        'pid_file',
+        type=str,
+        help='The path to the JSON patient id file from process_mimic.py.')
+    parser.add_argument(\
+        'seq_file',
+        type=str,
+        help='The path to the JSON visit file from process_mimic.py.')
+    parser.add_argument(\
+        'label_file',
+        type=str,
+        help='The path to the JSON label file from process_mimic.py.')
+    parser.add_argument(\
+        'date_file',
+        type=str,
+        help='The path to the JSON date file from process_mimic.py.')
+    parser.add_argument(\
+        'store_dir',
+        type=str,
+        help='The output directory of the patient store.')
+    parser.add_argument('-v', '--verbose', action='store_true',\
+        help='Show verbose output.')
+    args = parser.parse_args()
+    return args
+
+def main():
+    parser = argparse.ArgumentParser()
+    args = parse_arguments(parser)
+    if args.verbose:
+        logging.basicConfig(level=logging.DEBUG)
+    else:
+        logging.basicConfig(level=logging.INFO)
+
+    with open(args.pid_file, 'r') as infile:
+        pids = json.load(infile)
+    with open(args.seq_file, 'r') as infile:
+        seqs = json.load(infile)
+    with open(args.label_file, 'r') as infile:
+        labels = json.load(infile)
+    with open(args.date_file, 'r') as infile:
+        dates = [[datetime.fromisoformat(date) for date in date_list] for date_list in json.load(infile)]
+    write_patient_store(args.store_dir, pids, seqs, labels, dates)
+    logging.info("wrote %d patients to %s", len(pids), args.store_dir)
+
+if __name__ == '__main__':
+    main()
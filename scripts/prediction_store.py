@@ -0,0 +1,128 @@
+'''This module reads and writes the columnar prediction files of
+test_doctor_ai.py.
+
+A prediction store is a directory holding one uncompressed .npz part per
+scored batch plus a small meta.json manifest.  Each part stores one row per
+scored visit in the following columns:
+    - pid:            patient id (subject id if a pid file was given,
+                      otherwise the patient's position in the split)
+    - visit:          index of the visit whose successor is predicted
+    - codes:          top-k predicted label ids, best first (n x k)
+    - probs:          the matching predicted probabilities (n x k)
+    - actual_codes:   label ids observed in the next visit, concatenated
+    - actual_offsets: row boundaries into actual_codes (n + 1)
+    - duration:       predicted duration until the next visit (optional)
+
+Parts are written as batches are scored and read back one at a time, so
+neither side holds the full prediction set in memory.
+'''
+
+import json
+import logging
+import os
+
+import numpy as np
+
+META_FILE = 'meta.json'
+PART_FORMAT = 'part-{:05d}.npz'
+
+class PredictionWriter:
+    '''
+    Appends scored batches to a prediction store directory.
+    '''
+
+    def __init__(self, out_dir, topk):
+        os.makedirs(out_dir, exist_ok=True)
+        self.out_dir = out_dir
+        self.topk = topk
+        self.n_parts = 0
+        self.n_rows = 0
+        self.has_duration = False
+
+    def write(self, pids, visits, codes, probs, actuals, durations=None):
+        '''
+        Writes one part.  actuals is a list with the observed label ids of
+        each row.
+        '''
+        lengths = [len(actual) for actual in actuals]
+        offsets = np.zeros(len(actuals) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=offsets[1:])
+        columns = {
+            'pid': np.asarray(pids, dtype=np.int64),
+            'visit': np.asarray(visits, dtype=np.int32),
+            'codes': np.asarray(codes, dtype=np.int32),
+            'probs': np.asarray(probs, dtype=np.float32),
+            'actual_codes': np.fromiter(\
+                (code for actual in actuals for code in actual), dtype=np.int32, count=offsets[-1]),
+            'actual_offsets': offsets}
+        if durations is not None:
+            columns['duration'] = np.asarray(durations, dtype=np.float32)
+            self.has_duration = True
+        np.savez(os.path.join(self.out_dir, PART_FORMAT.format(self.n_parts)), **columns)
+        self.n_parts += 1
+        self.n_rows += len(actuals)
+
+    def close(self):
+        meta = {
+            'topk': self.topk,
+            'n_parts': self.n_parts,
+            'n_rows': self.n_rows,
+            'has_duration': self.has_duration}
+        with open(os.path.join(self.out_dir, META_FILE), 'w', encoding='utf8') as outfile:
+            json.dump(meta, outfile, indent=2)
+        logging.debug("wrote %d rows in %d parts to %s", self.n_rows, self.n_parts, self.out_dir)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+def merge_stores(store_dirs, out_dir):
+    '''
+    Moves the parts of several stores, in the given order, into one store
+    at out_dir and removes the emptied stores.  Returns the merged meta.
+    '''
+    os.makedirs(out_dir, exist_ok=True)
+    merged = {'topk': None, 'n_parts': 0, 'n_rows': 0, 'has_duration': False}
+    for store_dir in store_dirs:
+        meta = load_meta(store_dir)
+        merged['topk'] = meta['topk']
+        merged['has_duration'] = merged['has_duration'] or meta['has_duration']
+        for index in range(meta['n_parts']):
+            os.replace(os.path.join(store_dir, PART_FORMAT.format(index)),\
+                os.path.join(out_dir, PART_FORMAT.format(merged['n_parts'])))
+            merged['n_parts'] += 1
+        merged['n_rows'] += meta['n_rows']
+        os.remove(os.path.join(store_dir, META_FILE))
+        os.rmdir(store_dir)
+    with open(os.path.join(out_dir, META_FILE), 'w', encoding='utf8') as outfile:
+        json.dump(merged, outfile, indent=2)
+    logging.debug("merged %d stores into %s", len(store_dirs), out_dir)
+    return merged
+
+def is_prediction_store(path):
+    return os.path.isdir(path) and os.path.exists(os.path.join(path, META_FILE))
+
+def load_meta(store_dir):
+    with open(os.path.join(store_dir, META_FILE), 'r') as infile:
+        return json.load(infile)
+
+def iter_parts(store_dir):
+    '''
+    Yields the parts of a store in order.  Columns of a part are only read
+    from disk when accessed.
+    '''
+    meta = load_meta(store_dir)
+    for index in range(meta['n_parts']):
+        with np.load(os.path.join(store_dir, PART_FORMAT.format(index))) as part:
+            yield part
+
+def split_actuals(part):
+    '''
+    Returns the observed label ids of a part as one array per row.
+    '''
+    offsets = part['actual_offsets']
+    if len(offsets) < 2:
+        return []
+    return np.split(part['actual_codes'], offsets[1:-1])
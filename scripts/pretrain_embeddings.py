@@ -0,0 +1,164 @@
+'''This module pretrains code embeddings for doctor_ai.py --embed_file from
+the co-occurrence of codes in the training visits.
+
+Two codes co-occur when they are in the same visit, or in two consecutive
+visits of a patient (weighted by --adjacent_weight).  The co-occurrence
+counts are kept in a sparse matrix, turned into positive pointwise mutual
+information (PPMI) with context distribution smoothing, and factorized with
+a truncated SVD; the code vectors are the left singular vectors scaled by
+the square root of the singular values, normalized to unit length.  Codes
+that never occur get zero vectors.
+
+All steps are sparse matrix operations: the visits are a sparse
+visit x code matrix V, the within-visit counts are V^T V and the
+adjacent-visit counts V[visit]^T V[next visit].
+
+inputs:
+    - visit file of the training split (seqs_visit.train.json) or its
+      patient store (patients.train/) from process_mimic.py
+    - number of unique codes in visit codes
+    - output file name (.npy, .bin for raw float32 values, or .json)
+
+outputs:
+    - (n_codes, embed_size) embedding matrix that doctor_ai.py loads with
+      --embed_file
+'''
+
+import argparse
+import json
+import logging
+
+import numpy as np
+from scipy import sparse
+from scipy.sparse.linalg import svds
+
+from patient_store import PatientStore, is_patient_store, lengths_to_offsets
+
+def load_visits(visit_file):
+    '''
+    Returns the (patient_offsets, visit_offsets, visit_codes) arrays of a
+    JSON visit file or a patient store.
+    '''
+    if is_patient_store(visit_file):
+        store = PatientStore(visit_file)
+        return np.asarray(store.patient_offsets), np.asarray(store.visit_offsets), np.asarray(store.visit_codes)
+    with open(visit_file, 'r') as infile:
+        seqs = json.load(infile)
+    patient_offsets = lengths_to_offsets([len(seq) for seq in seqs])
+    visit_offsets = lengths_to_offsets([len(visit) for seq in seqs for visit in seq])
+    visit_codes = np.fromiter((code for seq in seqs for visit in seq for code in visit),\
+        dtype=np.int64, count=visit_offsets[-1])
+    return patient_offsets, visit_offsets, visit_codes
+
+def cooccurrence_matrix(patient_offsets, visit_offsets, visit_codes, n_codes, adjacent_weight=0.5):
+    '''
+    Returns the symmetric sparse (n_codes, n_codes) co-occurrence counts.
+    '''
+    n_visits = len(visit_offsets) - 1
+    rows = np.repeat(np.arange(n_visits), np.diff(visit_offsets))
+    visits = sparse.csr_matrix((np.ones(len(visit_codes), dtype=np.float64), (rows, visit_codes)),\
+        shape=(n_visits, n_codes))
+    # a code listed twice in a visit counts once
+    visits.sum_duplicates()
+    visits.data[:] = 1.
+
+    counts = (visits.T @ visits).tolil()
+    counts.setdiag(0)
+    counts = counts.tocsr()
+    if adjacent_weight > 0:
+        last_visits = patient_offsets[1:] - 1
+        current = np.setdiff1d(np.arange(n_visits), last_visits)
+        adjacent = visits[current].T @ visits[current + 1]
+        counts = counts + adjacent_weight * (adjacent + adjacent.T)
+    counts.eliminate_zeros()
+    return counts
+
+def ppmi_matrix(counts, smoothing=0.75):
+    '''
+    Returns the positive pointwise mutual information of sparse counts, with
+    the context counts raised to the power smoothing.
+    '''
+    counts = counts.tocoo()
+    row_sums = np.asarray(counts.sum(axis=1)).ravel()
+    context = np.asarray(counts.sum(axis=0)).ravel() ** smoothing
+    pmi = np.log(counts.data * context.sum() / (row_sums[counts.row] * context[counts.col]))
+    keep = pmi > 0
+    return sparse.csr_matrix((pmi[keep], (counts.row[keep], counts.col[keep])), shape=counts.shape)
+
+def factorize(ppmi, embed_size, seed=12345):
+    '''
+    Returns unit-length (n_codes, embed_size) code vectors from a truncated
+    SVD of the PPMI matrix.
+    '''
+    k = min(embed_size, min(ppmi.shape) - 1)
+    v0 = np.random.RandomState(seed).uniform(-1, 1, min(ppmi.shape))
+    left, values, _ = svds(ppmi, k=k, v0=v0)
+    vectors = np.zeros((ppmi.shape[0], embed_size), dtype=np.float32)
+    vectors[:, :k] = left[:, ::-1] * np.sqrt(values[::-1])
+    norms = np.linalg.norm(vectors, axis=1)
+    nonzero = norms > 0
+    vectors[nonzero] /= norms[nonzero, None]
+    return vectors
+
+def write_embedding(vectors, out_file):
+    if out_file.endswith('.json'):
+        with open(out_file, 'w', encoding='utf8') as outfile:
+            json.dump(vectors.tolist(), outfile)
+    elif out_file.endswith('.bin') or out_file.endswith('.raw'):
+        vectors.astype(np.float32).tofile(out_file)
+    else:
+        np.save(out_file, vectors)
+
+def parse_arguments(parser):
+    parser.add_argument(\
+        'visit_file',
+        type=str,
+        help='The path to the training visit file (seqs_visit.train.json) or patient store (patients.train/) from process_mimic.py.')
+    parser.add_argument(\
+        'n_input_codes',
+        type=int,
+        help='The number of unique input medical codes.')
+    parser.add_argument(\
+        'out_file',
+        type=str,
+        help='The path to the embedding file: .npy, .bin (raw float32) or .json.')
+    parser.add_argument(\
+        '--embed_size',
+        type=int,
+        default=200,
+        help='The size of the code vectors (default value: 200)')
+    parser.add_argument(\
+        '--adjacent_weight',
+        type=float,
+        default=0.5,
+        help='The weight of a co-occurrence in consecutive visits relative to one within a visit, 0 for within-visit only (default value: 0.5)')
+    parser.add_argument(\
+        '--smoothing',
+        type=float,
+        default=0.75,
+        help='The power the context counts are raised to in the PPMI (default value: 0.75)')
+    parser.add_argument('-v', '--verbose', action='store_true',\
+        help='Show verbose output.')
+    args = parser.parse_args()
+    return args
+
+def main():
+    parser = argparse.ArgumentParser()
+    args = parse_arguments(parser)
+    if args.verbose:
+        logging.basicConfig(level=logging.DEBUG)
+    else:
+        logging.basicConfig(level=logging.INFO)
+
+    patient_offsets, visit_offsets, visit_codes = load_visits(args.visit_file)
+    logging.info("read %d patients, %d visits", len(patient_offsets) - 1, len(visit_offsets) - 1)
+    counts = cooccurrence_matrix(patient_offsets, visit_offsets, visit_codes, args.n_input_codes,\
+        args.adjacent_weight)
+    ppmi = ppmi_matrix(counts, args.smoothing)
+    logging.info("%d co-occurring code pairs, %d with positive PMI", counts.nnz, ppmi.nnz)
+    vectors = factorize(ppmi, args.embed_size)
+    write_embedding(vectors, args.out_file)
+    logging.info("wrote %d x %d code vectors to %s", vectors.shape[0], vectors.shape[1], args.out_file)
+
+if __name__ == '__main__':
+    main()
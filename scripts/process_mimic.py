@@ -21,6 +21,21 @@ python process_mimic.py ADMISSIONS.csv DIAGNOSES_ICD.csv <output file>
                          each visit
     -<output file>.types: Python dictionary that maps string diagnosis codes to
                           integer diagnosis codes.
+    -patients.<split>/: binary patient store of each split indexed by patient id,
+                        see patient_store.py
+    -shards.<split>/: (with --shard_size) each split as fixed-size shards for
+                      streaming training
+    -vocab/: binary code vocabulary with dense tables between visit ids, label
+             ids, ICD9 codes, CCS codes and descriptions (see code_vocab.py)
+    -code_map.json: (with --min_code_count) the visit code that stands in for
+                    every code seen fewer than min_code_count times, also
+                    recorded in vocab/
+
+With --previous_dir, the visit and label ids of an earlier run are kept and
+the codes seen since are appended after them, and the patients of the
+earlier run stay in their split; only new patients are split at random.
+Models trained on the earlier run can then continue training on the new
+data (doctor_ai.py --init_model).
 
 # Edited 2/6/2020 Eliot Bethke
 # -updated print syntax to python3 compat
@@ -34,13 +49,18 @@ python process_mimic.py ADMISSIONS.csv DIAGNOSES_ICD.csv <output file>
 '''
 
 import argparse
+from collections import Counter
 from datetime import datetime
 import json
 import logging
 import os
+import zlib
 
 import numpy as np
 
+from code_vocab import CodeVocabulary, label_key_to_ccs
+from patient_store import write_patient_store, write_shards
+
 def json_encoder(obj):
     return_val = None
     if isinstance(obj, np.integer):
@@ -83,10 +103,156 @@ def convert_to_3digit_icd9(dx_str):
             return_val = dx_str
     return return_val
 
-def process(admission_file, diagnosis_file, ccs_map_file, out_dir):
-    # load in dictionary with ccs code keys and ICD9 code values
-    with open(ccs_map_file, 'r') as ccs_icd_file:
-        icd_ccs_dx = json.load(ccs_icd_file)
+def load_ccs_vocabulary(ccs_map_file):
+    '''
+    Loads the ICD9 to CCS mapping, either from the binary vocabulary
+    directory or from the JSON file written by create_ccs_dict.py.  The
+    matching _text.json file is picked up if it sits next to the JSON file.
+    '''
+    if os.path.isdir(ccs_map_file):
+        return CodeVocabulary.load(ccs_map_file, mmap_mode=None)
+    ccs_text_file = os.path.splitext(ccs_map_file)[0] + '_text.json'
+    if not os.path.exists(ccs_text_file):
+        ccs_text_file = ''
+    return CodeVocabulary.from_json_files(ccs_map_file=ccs_map_file, ccs_text_file=ccs_text_file)
+
+def prune_codes(seqs, min_count, rare_codes='parent', hash_buckets=100):
+    '''
+    Returns a dictionary from every ICD9 code seen fewer than min_count times
+    to the visit code used in its place: its 3-digit parent code, or with
+    rare_codes='hash' one of hash_buckets shared codes.
+    '''
+    counts = Counter(code for patient in seqs for visit in patient for code in visit)
+    code_map = {}
+    for code, count in counts.items():
+        if count >= min_count:
+            continue
+        if rare_codes == 'hash':
+            # crc32 rather than hash(), which is salted per process
+            code_map[code] = 'H_' + str(zlib.crc32(code.encode('utf8')) % hash_buckets)
+        else:
+            code_map[code] = 'D_' + convert_to_3digit_icd9(code[2:].replace('.', ''))
+    return code_map
+
+def map_codes(seqs, ccs_vocab, code_map=None, previous=None):
+    '''
+    Converts the string ICD9 codes of every visit to integer visit codes and
+    integer CCS label codes.  Returns the code dictionaries and both
+    sequences.  Codes in code_map get the visit code of their replacement,
+    but keep their own CCS label.  previous optionally holds the
+    dictionaries of an earlier run (see load_previous_types), whose ids are
+    kept; new codes get the ids after them.
+    '''
+    if code_map is None:
+        code_map = {}
+    if previous is None:
+        types, ccs_types, visit_ccs = {}, {}, {}
+    else:
+        types, ccs_types, visit_ccs = (dict(previous[name]) for name in ('types', 'ccs_types', 'visit_ccs'))
+    code_ccs = {}
+    new_seqs = []
+    lab_seqs = []
+    # patient level (list of lists)
+    for patient in seqs:
+        # create blank patient list
+        new_patient = []
+        ccs_patient = []
+        # visit level (list of ints)
+        for visit in patient:
+            # create blank visit list
+            new_visit = []
+            ccs_visit = []
+            # code level (int)
+            for code in visit:
+                # keep track of codes we've seen
+                if code in code_ccs:
+                    ccs_code = code_ccs[code]
+                # if new code, add to dict to keep track
+                else:
+                    # translate a D_###.## ICD9 code to ### CCS code
+                    ccs_code = ccs_vocab.icd_to_ccs(code[2:].replace('.', ''))
+                    if ccs_code < 0:
+                        logging.info('Could not find code %s in CCS dict.', code)
+                        ccs_code = code
+                    code_ccs[code] = ccs_code
+                visit_code = code_map.get(code, code)
+                if visit_code not in types:
+                    types[visit_code] = len(types)
+                    visit_ccs[visit_code] = ccs_code
+                # rare codes of one visit may share their replacement
+                if visit_code == code or types[visit_code] not in new_visit:
+                    new_visit.append(types[visit_code])
+                if ccs_code not in ccs_types:
+                    ccs_types[ccs_code] = len(ccs_types)
+                ccs_visit.append(ccs_types[ccs_code])
+            # add visit list to patient
+            new_patient.append(new_visit)
+            ccs_patient.append(ccs_visit)
+        # add patient to list of all patients
+        new_seqs.append(new_patient)
+        lab_seqs.append(ccs_patient)
+    return types, ccs_types, visit_ccs, new_seqs, lab_seqs
+
+def label_key(key):
+    '''
+    Returns the label key of a label code string of the vocabulary: the
+    CCS category as an int, or the ICD9 string of codes without one.
+    '''
+    ccs = label_key_to_ccs(key)
+    return ccs if ccs >= 0 else key
+
+def load_previous_types(previous_dir):
+    '''
+    Returns the code dictionaries, rare code replacements and patient splits
+    written by an earlier run to previous_dir.
+    '''
+    vocab = CodeVocabulary.load(os.path.join(previous_dir, 'vocab'), mmap_mode=None)
+    visit_codes = vocab.visit_codes.tolist()
+    label_codes = vocab.label_codes.tolist()
+    previous = {
+        'types': {code: index for index, code in enumerate(visit_codes)},
+        'ccs_types': {label_key(key): index for index, key in enumerate(label_codes)},
+        'visit_ccs': {code: label_codes[label] if label >= 0 else ''\
+            for code, label in zip(visit_codes, vocab.visit_labels.tolist())},
+        'code_map': {code: visit_codes[index] for code, index in\
+            zip(vocab.raw_codes.tolist(), vocab.raw_visit_ids.tolist())},
+        'splits': {}}
+    for split in ('train', 'valid', 'test'):
+        with open(os.path.join(previous_dir, 'pids.' + split + '.json'), 'r') as infile:
+            previous['splits'][split] = json.load(infile)
+    return previous
+
+def split_indices(pids, previous_splits=None):
+    '''
+    Returns the indices of the train, valid and test patients: a random
+    60/20/20 split, or with previous_splits the patients of every earlier
+    split in their earlier order followed by a random 60/20/20 split of the
+    new patients.
+    '''
+    kept = {split: [] for split in ('train', 'valid', 'test')}
+    new = list(range(len(pids)))
+    if previous_splits is not None:
+        index = {pid: i for i, pid in enumerate(pids)}
+        for split in kept:
+            kept[split] = [index[pid] for pid in previous_splits[split] if pid in index]
+        known = set(i for split in kept.values() for i in split)
+        new = [i for i in new if i not in known]
+
+    # get random permutation of pids
+    np.random.seed(12345)
+    indices = np.array(new, dtype=np.int64)[np.random.permutation(len(new))]
+    # split into three groups approximately 60%, 20%, 20%
+    ind_train = len(new)*3//5
+    ind_valid = ind_train + (len(new) - ind_train)//2
+    # test is whatever is left (through to end of list)
+    return (np.concatenate([np.array(kept['train'], dtype=np.int64), indices[:ind_train]]),\
+        np.concatenate([np.array(kept['valid'], dtype=np.int64), indices[ind_train:ind_valid]]),\
+        np.concatenate([np.array(kept['test'], dtype=np.int64), indices[ind_valid:]]))
+
+def process(admission_file, diagnosis_file, ccs_map_file, out_dir, shard_size=0,\
+    min_code_count=0, rare_codes='parent', hash_buckets=100, previous_dir=''):
+    # load in ICD9 -> ccs code lookup table
+    ccs_vocab = load_ccs_vocabulary(ccs_map_file)
     logging.debug("Loaded ccs file containing icd9 codes.")
 
     logging.info('Building pid-admission mapping, admission-date mapping')
@@ -144,62 +310,27 @@ def process(admission_file, diagnosis_file, ccs_map_file, out_dir):
         dates.append(date)
         seqs.append(seq)
 
-    logging.info('Converting strSeqs to intSeqs, and making types')
-    types = {}
-    ccs_types = {}
-    new_seqs = []
-    lab_seqs = []
-    # patient level (list of lists)
-    for patient in seqs:
-        # create blank patient list
-        new_patient = []
-        ccs_patient = []
-        # visit level (list of ints)
-        for visit in patient:
-            # create blank visit list
-            new_visit = []
-            ccs_visit = []
-            # code level (int)
-            for code in visit:
-                # translate a D_###.## ICD9 code to ### CCS code
-                ccs_code = [int(k) for k, v in icd_ccs_dx.items()
-                            if code[2:].replace('.', '') in v]
-                if not ccs_code:
-                    logging.info('Could not find code %s in CCS dict.', code)
-                    ccs_code = code
-                else:
-                    ccs_code = ccs_code[0]
+    previous = None
+    if previous_dir:
+        previous = load_previous_types(previous_dir)
+        logging.info('Keeping the %d visit codes, %d label codes and %d patients of %s', len(previous['types']),\
+            len(previous['ccs_types']), sum(len(split) for split in previous['splits'].values()), previous_dir)
+
+    code_map = {}
+    if min_code_count > 1:
+        code_map = prune_codes(seqs, min_code_count, rare_codes, hash_buckets)
+        logging.info('Replacing %d codes seen fewer than %d times', len(code_map), min_code_count)
+    if previous is not None:
+        # codes keep the visit id they had, whether their own or a replacement
+        code_map = {code: visit_code for code, visit_code in code_map.items() if code not in previous['types']}
+        code_map.update(previous['code_map'])
 
-                # keep track of codes we've seen
-                if code in types:
-                    new_visit.append(types[code])
-                # if new code, add to dict to keep track
-                else:
-                    types[code] = len(types)
-                    new_visit.append(types[code])
-                if ccs_code not in ccs_types:
-                    ccs_types[ccs_code] = len(ccs_types)
-                ccs_visit.append(ccs_types[ccs_code])
-            # add visit list to patient
-            new_patient.append(new_visit)
-            ccs_patient.append(ccs_visit)
-        # add patient to list of all patients
-        new_seqs.append(new_patient)
-        lab_seqs.append(ccs_patient)
+    logging.info('Converting strSeqs to intSeqs, and making types')
+    types, ccs_types, visit_ccs, new_seqs, lab_seqs = map_codes(seqs, ccs_vocab, code_map, previous)
 
     ### seqs = [patient[visit[], visit[]...], patient[visit[]...]]
-    # get random permutation of pids
-    np.random.seed(12345)
-    indices = np.random.permutation(len(pids))
-    # split into three groups approximately 60%, 20%, 20%
-    ind_train = len(pids)*3//5
-    ind_valid = ind_train + (len(pids) - ind_train)//2
-    # test is whatever is left (through to end of list)
-
     # get indices for each group
-    train = indices[:ind_train]
-    valid = indices[ind_train:ind_valid]
-    tests = indices[ind_valid:]
+    train, valid, tests = split_indices(pids, None if previous is None else previous['splits'])
 
     # get broken out lists of pids
     pids_arr = np.array(pids)
@@ -238,6 +369,11 @@ def process(admission_file, diagnosis_file, ccs_map_file, out_dir):
     with open(os.path.join(out_dir, 'label_types.json'), 'w', encoding='utf8') as outfile:
         json.dump(ccs_types, outfile, indent=2, default=json_encoder)
     logging.info("# visit codes: %d, # label codes: %d", len(types), len(ccs_types))
+    vocab = ccs_vocab.with_types(types, ccs_types, visit_ccs, code_map)
+    vocab.save(os.path.join(out_dir, 'vocab'))
+    if code_map:
+        with open(os.path.join(out_dir, 'code_map.json'), 'w', encoding='utf8') as outfile:
+            json.dump(code_map, outfile, indent=2)
 
     with open(os.path.join(out_dir, 'pids.train.json'), 'w', encoding='utf8') as outfile:
         json.dump(tr_pids, outfile, indent=2, default=json_encoder)
@@ -267,6 +403,16 @@ def process(admission_file, diagnosis_file, ccs_map_file, out_dir):
     with open(os.path.join(out_dir, 'seqs_label.test.json'), 'w', encoding='utf8') as outfile:
         json.dump(te_labl, outfile, indent=2, default=json_encoder)
 
+    # indexed binary copy of every split for random access by patient id
+    for split, split_index in (('train', train), ('valid', valid), ('test', tests)):
+        write_patient_store(os.path.join(out_dir, 'patients.' + split),\
+            [pids[i] for i in split_index], [new_seqs[i] for i in split_index],\
+            [lab_seqs[i] for i in split_index], [dates[i] for i in split_index])
+        if shard_size > 0:
+            write_shards(os.path.join(out_dir, 'shards.' + split),\
+                [pids[i] for i in split_index], [new_seqs[i] for i in split_index],\
+                [lab_seqs[i] for i in split_index], [dates[i] for i in split_index], shard_size)
+
 def parse_arguments(parser):
     parser.add_argument(\
         'admission_file',
@@ -279,11 +425,37 @@ def parse_arguments(parser):
     parser.add_argument(\
         'ccs_map_file',
         type=str,
-        help='The path to the mapping from ICD to CCS codes in JSON format.')
+        help='The path to the mapping from ICD to CCS codes in JSON format, or to the binary vocabulary directory written by create_ccs_dict.py.')
     parser.add_argument(\
         'out_dir',
         type=str,
         help='The path to the output directory.')
+    parser.add_argument(\
+        '--shard_size',
+        type=int,
+        default=0,
+        help='If set, also write every split as shards of this many patients (shards.<split>/) for out-of-core training with doctor_ai.py.')
+    parser.add_argument(\
+        '--min_code_count',
+        type=int,
+        default=0,
+        help='If set, ICD9 codes seen fewer than this many times do not get a visit code of their own, see --rare_codes. Their CCS labels are kept.')
+    parser.add_argument(\
+        '--rare_codes',
+        type=str,
+        default='parent',
+        choices=['parent', 'hash'],
+        help='What rare codes are replaced with: their 3-digit ICD9 parent code, or one of --hash_buckets shared codes (default value: parent)')
+    parser.add_argument(\
+        '--hash_buckets',
+        type=int,
+        default=100,
+        help='The number of shared codes for --rare_codes hash (default value: 100)')
+    parser.add_argument(\
+        '--previous_dir',
+        type=str,
+        default='',
+        help='The output directory of an earlier run.  Its visit and label ids are kept and new codes are appended after them, and its patients stay in their split, so that models trained on it can continue training on the new data.')
     parser.add_argument('-v', '--verbose', action='store_true',\
         help='Show verbose output.')
     args = parser.parse_args()
@@ -298,7 +470,8 @@ def main():
     else:
         logging.basicConfig(level=logging.INFO)
 
-    process(args.admission_file, args.diagnosis_file, args.ccs_map_file, args.out_dir)
+    process(args.admission_file, args.diagnosis_file, args.ccs_map_file, args.out_dir,\
+        args.shard_size, args.min_code_count, args.rare_codes, args.hash_buckets, args.previous_dir)
 
 if __name__ == '__main__':
     main()
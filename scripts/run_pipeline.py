@@ -0,0 +1,422 @@
+'''This module runs the pipeline of the README as one command:
+    create_ccs_dict -> process_mimic -> doctor_ai -> test_doctor_ai ->
+    translate_codes_to_text
+
+Every stage declares its input and output files and runs its script as a
+child process, as in scale_harness.py.  A stage is skipped when its outputs
+are current: the key of a stage is a hash of its command line, of the
+source of its script and of the sibling modules the script imports, and of
+the contents of its input files.  The key and the hashes of the outputs are
+recorded in <out_dir>/pipeline_state.json after the stage succeeds, and
+the stage runs again only if its key changed or its outputs are missing or
+were changed since.  Iterating on the model therefore reruns training and
+the stages after it, but not the preprocessing; a stage whose rerun
+produces the same outputs as before does not make the later stages run
+again either.
+
+Stages whose dependencies have finished run concurrently, up to --jobs at
+a time (the CCS procedure mapping, for instance, does not wait for
+process_mimic).  A stage depends on the stages that declare one of its
+inputs as an output.  Training and scoring read the patient stores
+(patients.<split>/) instead of the JSON splits, so they do not parse the
+JSON written by process_mimic.py.
+
+inputs:
+    - MIMIC-III admissions and diagnoses csv files.
+    - Single Level diagnosis file from CCS (dxref2015.csv), and optionally
+      the procedure file (prref2015.csv).
+    - output directory.
+
+outputs:
+    - <out_dir>/ccs/:        create_ccs_dict.py outputs
+    - <out_dir>/mimic/:      process_mimic.py outputs
+    - <out_dir>/model/:      doctor_ai.py checkpoints
+    - <out_dir>/predictions.test/: test split predictions (prediction store)
+    - <out_dir>/results.{predictions,actuals}.csv
+    - <out_dir>/logs/<stage>.log and pipeline_state.json
+'''
+
+import argparse
+import ast
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from datetime import datetime
+import hashlib
+import json
+import logging
+import os
+import shlex
+import shutil
+import sys
+
+from scale_harness import SCRIPT_DIR, count_json_list, latest_model, run_stage
+
+STATE_FILE = 'pipeline_state.json'
+
+def script_modules(script, seen=None):
+    '''
+    Returns the names of a script and of the sibling modules it imports,
+    directly or through each other.
+    '''
+    seen = set() if seen is None else seen
+    path = os.path.join(SCRIPT_DIR, script + '.py')
+    if script in seen or not os.path.exists(path):
+        return seen
+    seen.add(script)
+    with open(path, 'r', encoding='utf8') as infile:
+        tree = ast.parse(infile.read(), path)
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Import):
+            names = [alias.name for alias in node.names]
+        elif isinstance(node, ast.ImportFrom) and node.level == 0 and node.module:
+            names = [node.module]
+        else:
+            continue
+        for name in names:
+            script_modules(name.split('.')[0], seen)
+    return seen
+
+class ContentHashes:
+    '''
+    Hashes files and directories by content.  The hash of a file is reused
+    while its size and modification time are unchanged, so unchanged large
+    inputs are not read again on every run.
+    '''
+
+    def __init__(self, files=None):
+        self.files = files or {}
+
+    def file_hash(self, path):
+        stat = os.stat(path)
+        cached = self.files.get(path)
+        if cached is not None and cached[0] == stat.st_size and cached[1] == stat.st_mtime_ns:
+            return cached[2]
+        digest = hashlib.sha256()
+        with open(path, 'rb') as infile:
+            for block in iter(lambda: infile.read(1 << 20), b''):
+                digest.update(block)
+        self.files[path] = [stat.st_size, stat.st_mtime_ns, digest.hexdigest()]
+        return digest.hexdigest()
+
+    def __call__(self, path):
+        '''
+        Returns the hash of a file or of the relative paths and contents of
+        every file in a directory, or None if the path does not exist.
+        '''
+        if os.path.isfile(path):
+            return self.file_hash(path)
+        if not os.path.isdir(path):
+            return None
+        digest = hashlib.sha256()
+        for root, dirs, files in os.walk(path):
+            dirs.sort()
+            for name in sorted(files):
+                file_path = os.path.join(root, name)
+                digest.update(os.path.relpath(file_path, path).encode('utf8'))
+                digest.update(self.file_hash(file_path).encode('ascii'))
+        return digest.hexdigest()
+
+def stage_key(stage, hashes):
+    '''
+    Returns the hash of the command line, code and inputs of a stage.
+    '''
+    key = {
+        'args': [str(arg) for arg in stage['args']()],
+        'code': {name: hashes(os.path.join(SCRIPT_DIR, name + '.py'))\
+            for name in sorted(script_modules(stage['script']))},
+        'inputs': {path: hashes(path) for path in stage['inputs']}}
+    return hashlib.sha256(json.dumps(key, sort_keys=True).encode('utf8')).hexdigest()
+
+def is_current(stage, key, state, hashes):
+    recorded = state['stages'].get(stage['name'])
+    if recorded is None or recorded['key'] != key:
+        return False
+    return all(hashes(path) == digest for path, digest in recorded['outputs'].items())
+
+def depends_on(stage, other):
+    '''
+    Returns True if an input of stage is, or is inside, an output of other.
+    '''
+    return any(path == output or path.startswith(output + os.sep)\
+        for path in stage['inputs'] for output in other['outputs'])
+
+def pipeline_stages(args):
+    '''
+    Returns the stages of the pipeline, as dictionaries of the name, script,
+    input and output paths, the directories the script expects to exist,
+    and a function returning the arguments of the script, evaluated once
+    the inputs exist.
+    '''
+    ccs_dir = os.path.join(args.out_dir, 'ccs')
+    data_dir = os.path.join(args.out_dir, 'mimic')
+    model_dir = os.path.join(args.out_dir, 'model')
+    model_prefix = os.path.join(model_dir, 'model')
+    predictions = os.path.join(args.out_dir, 'predictions.test')
+    ccs_name = os.path.splitext(os.path.basename(args.ccs_file))[0]
+    hidden = args.hidden_dim_size
+
+    def ccs_outputs(name):
+        return [os.path.join(ccs_dir, name + suffix) for suffix in ('.json', '_text.json', '_vocab')]
+
+    def data_file(name):
+        return os.path.join(data_dir, name)
+
+    stages = [{
+        'name': 'create_ccs_dict',
+        'script': 'create_ccs_dict',
+        'inputs': [args.ccs_file],
+        'outputs': ccs_outputs(ccs_name),
+        'out_dirs': [ccs_dir],
+        'args': lambda: [args.ccs_file, ccs_dir, args.n_header_rows]}]
+    if args.procedure_file:
+        procedure_name = os.path.splitext(os.path.basename(args.procedure_file))[0]
+        stages.append({
+            'name': 'create_ccs_dict_procedures',
+            'script': 'create_ccs_dict',
+            'inputs': [args.procedure_file],
+            'outputs': ccs_outputs(procedure_name),
+            'out_dirs': [ccs_dir],
+            'args': lambda: [args.procedure_file, ccs_dir, args.n_header_rows]})
+    stages.append({
+        'name': 'process_mimic',
+        'script': 'process_mimic',
+        'inputs': [args.admission_file, args.diagnosis_file, os.path.join(ccs_dir, ccs_name + '.json')],
+        'outputs': [data_file(name) for name in ('visit_types.json', 'label_types.json', 'vocab',\
+            'patients.train', 'patients.valid', 'patients.test')],
+        'out_dirs': [data_dir],
+        'args': lambda: [args.admission_file, args.diagnosis_file, os.path.join(ccs_dir, ccs_name + '.json'),\
+            data_dir] + shlex.split(args.process_args)})
+    stages.append({
+        'name': 'doctor_ai',
+        'script': 'doctor_ai',
+        'inputs': [data_file(name) for name in ('visit_types.json', 'label_types.json',\
+            'patients.train', 'patients.valid', 'patients.test')],
+        'outputs': [model_dir],
+        'out_dirs': [model_dir],
+        'args': lambda: [data_file('patients.train'), data_file('patients.test'), data_file('patients.valid'),\
+            count_json_list(data_file('visit_types.json')), '-', '-', '-',\
+            count_json_list(data_file('label_types.json')), model_prefix, '--backend', args.backend,\
+            '--n_epochs', args.n_epochs, '--batch_size', args.batch_size, '--hidden_dim_size', hidden]\
+            + shlex.split(args.train_args)})
+    if args.scorer == 'score_cohort':
+        score_args = lambda: [latest_model(model_prefix), data_file('patients.test'), predictions,\
+            '--batch_size', args.batch_size]
+    else:
+        score_args = lambda: [latest_model(model_prefix), data_file('patients.test'), data_file('patients.test'),\
+            hidden, '--output_file', predictions, '--batch_size', args.batch_size]
+    stages.append({
+        'name': args.scorer,
+        'script': args.scorer,
+        'inputs': [model_dir, data_file('patients.test')],
+        'outputs': [predictions],
+        'out_dirs': [],
+        'args': score_args})
+    stages.append({
+        'name': 'translate_codes_to_text',
+        'script': 'translate_codes_to_text',
+        'inputs': [data_file('label_types.json'), os.path.join(ccs_dir, ccs_name + '_text.json'), predictions],
+        'outputs': [os.path.join(args.out_dir, 'results.predictions.csv'),\
+            os.path.join(args.out_dir, 'results.actuals.csv')],
+        'out_dirs': [],
+        'args': lambda: [data_file('label_types.json'), os.path.join(ccs_dir, ccs_name + '_text.json'),\
+            predictions, os.path.join(args.out_dir, 'results.predictions.csv'),\
+            os.path.join(args.out_dir, 'results.actuals.csv')]})
+    for stage in stages:
+        stage['after'] = [other['name'] for other in stages if other is not stage and depends_on(stage, other)]
+    return stages
+
+def load_state(out_dir):
+    try:
+        with open(os.path.join(out_dir, STATE_FILE), 'r') as infile:
+            return json.load(infile)
+    except (OSError, ValueError):
+        return {'files': {}, 'stages': {}}
+
+def save_state(out_dir, state):
+    path = os.path.join(out_dir, STATE_FILE)
+    with open(path + '.tmp', 'w', encoding='utf8') as outfile:
+        json.dump(state, outfile, indent=2)
+    os.replace(path + '.tmp', path)
+
+def prepare_outputs(stage):
+    '''
+    Removes the output directories of a stage before it runs, so that
+    checkpoints or prediction parts of an earlier run do not remain, and
+    creates the directories its script writes to.
+    '''
+    for path in stage['outputs']:
+        if os.path.isdir(path):
+            shutil.rmtree(path)
+    for path in stage['out_dirs']:
+        os.makedirs(path, exist_ok=True)
+
+def run_pipeline(stages, out_dir, jobs, force=(), dry_run=False):
+    '''
+    Runs the stages in dependency order, skipping the current ones and
+    running up to jobs stages at once.  Returns one result per stage.
+    '''
+    log_dir = os.path.join(out_dir, 'logs')
+    os.makedirs(log_dir, exist_ok=True)
+    state = load_state(out_dir)
+    hashes = ContentHashes(state['files'])
+    results = {}
+    running = {}
+    started = set()
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        while len(results) < len(stages):
+            for stage in stages:
+                if stage['name'] in results or stage['name'] in started:
+                    continue
+                statuses = [results.get(name, {}).get('status') for name in stage['after']]
+                if any(status in ('failed', 'blocked') for status in statuses):
+                    results[stage['name']] = {'stage': stage['name'], 'status': 'blocked'}
+                    logging.error("%s: not run, a stage it depends on failed", stage['name'])
+                    continue
+                if not all(status in ('done', 'skipped', 'would run') for status in statuses):
+                    continue
+                if dry_run and 'would run' in statuses:
+                    results[stage['name']] = {'stage': stage['name'], 'status': 'would run'}
+                    logging.info("%s: would run", stage['name'])
+                    continue
+                key = stage_key(stage, hashes)
+                if stage['name'] not in force and is_current(stage, key, state, hashes):
+                    results[stage['name']] = {'stage': stage['name'], 'status': 'skipped'}
+                    logging.info("%s: outputs are current, skipped", stage['name'])
+                    continue
+                if dry_run:
+                    results[stage['name']] = {'stage': stage['name'], 'status': 'would run'}
+                    logging.info("%s: would run", stage['name'])
+                    continue
+                prepare_outputs(stage)
+                log_file = os.path.join(log_dir, stage['name'] + '.log')
+                logging.info("%s: running, log in %s", stage['name'], log_file)
+                future = executor.submit(run_stage, stage['script'], stage['args'](), log_file)
+                running[future] = (stage, key)
+                started.add(stage['name'])
+            if not running:
+                continue
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                stage, key = running.pop(future)
+                status, seconds, peak_rss = future.result()
+                result = {'stage': stage['name'], 'seconds': seconds, 'peak_rss_bytes': peak_rss}
+                if status == 0:
+                    result['status'] = 'done'
+                    state['stages'][stage['name']] = {
+                        'key': key,
+                        'outputs': {path: hashes(path) for path in stage['outputs']},
+                        'finished': datetime.now().isoformat(timespec='seconds'),
+                        'seconds': seconds}
+                    logging.info("%s: done in %.1fs", stage['name'], seconds)
+                else:
+                    result['status'] = 'failed'
+                    state['stages'].pop(stage['name'], None)
+                    logging.error("%s failed with status %d, see %s", stage['name'], status,\
+                        os.path.join(log_dir, stage['name'] + '.log'))
+                results[stage['name']] = result
+                save_state(out_dir, state)
+    save_state(out_dir, state)
+    return [results[stage['name']] for stage in stages]
+
+def parse_arguments(parser):
+    parser.add_argument(\
+        'admission_file',
+        type=str,
+        help='The path to the MIMIC-III ADMISSIONS.csv file.')
+    parser.add_argument(\
+        'diagnosis_file',
+        type=str,
+        help='The path to the MIMIC-III DIAGNOSES_ICD.csv file.')
+    parser.add_argument(\
+        'ccs_file',
+        type=str,
+        help='The path to the single-level CCS diagnosis csv file.')
+    parser.add_argument(\
+        'out_dir',
+        type=str,
+        help='The directory for every output of the pipeline and its state.')
+    parser.add_argument(\
+        '--procedure_file',
+        type=str,
+        default='',
+        help='The path to the single-level CCS procedure csv file, to map as well.')
+    parser.add_argument(\
+        '--n_header_rows',
+        type=int,
+        default=2,
+        help='The number of header rows of the CCS csv files (default value: 2)')
+    parser.add_argument(\
+        '--process_args',
+        type=str,
+        default='',
+        help='Further arguments of process_mimic.py, e.g. "--min_code_count 5"')
+    parser.add_argument(\
+        '--backend',
+        type=str,
+        default='theano',
+        choices=['theano', 'numpy'],
+        help='The training backend of doctor_ai.py (default value: theano)')
+    parser.add_argument(\
+        '--n_epochs',
+        type=int,
+        default=10,
+        help='The number of training epochs (default value: 10)')
+    parser.add_argument(\
+        '--batch_size',
+        type=int,
+        default=100,
+        help='The size of a single mini-batch for training and scoring (default value: 100)')
+    parser.add_argument(\
+        '--hidden_dim_size',
+        type=str,
+        default='[200,200]',
+        help='The size of the hidden layers of the GRU (default value: [200,200])')
+    parser.add_argument(\
+        '--train_args',
+        type=str,
+        default='',
+        help='Further arguments of doctor_ai.py, e.g. "--patience 3 --dropout_rate 0.3"')
+    parser.add_argument(\
+        '--scorer',
+        type=str,
+        default='test_doctor_ai',
+        choices=['test_doctor_ai', 'score_cohort'],
+        help='The script predicting the test split; score_cohort.py runs without Theano (default value: test_doctor_ai)')
+    parser.add_argument(\
+        '--jobs',
+        type=int,
+        default=2,
+        help='The number of stages run at the same time (default value: 2)')
+    parser.add_argument(\
+        '--force',
+        type=str,
+        nargs='+',
+        default=[],
+        help='The stages to run even if their outputs are current.')
+    parser.add_argument(\
+        '--dry_run',
+        action='store_true',
+        help='Only print which stages would run.')
+    parser.add_argument('-v', '--verbose', action='store_true',\
+        help='Show verbose output.')
+    args = parser.parse_args()
+    return args
+
+def main():
+    parser = argparse.ArgumentParser()
+    args = parse_arguments(parser)
+    if args.verbose:
+        logging.basicConfig(level=logging.DEBUG)
+    else:
+        logging.basicConfig(level=logging.INFO)
+
+    stages = pipeline_stages(args)
+    unknown = set(args.force) - {stage['name'] for stage in stages}
+    if unknown:
+        parser.error(f"unknown stages: {' '.join(sorted(unknown))}")
+    os.makedirs(args.out_dir, exist_ok=True)
+    results = run_pipeline(stages, args.out_dir, args.jobs, set(args.force), args.dry_run)
+    if any(result['status'] in ('failed', 'blocked') for result in results):
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,204 @@
+'''This module runs the whole pipeline end to end over synthetic MIMIC-shaped
+data at several sizes and records the cost of every stage.
+
+For each scale (a multiple of the MIMIC-III patient count) it runs, each as
+its own process:
+    generate_synthetic_mimic -> create_ccs_dict -> process_mimic ->
+    doctor_ai -> test_doctor_ai -> translate_codes_to_text
+
+and records wall time, peak RSS of the stage's process and throughput
+(patients, admissions or visits per second, depending on the stage).  A
+stage that fails stops the remaining stages of its scale.
+
+inputs:
+    - Single Level diagnosis file from CCS (dxref2015.csv).
+    - work directory for the generated data, models and predictions.
+    - output file name.
+
+outputs:
+    - JSON file with one result per scale and stage.
+'''
+
+import argparse
+import glob
+import json
+import logging
+import os
+import subprocess
+import sys
+import time
+
+from prediction_store import load_meta
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+MIMIC_N_PATIENTS = 46520
+
+def run_stage(name, args, log_file):
+    '''
+    Runs one script in a child process.  Returns (exit status, wall seconds,
+    peak RSS in bytes).
+    '''
+    command = [sys.executable, os.path.join(SCRIPT_DIR, name + '.py')] + [str(arg) for arg in args]
+    logging.debug("running %s", ' '.join(command))
+    with open(log_file, 'w') as log:
+        start = time.perf_counter()
+        process = subprocess.Popen(command, stdout=log, stderr=subprocess.STDOUT)
+        _, status, usage = os.wait4(process.pid, 0)
+        seconds = time.perf_counter() - start
+    if os.WIFEXITED(status):
+        process.returncode = os.WEXITSTATUS(status)
+    else:
+        process.returncode = -os.WTERMSIG(status)
+    # ru_maxrss is reported in kilobytes on Linux
+    return process.returncode, seconds, usage.ru_maxrss * 1024
+
+def count_json_list(path):
+    with open(path, 'r') as infile:
+        return len(json.load(infile))
+
+def count_visits(path):
+    with open(path, 'r') as infile:
+        return sum(len(patient) for patient in json.load(infile))
+
+def count_lines(path):
+    with open(path, 'r') as infile:
+        return sum(1 for _ in infile) - 1
+
+def latest_model(model_prefix):
+    # leaves out the optimizer states saved next to them (<model>.adadelta.npz)
+    models = [path for path in glob.glob(model_prefix + '.*.npz')\
+        if path[len(model_prefix) + 1:-len('.npz')].isdigit()]
+    if not models:
+        return ''
+    return max(models, key=lambda path: int(path[len(model_prefix) + 1:-len('.npz')]))
+
+def run_scale(scale, ccs_file, work_dir, options):
+    '''
+    Runs every stage for one scale and returns their results.
+    '''
+    data_dir = os.path.join(work_dir, f'scale_{scale:g}')
+    os.makedirs(data_dir, exist_ok=True)
+    ccs_name = os.path.splitext(os.path.basename(ccs_file))[0]
+    model_prefix = os.path.join(data_dir, 'model')
+    predictions = os.path.join(data_dir, 'predictions.test')
+    hidden = options['hidden_dim_size']
+    n_patients = int(round(MIMIC_N_PATIENTS * scale))
+
+    def visit_file(split):
+        return os.path.join(data_dir, f'seqs_visit.{split}.json')
+
+    def label_file(split):
+        return os.path.join(data_dir, f'seqs_label.{split}.json')
+
+    # (stage, arguments, function returning (items, unit) after the stage ran)
+    stages = [
+        ('generate_synthetic_mimic', lambda: [ccs_file, data_dir, '--n_patients', n_patients],
+         lambda: (n_patients, 'patients')),
+        ('create_ccs_dict', lambda: [ccs_file, data_dir, 2],
+         lambda: (count_lines(ccs_file), 'codes')),
+        ('process_mimic', lambda: [\
+            os.path.join(data_dir, 'ADMISSIONS.csv'), os.path.join(data_dir, 'DIAGNOSES_ICD.csv'),\
+            os.path.join(data_dir, ccs_name + '_vocab'), data_dir],
+         lambda: (count_lines(os.path.join(data_dir, 'ADMISSIONS.csv')), 'admissions')),
+        ('doctor_ai', lambda: [\
+            visit_file('train'), visit_file('test'), visit_file('valid'),\
+            count_json_list(os.path.join(data_dir, 'visit_types.json')),\
+            label_file('train'), label_file('test'), label_file('valid'),\
+            count_json_list(os.path.join(data_dir, 'label_types.json')),\
+            model_prefix, '--n_epochs', options['n_epochs'],\
+            '--batch_size', options['batch_size'], '--hidden_dim_size', hidden],
+         lambda: (count_visits(visit_file('train')) * options['n_epochs'], 'visits')),
+        ('test_doctor_ai', lambda: [\
+            latest_model(model_prefix), visit_file('test'), label_file('test'), hidden,\
+            '--output_file', predictions, '--batch_size', options['batch_size']],
+         lambda: (count_visits(visit_file('test')), 'visits')),
+        ('translate_codes_to_text', lambda: [\
+            os.path.join(data_dir, 'label_types.json'),\
+            os.path.join(data_dir, ccs_name + '_text.json'), predictions,\
+            os.path.join(data_dir, 'results.predictions.csv'),\
+            os.path.join(data_dir, 'results.actuals.csv')],
+         lambda: (load_meta(predictions)['n_rows'], 'visits')),
+    ]
+
+    results = []
+    for name, stage_args, stage_items in stages:
+        status, seconds, peak_rss = run_stage(\
+            name, stage_args(), os.path.join(data_dir, name + '.log'))
+        result = {
+            'scale': scale,
+            'stage': name,
+            'status': status,
+            'seconds': seconds,
+            'peak_rss_bytes': peak_rss}
+        if status == 0:
+            items, unit = stage_items()
+            result.update({'items': items, 'unit': unit, 'items_per_second': items / max(seconds, 1e-12)})
+            logging.info("x%g %s: %.1fs, %.0f MB peak RSS, %.0f %s/s", scale, name, seconds,\
+                peak_rss / 2**20, result['items_per_second'], unit)
+        else:
+            logging.error("x%g %s failed with status %d, see %s.log", scale, name, status,\
+                os.path.join(data_dir, name))
+        results.append(result)
+        if status != 0:
+            break
+    return results
+
+def parse_arguments(parser):
+    parser.add_argument(\
+        'ccs_file',
+        type=str,
+        help='The path to the single-level CCS diagnosis csv file.')
+    parser.add_argument(\
+        'work_dir',
+        type=str,
+        help='The directory for generated data, models and predictions. Each scale gets its own subdirectory.')
+    parser.add_argument(\
+        'out_file',
+        type=str,
+        help='The path to the JSON results file.')
+    parser.add_argument(\
+        '--scales',
+        type=str,
+        default='1,10,100',
+        help='Comma-separated multiples of the MIMIC-III patient count (default value: 1,10,100)')
+    parser.add_argument(\
+        '--n_epochs',
+        type=int,
+        default=1,
+        help='The number of training epochs per scale (default value: 1)')
+    parser.add_argument(\
+        '--batch_size',
+        type=int,
+        default=100,
+        help='The size of a single mini-batch for training and scoring (default value: 100)')
+    parser.add_argument(\
+        '--hidden_dim_size',
+        type=str,
+        default='[200,200]',
+        help='The size of the hidden layers of the GRU (default value: [200,200])')
+    parser.add_argument('-v', '--verbose', action='store_true',\
+        help='Show verbose output.')
+    args = parser.parse_args()
+    return args
+
+def main():
+    parser = argparse.ArgumentParser()
+    args = parse_arguments(parser)
+    if args.verbose:
+        logging.basicConfig(level=logging.DEBUG)
+    else:
+        logging.basicConfig(level=logging.INFO)
+
+    options = {
+        'n_epochs': args.n_epochs,
+        'batch_size': args.batch_size,
+        'hidden_dim_size': args.hidden_dim_size}
+    results = []
+    for scale in [float(scale) for scale in args.scales.split(',')]:
+        results.extend(run_scale(scale, args.ccs_file, args.work_dir, options))
+        with open(args.out_file, 'w', encoding='utf8') as outfile:
+            json.dump({'options': options, 'results': results}, outfile, indent=2)
+    logging.info("wrote %d results to %s", len(results), args.out_file)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,199 @@
+'''This module scores a whole patient split with a trained Doctor AI model on
+all cores, for example to produce nightly risk lists of a population.
+
+The patients of a patient store (patients.<split>/ from process_mimic.py)
+are cut into contiguous partitions that a process pool scores in parallel.
+Every worker loads the model once, when it starts, and reads the patients of
+its partitions from the memory-mapped store; the model is run forward with
+numpy_model.py.  Each partition is written as a prediction store of its own
+(prediction_store.py), and the partitions are merged into one store in
+partition order at the end, so the output holds the same rows as that of
+test_doctor_ai.py with a directory output file: the top-k predicted codes
+and probabilities for every visit that has a next visit.  With
+--latest_visit, every patient is instead scored once from all of their
+visits, which predicts the visit that has not happened yet, as a risk list
+needs; these rows have no actual codes.
+
+Progress (patients scored, visits per second and the estimated time left)
+is logged as partitions complete.
+
+inputs:
+    - .npz model file from doctor_ai.py, or a model directory exported by
+      model_export.py
+    - patient store of the split to score
+    - output directory
+
+outputs:
+    - prediction store directory, readable by translate_codes_to_text.py
+'''
+
+import argparse
+import logging
+import multiprocessing
+import os
+import time
+
+import numpy as np
+
+from blas_config import recommended_layout, set_blas_threads
+from label_groups import LabelGroups
+from model_export import load_model
+from numpy_model import batch_hidden_states, predict_durations, prepare_batches, topk_rows, uses_time
+from patient_store import PatientStore, is_patient_store
+from prediction_store import PredictionWriter, merge_stores
+
+PARTITION_FORMAT = 'partition-{:05d}'
+
+# the model and store of a worker process, loaded by init_worker
+_worker = {}
+
+def init_worker(model_file, store_dir, options):
+    params = load_model(model_file)
+    _worker['params'] = params
+    _worker['labelGroups'] = LabelGroups(params['label_groups']) if 'label_groups' in params else None
+    _worker['store'] = PatientStore(store_dir)
+    _worker['options'] = options
+
+def score_partition(partition):
+    '''
+    Scores the patients [start, stop) of the store into the prediction
+    store out_dir.  Returns the partition index, the numbers of patients and
+    scored visits and the seconds it took.
+    '''
+    index, start, stop, out_dir = partition
+    begin = time.perf_counter()
+    params = _worker['params']
+    options = _worker['options']
+    store = _worker['store']
+    predictTime = 'W_time' in params
+
+    seqs, labels, _ = store.patients(range(start, stop))
+    pids = np.asarray(store.pids[start:stop])
+    with PredictionWriter(out_dir, options['topk']) as writer:
+        for batch in prepare_batches(seqs, labels, options['batchSize'], latest=options['latestVisit']):
+            if not batch['labels']:
+                continue
+            hidden, mask = batch_hidden_states(params, batch)
+            visitIndex, sampleIndex = batch['rows']
+            topCodes, topProbs = topk_rows(params, hidden[visitIndex, sampleIndex], options['topk'],\
+                _worker['labelGroups'])
+            durations = None
+            if predictTime:
+                durations = predict_durations(params, hidden, mask)[visitIndex, sampleIndex]
+            writer.write(pids[batch['patients'][sampleIndex]], visitIndex, topCodes, topProbs,\
+                batch['labels'], durations)
+        n_rows = writer.n_rows
+    return index, stop - start, n_rows, time.perf_counter() - begin
+
+def partition_bounds(n_patients, n_partitions):
+    '''
+    Returns (start, stop) ranges cutting n_patients into at most
+    n_partitions contiguous partitions of near equal size.
+    '''
+    edges = np.linspace(0, n_patients, min(n_partitions, max(n_patients, 1)) + 1).astype(np.int64)
+    return [(int(start), int(stop)) for start, stop in zip(edges[:-1], edges[1:]) if stop > start]
+
+def parse_arguments(parser):
+    parser.add_argument(\
+        'model_file',
+        type=str,
+        help='The path to the model file from doctor_ai.py or a model directory exported by model_export.py.')
+    parser.add_argument(\
+        'store_dir',
+        type=str,
+        help='The path to the patient store (patients.<split>/) of the patients to score.')
+    parser.add_argument(\
+        'out_dir',
+        type=str,
+        help='The output prediction store directory.')
+    parser.add_argument(\
+        '--topk',
+        type=int,
+        default=30,
+        help='The number of predicted codes per visit (default value: 30)')
+    parser.add_argument(\
+        '--batch_size',
+        type=int,
+        default=100,
+        help='The size of a single mini-batch (default value: 100)')
+    parser.add_argument(\
+        '--workers',
+        type=int,
+        default=0,
+        help='The number of worker processes (default value: the processes recommended by autotune_blas.py, else all cores)')
+    parser.add_argument(\
+        '--threads_per_worker',
+        type=int,
+        default=0,
+        help='The BLAS threads of every worker (default value: the threads recommended by autotune_blas.py, else 1)')
+    parser.add_argument(\
+        '--partitions_per_worker',
+        type=int,
+        default=4,
+        help='The number of partitions per worker; more partitions balance the load and report progress more often (default value: 4)')
+    parser.add_argument(\
+        '--latest_visit',
+        type=int,
+        default=0,
+        choices=[0, 1],
+        help='Score every patient once, from their latest visit, for the visit that has not happened yet. The rows have no actual codes, and durations are predicted if the model predicts them (0=no, 1=yes, default value: 0)')
+    parser.add_argument('-v', '--verbose', action='store_true',\
+        help='Show verbose output.')
+    args = parser.parse_args()
+    return args
+
+def main():
+    parser = argparse.ArgumentParser()
+    args = parse_arguments(parser)
+    if args.verbose:
+        logging.basicConfig(level=logging.DEBUG)
+    else:
+        logging.basicConfig(level=logging.INFO)
+
+    if not is_patient_store(args.store_dir):
+        logging.error("%s is not a patient store, convert the split with patient_store.py", args.store_dir)
+        return
+    params = load_model(args.model_file, dtype=None)
+    if uses_time(params):
+        logging.error("%s uses durations, which patient stores do not hold", args.model_file)
+        return
+    layout = recommended_layout('score') or {}
+    workers = args.workers or layout.get('processes', os.cpu_count())
+    threads = args.threads_per_worker or layout.get('threads', 1)
+    n_patients = len(PatientStore(args.store_dir))
+    partitions_dir = os.path.join(args.out_dir, 'partitions')
+    if os.path.exists(args.out_dir) and os.listdir(args.out_dir):
+        logging.error("%s is not empty", args.out_dir)
+        return
+    os.makedirs(partitions_dir)
+    bounds = partition_bounds(n_patients, workers * args.partitions_per_worker)
+    partitions = [(index, start, stop, os.path.join(partitions_dir, PARTITION_FORMAT.format(index)))\
+        for index, (start, stop) in enumerate(bounds)]
+    n_workers = max(1, min(workers, len(partitions)))
+    logging.info("scoring %d patients in %d partitions with %d workers of %d threads", n_patients,\
+        len(partitions), n_workers, threads)
+
+    # spawned workers load BLAS with these settings
+    set_blas_threads(threads)
+    options = {'topk': args.topk, 'batchSize': args.batch_size, 'latestVisit': bool(args.latest_visit)}
+    context = multiprocessing.get_context('spawn')
+    start = time.perf_counter()
+    done_patients = 0
+    done_rows = 0
+    with context.Pool(n_workers, initializer=init_worker, initargs=(args.model_file, args.store_dir, options)) as pool:
+        for index, n, n_rows, seconds in pool.imap_unordered(score_partition, partitions):
+            done_patients += n
+            done_rows += n_rows
+            elapsed = time.perf_counter() - start
+            remaining = elapsed * (n_patients - done_patients) / max(done_patients, 1)
+            logging.info("partition %d: %d patients in %.1fs; %d/%d patients, %.0f visits/s, %.0fs left",\
+                index, n, seconds, done_patients, n_patients, done_rows / max(elapsed, 1e-12), remaining)
+
+    meta = merge_stores([partition[3] for partition in partitions], args.out_dir)
+    os.rmdir(partitions_dir)
+    elapsed = time.perf_counter() - start
+    logging.info("scored %d visits of %d patients in %.1fs (%.0f patients/s), wrote %d parts to %s",\
+        meta['n_rows'], n_patients, elapsed, n_patients / max(elapsed, 1e-12), meta['n_parts'], args.out_dir)
+
+if __name__ == '__main__':
+    main()
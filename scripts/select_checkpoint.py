@@ -0,0 +1,225 @@
+'''This module scores every checkpoint of a Doctor AI training run on the
+validation and test sets and selects the best one.
+
+doctor_ai.py saves <out_file>.<epoch>.npz every time the validation cross
+entropy improves.  Instead of running test_doctor_ai.py on one file at a
+time, which compiles the Theano graph each time, the splits are prepared
+once with numpy_model.prepare_batches (sorted by length, input codes as
+embedding row indices) and the checkpoints are run forward with NumPy in a
+process pool.  The worker processes inherit the prepared batches when they
+are forked, so the splits are neither read nor padded again.
+
+The checkpoint with the best validation recall at --select_rank is
+selected; with --prune every other checkpoint of the run is deleted.
+
+inputs:
+    - the out_file given to doctor_ai.py (checkpoints <out_file>.<epoch>.npz)
+    - visit and label files of the validation and test sets, or their
+      patient stores (patients.<split>/)
+    - (optional) duration files, for models that predict durations
+
+outputs:
+    - a table of recall@k (and R2) per checkpoint and split on the console
+    - (optional) JSON report of the table and the selected checkpoint
+'''
+
+import argparse
+import glob
+import json
+import logging
+import multiprocessing
+import os
+import re
+
+from model_export import load_model
+from numpy_model import evaluate_batches, prepare_batches, r_squared
+from patient_store import PatientStore, is_patient_store
+
+CHECKPOINT_EPOCH = re.compile(r'\.(\d+)\.npz$')
+
+def find_checkpoints(out_file):
+    '''
+    Returns the (epoch, path) of every checkpoint of out_file, by epoch.
+    '''
+    checkpoints = []
+    for path in glob.glob(glob.escape(out_file) + '.*.npz'):
+        match = CHECKPOINT_EPOCH.search(path)
+        if match and path == f'{out_file}.{match.group(1)}.npz':
+            checkpoints.append((int(match.group(1)), path))
+    return sorted(checkpoints)
+
+def load_split(visit_file, label_file, time_file=''):
+    if is_patient_store(visit_file):
+        store = PatientStore(visit_file)
+        seqs, labels, _ = store.patients(range(len(store)))
+        return seqs, labels, None
+    with open(visit_file, 'r') as infile:
+        seqs = json.load(infile)
+    with open(label_file, 'r') as infile:
+        labels = json.load(infile)
+    times = None
+    if time_file:
+        with open(time_file, 'r') as infile:
+            times = json.load(infile)
+    return seqs, labels, times
+
+# the prepared splits, set in the parent before the pool forks
+_batches = {}
+_options = {}
+
+def init_worker(batches, options):
+    _batches.update(batches)
+    _options.update(options)
+
+def score_checkpoint(checkpoint):
+    '''
+    Returns the scores of one checkpoint on every prepared split.
+    '''
+    epoch, path = checkpoint
+    params = load_model(path)
+    row = {'epoch': epoch, 'path': path}
+    for split, batches in _batches.items():
+        recall, (trueTimes, predTimes) = evaluate_batches(params, batches, _options['ranks'])
+        for rank, value in zip(_options['ranks'], recall):
+            row[f'{split}_recall@{rank}'] = value
+        if predTimes:
+            row[f'{split}_R2'] = float(r_squared(trueTimes, predTimes, _options['mean_duration'],\
+                _options['useLogTime'], _options['logEps']))
+    return row
+
+def parse_arguments(parser):
+    parser.add_argument(\
+        'out_file',
+        type=str,
+        help='The out_file given to doctor_ai.py; its checkpoints are <out_file>.<epoch>.npz.')
+    parser.add_argument(\
+        'visit_file_valid',
+        type=str,
+        help='The path to the visit file of the validation set, or its patient store (patients.valid/).')
+    parser.add_argument(\
+        'label_file_valid',
+        type=str,
+        help='The path to the label file of the validation set, ignored with a patient store.')
+    parser.add_argument(\
+        'visit_file_test',
+        type=str,
+        help='The path to the visit file of the test set, or its patient store (patients.test/).')
+    parser.add_argument(\
+        'label_file_test',
+        type=str,
+        help='The path to the label file of the test set, ignored with a patient store.')
+    parser.add_argument(\
+        '--time_file_valid',
+        type=str,
+        default='',
+        help='The path to the duration file of the validation set, for models that use durations.')
+    parser.add_argument(\
+        '--time_file_test',
+        type=str,
+        default='',
+        help='The path to the duration file of the test set, for models that use durations.')
+    parser.add_argument(\
+        '--ranks',
+        type=int,
+        nargs='+',
+        default=[10, 20, 30],
+        help='The ranks k of recall@k (default value: 10 20 30)')
+    parser.add_argument(\
+        '--select_rank',
+        type=int,
+        default=0,
+        help='The k of the validation recall@k the best checkpoint is selected by (default value: the largest rank)')
+    parser.add_argument(\
+        '--use_log_time',
+        type=int,
+        default=1,
+        choices=[0, 1],
+        help='Whether the models were trained on the logarithm of durations (0 for false, 1 for true) (default value: 1)')
+    parser.add_argument(\
+        '--mean_duration',
+        type=float,
+        default=20.0,
+        help='The mean duration used for R2, as in test_doctor_ai.py (default value: 20.0)')
+    parser.add_argument(\
+        '--log_eps',
+        type=float,
+        default=1e-8,
+        help='A small value to prevent log(0) (default value: 1e-8)')
+    parser.add_argument(\
+        '--batch_size',
+        type=int,
+        default=100,
+        help='The size of a single mini-batch (default value: 100)')
+    parser.add_argument(\
+        '--workers',
+        type=int,
+        default=os.cpu_count(),
+        help='The number of checkpoints scored at a time (default value: all cores)')
+    parser.add_argument(\
+        '--prune',
+        action='store_true',
+        help='Delete every checkpoint but the selected one.')
+    parser.add_argument(\
+        '--report_file',
+        type=str,
+        default='',
+        help='The path to the JSON report of the scores of every checkpoint.')
+    parser.add_argument('-v', '--verbose', action='store_true',\
+        help='Show verbose output.')
+    args = parser.parse_args()
+    return args
+
+def main():
+    parser = argparse.ArgumentParser()
+    args = parse_arguments(parser)
+    if args.verbose:
+        logging.basicConfig(level=logging.DEBUG)
+    else:
+        logging.basicConfig(level=logging.INFO)
+
+    checkpoints = find_checkpoints(args.out_file)
+    if not checkpoints:
+        logging.error("no checkpoints %s.<epoch>.npz", args.out_file)
+        return
+    select_rank = args.select_rank or max(args.ranks)
+    if select_rank not in args.ranks:
+        args.ranks.append(select_rank)
+
+    batches = {}
+    for split, visit_file, label_file, time_file in (\
+        ('valid', args.visit_file_valid, args.label_file_valid, args.time_file_valid),\
+        ('test', args.visit_file_test, args.label_file_test, args.time_file_test)):
+        seqs, labels, times = load_split(visit_file, label_file, time_file)
+        batches[split] = prepare_batches(seqs, labels, args.batch_size, times, args.use_log_time, args.log_eps)
+        logging.info("prepared %d %s patients in %d batches", len(seqs), split, len(batches[split]))
+    options = {'ranks': args.ranks, 'mean_duration': args.mean_duration,\
+        'useLogTime': args.use_log_time, 'logEps': args.log_eps}
+
+    n_workers = max(1, min(args.workers, len(checkpoints)))
+    with multiprocessing.Pool(n_workers, initializer=init_worker, initargs=(batches, options)) as pool:
+        rows = pool.map(score_checkpoint, checkpoints)
+
+    key = f'valid_recall@{select_rank}'
+    best = max(rows, key=lambda row: (row[key], row['epoch']))
+    columns = [name for name in rows[0] if name not in ('epoch', 'path')]
+    logging.info("epoch  %s", '  '.join(columns))
+    for row in rows:
+        logging.info("%5d  %s%s", row['epoch'], '  '.join(f'{row[name]:.4f}' for name in columns),\
+            '  <- selected' if row is best else '')
+    logging.info("selected %s by %s", best['path'], key)
+
+    if args.report_file:
+        with open(args.report_file, 'w', encoding='utf8') as outfile:
+            json.dump({'selected': best['path'], 'select_by': key, 'checkpoints': rows}, outfile, indent=2)
+    if args.prune:
+        for row in rows:
+            if row is not best:
+                os.remove(row['path'])
+                logging.info("deleted %s", row['path'])
+                # the optimizer state doctor_ai.py saves next to every checkpoint
+                state_file = row['path'][:-len('.npz')] + '.adadelta.npz'
+                if os.path.exists(state_file):
+                    os.remove(state_file)
+
+if __name__ == '__main__':
+    main()
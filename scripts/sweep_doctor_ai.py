@@ -0,0 +1,284 @@
+'''This module tunes the hyperparameters of doctor_ai.py by training a grid
+of configurations concurrently.
+
+The splits are loaded once: JSON visit and label files are written as patient
+stores (patient_store.py) in the sweep directory, and patient stores from
+process_mimic.py (patients.<split>/) are used as they are.  Every worker
+process trains one configuration at a time with doctor_ai.train_doctorAI on
+the memory-mapped stores, so all workers read the same pages of the page
+cache instead of parsing and holding their own copy of the JSON files.
+
+The number of concurrent workers is the CPU-core budget divided by the BLAS
+threads of every worker.  After every epoch a worker reports its validation
+cross entropy to the other workers; from --min_epochs on, a configuration
+whose validation cost is worse than the --keep_fraction best of the costs
+reported at the same epoch is stopped, which frees its worker for the next
+configuration.
+
+inputs:
+    - the visit and label files (or patient stores) of the three splits, the
+      code counts and the output directory, as for doctor_ai.py
+    - the values to try for every hyperparameter
+
+outputs:
+    - <out_dir>/config-<n>/: the models and training output of every configuration
+    - <out_dir>/results.tsv: one row per configuration, best validation cost first
+'''
+
+import argparse
+import contextlib
+import csv
+import itertools
+import json
+import logging
+import multiprocessing
+import os
+import time
+
+from blas_config import recommended_layout, set_blas_threads
+from patient_store import is_patient_store, write_patient_store
+
+SPLITS = ('train', 'test', 'valid')
+RESULT_COLUMNS = ('config', 'hidden_dim_size', 'embed_size', 'dropout_rate', 'L2_softmax',\
+    'epochs', 'stopped', 'best_valid_cost', 'best_epoch', 'test_cost', 'seconds')
+
+def prepare_stores(visit_files, label_files, data_dir):
+    '''
+    Returns a patient store for every split, writing the JSON splits to
+    data_dir once.
+    '''
+    stores = []
+    for split, visit_file, label_file in zip(SPLITS, visit_files, label_files):
+        if is_patient_store(visit_file):
+            stores.append(visit_file)
+            continue
+        store_dir = os.path.join(data_dir, 'patients.' + split)
+        with open(visit_file, 'r') as infile:
+            seqs = json.load(infile)
+        with open(label_file, 'r') as infile:
+            labels = json.load(infile)
+        write_patient_store(store_dir, list(range(len(seqs))), seqs, labels)
+        logging.info("wrote %d %s patients to %s", len(seqs), split, store_dir)
+        stores.append(store_dir)
+    return stores
+
+def config_grid(hidden_dim_sizes, embed_sizes, dropout_rates, L2_softmaxes):
+    '''
+    Returns every combination of the hyperparameter values as a list of
+    train_doctorAI keyword arguments.
+    '''
+    return [{'hiddenDimSize': hidden, 'embSize': embed, 'dropout_rate': dropout, 'L2_output': L2}\
+        for hidden, embed, dropout, L2 in itertools.product(hidden_dim_sizes, embed_sizes, dropout_rates, L2_softmaxes)]
+
+def parse_hidden_dim_size(value):
+    return [int(strDim) for strDim in value.strip()[1:-1].split(',')]
+
+class EarlyStopping:
+    '''
+    Stops configurations whose validation cost at an epoch is worse than
+    the keep_fraction best costs reported by all configurations at that
+    epoch.  The reports are kept in a dictionary shared by the workers.
+    '''
+
+    def __init__(self, reports, config_id, min_epochs=2, keep_fraction=0.5, min_reports=3):
+        self.reports = reports
+        self.config_id = config_id
+        self.min_epochs = min_epochs
+        self.keep_fraction = keep_fraction
+        self.min_reports = min_reports
+        self.epochs = 0
+        self.stopped = False
+
+    def __call__(self, epoch, valid_cost):
+        self.epochs = epoch + 1
+        self.reports[(epoch, self.config_id)] = valid_cost
+        if self.epochs < self.min_epochs or self.keep_fraction >= 1:
+            return False
+        costs = sorted(cost for (reported_epoch, _), cost in self.reports.items() if reported_epoch == epoch)
+        if len(costs) < self.min_reports:
+            return False
+        n_kept = max(1, int(len(costs) * self.keep_fraction))
+        self.stopped = valid_cost > costs[n_kept - 1]
+        return self.stopped
+
+def run_config(job):
+    '''
+    Trains one configuration and returns its row of the results table.
+    '''
+    config_id, config, train_kwargs, reports, stop_options = job
+    import doctor_ai
+
+    config_dir = os.path.join(train_kwargs['outDir'], f'config-{config_id:03d}')
+    os.makedirs(config_dir, exist_ok=True)
+    kwargs = dict(train_kwargs)
+    del kwargs['outDir']
+    stopping = EarlyStopping(reports, config_id, **stop_options)
+    start = time.perf_counter()
+    with open(os.path.join(config_dir, 'train.log'), 'w', encoding='utf8') as log,\
+        contextlib.redirect_stdout(log):
+        best_valid, best_epoch, test_cost = doctor_ai.train_doctorAI(\
+            outFile=os.path.join(config_dir, 'model'), epochCallback=stopping, **config, **kwargs)
+    return {
+        'config': config_id,
+        'hidden_dim_size': json.dumps(config['hiddenDimSize']).replace(' ', ''),
+        'embed_size': config['embSize'],
+        'dropout_rate': config['dropout_rate'],
+        'L2_softmax': config['L2_output'],
+        'epochs': stopping.epochs,
+        'stopped': int(stopping.stopped),
+        'best_valid_cost': float(best_valid),
+        'best_epoch': best_epoch,
+        'test_cost': float(test_cost),
+        'seconds': round(time.perf_counter() - start, 1)}
+
+def write_results(results, out_file):
+    results = sorted(results, key=lambda row: row['best_valid_cost'])
+    with open(out_file, 'w', encoding='utf8', newline='') as outfile:
+        writer = csv.DictWriter(outfile, fieldnames=RESULT_COLUMNS, delimiter='\t')
+        writer.writeheader()
+        writer.writerows(results)
+    return results
+
+def parse_arguments(parser):
+    for split in SPLITS:
+        parser.add_argument(\
+            f'visit_file_{split}',
+            type=str,
+            help=f'The path to the visit file of the {split} set, or to its patient store (patients.{split}/) from process_mimic.py.')
+    parser.add_argument(\
+        'n_input_codes',
+        type=int,
+        help='The number of unique input medical codes.')
+    for split in SPLITS:
+        parser.add_argument(\
+            f'label_file_{split}',
+            type=str,
+            help=f'The path to the label file of the {split} set, ignored with patient stores.')
+    parser.add_argument(\
+        'n_output_codes',
+        type=int,
+        help='The number of unique label medical codes.')
+    parser.add_argument(\
+        'out_dir',
+        type=str,
+        help='The output directory of the sweep.')
+    parser.add_argument(\
+        '--hidden_dim_size',
+        type=str,
+        nargs='+',
+        default=['[200,200]'],
+        help='The GRU layer sizes to try, e.g. [200,200] [400] (default value: [200,200])')
+    parser.add_argument(\
+        '--embed_size',
+        type=int,
+        nargs='+',
+        default=[200],
+        help='The embedding sizes to try (default value: 200)')
+    parser.add_argument(\
+        '--dropout_rate',
+        type=float,
+        nargs='+',
+        default=[0.5],
+        help='The dropout rates to try (default value: 0.5)')
+    parser.add_argument(\
+        '--L2_softmax',
+        type=float,
+        nargs='+',
+        default=[0.001],
+        help='The L2 regularizations of the softmax to try (default value: 0.001)')
+    parser.add_argument(\
+        '--batch_size',
+        type=int,
+        default=100,
+        help='The size of a single mini-batch (default value: 100)')
+    parser.add_argument(\
+        '--n_epochs',
+        type=int,
+        default=10,
+        help='The maximum number of training epochs of every configuration (default value: 10)')
+    parser.add_argument(\
+        '--cores',
+        type=int,
+        default=os.cpu_count(),
+        help='The number of CPU cores the sweep may use (default value: all cores)')
+    parser.add_argument(\
+        '--threads_per_worker',
+        type=int,
+        default=0,
+        help='The BLAS threads of every worker; the sweep runs cores / threads_per_worker configurations at a time (default value: the threads recommended by autotune_blas.py, else 1)')
+    parser.add_argument(\
+        '--min_epochs',
+        type=int,
+        default=2,
+        help='The number of epochs every configuration trains before it can be stopped (default value: 2)')
+    parser.add_argument(\
+        '--keep_fraction',
+        type=float,
+        default=0.5,
+        help='The fraction of the validation costs reported at an epoch a configuration must be within to keep training, 1 to never stop early (default value: 0.5)')
+    parser.add_argument(\
+        '--min_reports',
+        type=int,
+        default=3,
+        help='The number of configurations that must have reached an epoch before any is stopped there (default value: 3)')
+    parser.add_argument('-v', '--verbose', action='store_true',\
+        help='Show verbose output.')
+    args = parser.parse_args()
+    return args
+
+def main():
+    parser = argparse.ArgumentParser()
+    args = parse_arguments(parser)
+    if args.verbose:
+        logging.basicConfig(level=logging.DEBUG)
+    else:
+        logging.basicConfig(level=logging.INFO)
+
+    os.makedirs(args.out_dir, exist_ok=True)
+    visit_files = [getattr(args, f'visit_file_{split}') for split in SPLITS]
+    label_files = [getattr(args, f'label_file_{split}') for split in SPLITS]
+    stores = prepare_stores(visit_files, label_files, os.path.join(args.out_dir, 'data'))
+
+    configs = config_grid([parse_hidden_dim_size(value) for value in args.hidden_dim_size],\
+        args.embed_size, args.dropout_rate, args.L2_softmax)
+    threads = args.threads_per_worker or (recommended_layout('train') or {}).get('threads', 1)
+    n_workers = max(1, min(len(configs), args.cores // threads))
+    logging.info("%d configurations, %d workers with %d threads each", len(configs), n_workers, threads)
+
+    train_kwargs = {
+        'outDir': args.out_dir,
+        'seqFileTrain': stores[0],
+        'seqFileTest': stores[1],
+        'seqFileValid': stores[2],
+        'inputDimSize': args.n_input_codes,
+        'numClass': args.n_output_codes,
+        'timeFileTrain': '',
+        'embFile': '',
+        'batchSize': args.batch_size,
+        'max_epochs': args.n_epochs}
+    stop_options = {'min_epochs': args.min_epochs, 'keep_fraction': args.keep_fraction,\
+        'min_reports': args.min_reports}
+
+    # spawned workers load BLAS with these settings; forked workers would
+    # inherit the BLAS this process loaded with NumPy
+    set_blas_threads(threads)
+    context = multiprocessing.get_context('spawn')
+    start = time.perf_counter()
+    results = []
+    with context.Manager() as manager:
+        reports = manager.dict()
+        jobs = [(config_id, config, train_kwargs, reports, stop_options) for config_id, config in enumerate(configs)]
+        # a fresh process per configuration releases its compiled functions
+        with context.Pool(n_workers, maxtasksperchild=1) as pool:
+            for row in pool.imap_unordered(run_config, jobs):
+                results.append(row)
+                logging.info("config %d: best valid cost %.4f at epoch %d, %d epochs%s, %.0fs",\
+                    row['config'], row['best_valid_cost'], row['best_epoch'], row['epochs'],\
+                    ' (stopped)' if row['stopped'] else '', row['seconds'])
+    results = write_results(results, os.path.join(args.out_dir, 'results.tsv'))
+    elapsed = time.perf_counter() - start
+    logging.info("sweep took %.0fs for %.0fs of training; best: config %d", elapsed,\
+        sum(row['seconds'] for row in results), results[0]['config'])
+
+if __name__ == '__main__':
+    main()
@@ -9,32 +9,37 @@ new data through to test preformance.  The output is a list of tuples
 containing estimations of future codes.
 
 inputs:
-    - .npz model file (use higest number for best model) from doctor_ai.py
+    - .npz model file (use higest number for best model) from doctor_ai.py,
+      or a model directory exported by model_export.py
     - visit file, Use "seqs_visit.test.json" from process_mimic
     - label file, Use "seqs_label.test.json" from process_mimic
     - hidden dimension size from doctor_ai.py.  Default was "[200,200]"
     - (optional) output file name
 
 outputs:
-    - if output file name provided, saves a json file:
+    - if output file name provided and it ends in .json, saves a json file:
         {'inputs':[[input codes]...],
          'predicitons':[[predicted codes]...]}
+    - otherwise the output file name is a directory, and predictions are
+      written to it batch by batch in the columnar format of
+      prediction_store.py (patient id, visit index, top-k codes and
+      probabilities, predicted duration, actual codes).
 
 '''
 import argparse
 from collections import OrderedDict
 from datetime import datetime
-import heapq
 import json
 import logging
-import operator
 import sys
 
 import numpy as np
 
-import theano
-import theano.tensor as T
-from theano import config
+from code_vocab import CodeVocabulary
+from label_groups import LabelGroups
+from model_export import load_model
+from patient_store import PatientStore, is_patient_store
+from prediction_store import PredictionWriter
 
 def recallTop(y_true, y_pred, rank=[10, 20, 30]):
     recall = list()
@@ -60,12 +65,39 @@ def calculate_r_squared(trueVec, predVec, options):
 
     return 1.0 - (numerator / denominator)
 
+def topk_predictions(outputs, k=30):
+    '''
+    Returns the ids and probabilities of the k largest outputs of every row,
+    best first.
+    '''
+    k = min(k, outputs.shape[1])
+    top = np.argpartition(-outputs, k - 1, axis=1)[:, :k]
+    probs = np.take_along_axis(outputs, top, axis=1)
+    order = np.argsort(-probs, axis=1, kind='stable')
+    return np.take_along_axis(top, order, axis=1), np.take_along_axis(probs, order, axis=1)
+
+# Theano is imported by load_theano when the model is built, so that
+# --help, argument errors and the NumPy helpers above do not set up its
+# configuration and compilation directory
+theano = None
+T = None
+config = None
+
+def load_theano():
+    global theano, T, config
+    if theano is None:
+        import theano
+        import theano.tensor as T
+        from theano import config
+
 def numpy_floatX(data):
     return np.asarray(data, dtype=config.floatX)
 
 def init_tparams(params):
     tparams = OrderedDict()
     for key, value in params.items():
+        if key == 'label_groups':
+            continue
         tparams[key] = theano.shared(value, name=key)
     return tparams
 
@@ -118,13 +150,27 @@ def build_model(tparams, options):
     def softmaxStep(memory2d):
         return T.nnet.softmax(T.dot(memory2d, tparams['W_output']) + tparams['b_output'])
 
-    results, updates = theano.scan(\
-        fn=softmaxStep,
-        sequences=[inputVector],
-        outputs_info=None,
-        name='softmax_layer',
-        n_steps=n_timesteps)
-    results = results * mask[:, :, None]
+    def groupSoftmaxStep(memory2d):
+        return T.nnet.softmax(T.dot(memory2d, tparams['W_group']) + tparams['b_group'])
+
+    if options['labelGroups'] is not None:
+        # two-level output layer: the group probabilities and the hidden
+        # states, from which LabelGroups.topk scores the best groups only
+        groupResults, updates = theano.scan(\
+            fn=groupSoftmaxStep,
+            sequences=[inputVector],
+            outputs_info=None,
+            name='group_softmax_layer',
+            n_steps=n_timesteps)
+        results = [groupResults * mask[:, :, None], inputVector]
+    else:
+        results, updates = theano.scan(\
+            fn=softmaxStep,
+            sequences=[inputVector],
+            outputs_info=None,
+            name='softmax_layer',
+            n_steps=n_timesteps)
+        results = results * mask[:, :, None]
 
     duration = 0.0
     if options['predictTime']:
@@ -152,10 +198,36 @@ def load_data(dataFile, labelFile, timeFile):
     if len(timeFile) > 0:
         test_set_t = [datetime.fromisoformat(test_set_t[i]) for i in sorted_index]
 
-    test_set = (test_set_x, test_set_y, test_set_t)
+    test_set = (test_set_x, test_set_y, test_set_t, np.array(sorted_index))
 
     return test_set
 
+def load_store_data(storeDir, pids=None):
+    store = PatientStore(storeDir)
+    if pids is None:
+        indices = np.arange(len(store))
+    else:
+        indices = store.index_of(pids)
+        missing = np.asarray(pids)[indices < 0]
+        if len(missing) > 0:
+            logging.warning(f"{len(missing)} patient ids not found in {storeDir}: {missing[:10].tolist()}")
+        indices = indices[indices >= 0]
+    test_set_x, test_set_y, _ = store.patients(indices)
+
+    sorted_index = sorted(range(len(test_set_x)), key=lambda x: len(test_set_x[x]))
+    test_set_x = [test_set_x[i] for i in sorted_index]
+    test_set_y = [test_set_y[i] for i in sorted_index]
+    indices = indices[sorted_index]
+
+    test_set = (test_set_x, test_set_y, None, indices)
+
+    return test_set, store.pids[indices]
+
+def parse_pids(pidArg):
+    if pidArg.endswith('.json'):
+        return json.load(open(pidArg, 'r'))
+    return [int(pid) for pid in pidArg.split(',') if pid.strip()]
+
 def padMatrixWithTime(seqs, times, options):
     lengths = np.array([len(seq) for seq in seqs]) - 1
     n_samples = len(seqs)
@@ -196,7 +268,8 @@ def padMatrixWithoutTime(seqs, options):
 def test_doctorAI(\
         modelFile='model.txt', seqFile='seq.txt', inputDimSize=20000, labelFile='label.txt',\
         numClass=500, timeFile='', predictTime=False, useLogTime=True, hiddenDimSize=[200, 200],\
-        batchSize=100, logEps=1e-8, mean_duration=20.0, verbose=False):
+        batchSize=100, logEps=1e-8, mean_duration=20.0, vocabDir='', pidFile='', pids=None, topk=30,\
+        predictionWriter=None, verbose=False):
     options = locals().copy()
 
     if len(timeFile) > 0:
@@ -205,8 +278,15 @@ def test_doctorAI(\
         useTime = False
     options['useTime'] = useTime
 
-    models = np.load(modelFile)
+    load_theano()
+    models = load_model(modelFile, dtype=config.floatX)
     tparams = init_tparams(models)
+    labelGroups = None
+    if 'label_groups' in models:
+        labelGroups = LabelGroups(models['label_groups'])
+        W_output = models['W_output']
+        b_output = models['b_output']
+    options['labelGroups'] = labelGroups
 
     logging.debug('build model ... ')
     if predictTime:
@@ -222,8 +302,27 @@ def test_doctorAI(\
 
     options['inputDimSize'] = models['W_emb'].shape[0]
     options['numClass'] = models['b_output'].shape[0]
+    if len(vocabDir) > 0:
+        vocab = CodeVocabulary.load(vocabDir)
+        # a two-level output layer predicts visit codes instead of labels
+        n_labels = vocab.n_labels if labelGroups is None else vocab.n_visit_codes
+        if vocab.n_visit_codes != options['inputDimSize'] or n_labels != options['numClass']:
+            logging.error(f"model expects {options['inputDimSize']} input and {options['numClass']} label codes, "
+                          f"vocabulary has {vocab.n_visit_codes} and {n_labels}")
+            sys.exit(2)
     logging.debug('load data ... ')
-    testSet = load_data(seqFile, labelFile, timeFile)
+    if is_patient_store(seqFile):
+        requested = pids is not None
+        testSet, pids = load_store_data(seqFile, pids)
+        if requested and len(pids) == 0:
+            logging.error(f"none of the requested patient ids are in {seqFile}")
+            sys.exit(2)
+    else:
+        testSet = load_data(seqFile, labelFile, timeFile)
+        if len(pidFile) > 0:
+            pids = np.array(json.load(open(pidFile, 'r')))[testSet[3]]
+        else:
+            pids = testSet[3]
     n_batches = int(np.ceil(float(len(testSet[0])) / float(batchSize)))
     logging.debug('done')
 
@@ -235,6 +334,7 @@ def test_doctorAI(\
     for batchIndex in range(n_batches):
         tempX = testSet[0][batchIndex*batchSize: (batchIndex+1)*batchSize]
         tempY = testSet[1][batchIndex*batchSize: (batchIndex+1)*batchSize]
+        tempPids = pids[batchIndex*batchSize: (batchIndex+1)*batchSize]
         if predictTime:
             tempT = testSet[2][batchIndex*batchSize: (batchIndex+1)*batchSize]
             x, t, mask, lengths = padMatrixWithTime(tempX, tempT, options)
@@ -248,15 +348,30 @@ def test_doctorAI(\
             x, mask, lengths = padMatrixWithoutTime(tempX, options)
             codeResults = predict_code(x, mask)
 
-        for i in range(codeResults.shape[1]):
-            tensorMatrix = codeResults[:, i, :]
+        batchTrue = []
+        sampleIndex = []
+        visitIndex = []
+        for i in range(len(tempX)):
             thisY = tempY[i][1:]
             for timeIndex in range(lengths[i]):
                 if len(thisY[timeIndex]) == 0:
                     continue
-                trueVec.append(thisY[timeIndex])
-                output = tensorMatrix[timeIndex]
-                predVec.append(list(zip(*heapq.nlargest(30, enumerate(output), key=operator.itemgetter(1))))[0])
+                batchTrue.append(thisY[timeIndex])
+                sampleIndex.append(i)
+                visitIndex.append(timeIndex)
+        if batchTrue:
+            if labelGroups is not None:
+                groupResults, hiddenResults = codeResults
+                topCodes, topProbs = labelGroups.topk(groupResults[visitIndex, sampleIndex, :],\
+                    hiddenResults[visitIndex, sampleIndex, :], W_output, b_output, topk)
+            else:
+                topCodes, topProbs = topk_predictions(codeResults[visitIndex, sampleIndex, :], topk)
+            trueVec.extend(batchTrue)
+            predVec.extend(map(tuple, topCodes.tolist()))
+            if predictionWriter is not None:
+                durations = timeResults[visitIndex, sampleIndex] if predictTime else None
+                predictionWriter.write(tempPids[sampleIndex], visitIndex, topCodes, topProbs,\
+                    batchTrue, durations)
 
         if predictTime:
             for i in range(timeResults.shape[1]):
@@ -268,13 +383,15 @@ def test_doctorAI(\
         if (iteration % 10 == 0) and verbose:
             logging.info(f"iteration: {iteration / n_batches}")
         iteration += 1
-        if iteration == 10:
-            break
 
-    recall = recallTop(trueVec, predVec)
-    logging.info(f"recall@10:{recall[0]}, recall@20:{recall[1]}, recall@30:{recall[2]}")
+    if len(trueVec) > 0:
+        recall = recallTop(trueVec, predVec)
+        logging.info(f"recall@10:{recall[0]}, recall@20:{recall[1]}, recall@30:{recall[2]}")
+    else:
+        # only patients with a single visit, which have no next visit to predict
+        logging.warning("no visits to predict, recall is not reported")
 
-    if predictTime:
+    if predictTime and len(trueTimeVec) > 0:
         r_squared = calculate_r_squared(trueTimeVec, predTimeVec, options)
         logging.info(f"R2:{r_squared}")
     return (trueVec, predVec)
@@ -284,17 +401,17 @@ def parse_arguments(parser):
         'model_file',
         type=str,
         metavar='<model_file>',
-        help='The path to the model file saved by doctor_ai.py')
+        help='The path to the model file saved by doctor_ai.py, or to a model directory exported by model_export.py')
     parser.add_argument(\
         'seq_file',
         type=str,
         metavar='<visit_file>',
-        help='The path to the JSON file containing visit information of patients')
+        help='The path to the JSON file containing visit information of patients, or to a patient store directory (patients.<split>/) from process_mimic.py')
     parser.add_argument(\
         'label_file',
         type=str,
         metavar='<label_file>',
-        help='The path to the JSON file containing label information of patients')
+        help='The path to the JSON file containing label information of patients. Ignored if <visit_file> is a patient store, which holds the labels as well')
     parser.add_argument(\
         'hidden_dim_size',
         type=str,
@@ -304,7 +421,17 @@ def parse_arguments(parser):
         '--output_file',
         type=str,
         default='',
-        help='The name of the output file with predicted codes generated from model.  If you do not want to evaluate the results at that level, do not use this option')
+        help='The name of the output file with predicted codes generated from model. Names ending in .json get the legacy single JSON document, anything else is written as a columnar prediction directory. If you do not want to evaluate the results at that level, do not use this option')
+    parser.add_argument(\
+        '--pids',
+        type=str,
+        default='',
+        help='Only score these patients: comma-separated subject ids, or the path to a JSON list of them. Requires <visit_file> to be a patient store')
+    parser.add_argument(\
+        '--pid_file',
+        type=str,
+        default='',
+        help='The path to the JSON file of patient ids from process_mimic.py matching the visit file. If given, the columnar output records subject ids instead of positions in the visit file')
     parser.add_argument(\
         '--time_file',
         type=str,
@@ -332,6 +459,11 @@ def parse_arguments(parser):
         type=float,
         default=20.0,
         help='The mean value of the durations between visits of the training data. This will be used to calculate the R^2 error (default value: 20.0)')
+    parser.add_argument(\
+        '--vocab_dir',
+        type=str,
+        default='',
+        help='The path to the binary vocabulary directory from process_mimic.py. If given, the model dimensions are checked against it')
     parser.add_argument(\
         '--verbose',
         action='store_true',
@@ -348,12 +480,23 @@ def main():
         logging.warn('Cannot predict time duration without time file')
         sys.exit(2)
 
+    if args.pids and not is_patient_store(args.seq_file):
+        logging.warn('--pids requires a patient store as the visit file')
+        sys.exit(2)
+    if args.time_file and is_patient_store(args.seq_file):
+        logging.warn('Duration information is not supported with a patient store')
+        sys.exit(2)
+
     # set verbosity for output.
     if args.verbose:
         logging.basicConfig(level=logging.DEBUG)
     else:
         logging.basicConfig(level=logging.INFO)
 
+    predictionWriter = None
+    if args.output_file and not args.output_file.endswith('.json'):
+        predictionWriter = PredictionWriter(args.output_file, 30)
+
     (inputs, predictions) = test_doctorAI(
         modelFile=args.model_file,
         seqFile=args.seq_file,
@@ -364,11 +507,18 @@ def main():
         hiddenDimSize=hiddenDimSize,
         batchSize=args.batch_size,
         mean_duration=args.mean_duration,
+        vocabDir=args.vocab_dir,
+        pidFile=args.pid_file,
+        pids=parse_pids(args.pids) if args.pids else None,
+        predictionWriter=predictionWriter,
         verbose=args.verbose
     )
 
-    if args.output_file:
-        logging.debug("saving inputs and predictions as Pickled dict...")
+    if predictionWriter is not None:
+        predictionWriter.close()
+        logging.debug("output complete.")
+    elif args.output_file:
+        logging.debug("saving inputs and predictions as JSON dict...")
         try:
             with open(args.output_file, 'w') as outFile:
                 json.dump({"inputs":inputs, "predictions":predictions}, outFile)
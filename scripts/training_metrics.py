@@ -0,0 +1,164 @@
+'''This module records where the time of a training run goes.
+
+TrainingMetrics times the phases of every training iteration (data fetch,
+padding, f_grad_shared, f_update) and every evaluation pass, along with the
+batch shape, padding ratio and throughput.  Records are written as JSON
+lines to a metrics file, and a summary can be printed to the console every
+few iterations.  When neither is requested every method returns at once,
+so the instrumentation costs nothing measurable.
+
+record types ("event" field):
+    - iteration:  epoch, iteration, cost, <phase>_s, total_s, maxlen,
+                  n_samples, n_visits, padding_ratio, samples_per_s,
+                  visits_per_s
+    - evaluation: epoch, split, cost, seconds
+    - epoch:      epoch, iterations, samples, visits, <phase>_s, seconds,
+                  samples_per_s, visits_per_s
+'''
+
+import json
+import time
+
+ITERATION_PHASES = ('fetch', 'pad', 'grad', 'update')
+
+class TrainingMetrics:
+    '''
+    Per-iteration phase timers and batch statistics for train_doctorAI.
+    '''
+
+    def __init__(self, metricsFile='', consoleInterval=0):
+        self.enabled = bool(metricsFile) or consoleInterval > 0
+        self.consoleInterval = consoleInterval
+        self.outfile = open(metricsFile, 'w', encoding='utf8') if metricsFile else None
+        self._last = 0.0
+        self._phases = {}
+        self._evalStart = 0.0
+        self._resetEpoch()
+        self._resetWindow()
+
+    def _resetEpoch(self):
+        self._epoch = {phase: 0.0 for phase in ITERATION_PHASES}
+        self._epoch.update({'iterations': 0, 'samples': 0, 'visits': 0.0})
+        self._epochStart = time.perf_counter()
+
+    def _resetWindow(self):
+        self._window = {phase: 0.0 for phase in ITERATION_PHASES}
+        self._window.update({'iterations': 0, 'samples': 0, 'visits': 0.0, 'padding': 0.0})
+
+    def _write(self, record):
+        if self.outfile is not None:
+            self.outfile.write(json.dumps(record) + '\n')
+
+    def begin_epoch(self):
+        '''
+        Starts the clock and totals of an epoch; call at the top of the
+        epoch loop, so the epoch leaves out setup, evaluation and saving.
+        '''
+        if not self.enabled:
+            return
+        self._resetEpoch()
+        self._resetWindow()
+
+    def begin_iteration(self):
+        '''
+        Starts the clock of the first iteration; call before the batch loop.
+        '''
+        if not self.enabled:
+            return
+        self._phases = {}
+        self._last = time.perf_counter()
+
+    def mark(self, phase):
+        '''
+        Charges the time since the previous mark to phase.
+        '''
+        if not self.enabled:
+            return
+        now = time.perf_counter()
+        self._phases[phase] = self._phases.get(phase, 0.0) + now - self._last
+        self._last = now
+
+    def end_iteration(self, epoch, iteration, cost, mask):
+        '''
+        Records an iteration and restarts the clock for the next one.  mask
+        is the (maxlen, n_samples) visit mask of the padded batch.
+        '''
+        if not self.enabled:
+            return
+        maxlen, n_samples = mask.shape
+        n_visits = float(mask.sum())
+        total = sum(self._phases.values())
+        padding = 1.0 - n_visits / max(mask.size, 1)
+        record = {
+            'event': 'iteration',
+            'epoch': epoch,
+            'iteration': iteration,
+            'cost': float(cost),
+            'total_s': total,
+            'maxlen': int(maxlen),
+            'n_samples': int(n_samples),
+            'n_visits': n_visits,
+            'padding_ratio': padding,
+            'samples_per_s': n_samples / max(total, 1e-12),
+            'visits_per_s': n_visits / max(total, 1e-12)}
+        for phase, seconds in self._phases.items():
+            record[phase + '_s'] = seconds
+            self._epoch[phase] = self._epoch.get(phase, 0.0) + seconds
+            self._window[phase] = self._window.get(phase, 0.0) + seconds
+        self._write(record)
+
+        for totals in (self._epoch, self._window):
+            totals['iterations'] += 1
+            totals['samples'] += n_samples
+            totals['visits'] += n_visits
+        self._window['padding'] += padding
+        if self.consoleInterval > 0 and self._window['iterations'] >= self.consoleInterval:
+            self._printWindow(epoch, iteration)
+            self._resetWindow()
+        self.begin_iteration()
+
+    def _printWindow(self, epoch, iteration):
+        window = self._window
+        n = window['iterations']
+        total = sum(window[phase] for phase in ITERATION_PHASES)
+        shares = ', '.join(f'{phase}:{100.0 * window[phase] / max(total, 1e-12):.0f}%'\
+            for phase in ITERATION_PHASES)
+        print(f'epoch:{epoch}, iteration:{iteration}, {1000.0 * total / n:.1f}ms/it ({shares}), '
+              f'padding:{100.0 * window["padding"] / n:.0f}%, '
+              f'samples/s:{window["samples"] / max(total, 1e-12):.0f}, '
+              f'visits/s:{window["visits"] / max(total, 1e-12):.0f}')
+
+    def end_epoch(self, epoch):
+        if not self.enabled:
+            return
+        seconds = time.perf_counter() - self._epochStart
+        record = {'event': 'epoch', 'epoch': epoch, 'seconds': seconds}
+        for key, value in self._epoch.items():
+            record[key + '_s' if key in ITERATION_PHASES else key] = value
+        record['samples_per_s'] = self._epoch['samples'] / max(seconds, 1e-12)
+        record['visits_per_s'] = self._epoch['visits'] / max(seconds, 1e-12)
+        self._write(record)
+
+    def begin_evaluation(self):
+        if not self.enabled:
+            return
+        self._evalStart = time.perf_counter()
+
+    def end_evaluation(self, epoch, split, cost, seconds=None):
+        '''
+        Records an evaluation pass timed since begin_evaluation, or taking
+        seconds when it ran elsewhere (e.g. in a validation worker).
+        '''
+        if not self.enabled:
+            return
+        if seconds is None:
+            seconds = time.perf_counter() - self._evalStart
+        self._write({'event': 'evaluation', 'epoch': epoch, 'split': split,\
+            'cost': float(cost), 'seconds': seconds})
+        if self.consoleInterval > 0:
+            print(f'epoch:{epoch}, {split} evaluation took {seconds:.1f}s')
+
+    def close(self):
+        if self.outfile is not None:
+            self.outfile.close()
+            self.outfile = None
@@ -1,80 +1,171 @@
 '''This module translates codes used by the model to CCS text descriptions.
 First, it has to go from number -> CCS code, then from
-CCS code -> text description of CCS code.
+CCS code -> text description of CCS code.  Both steps are folded into one
+lookup table indexed by label id (see code_vocab.py), which is applied to
+whole chunks of visits at once.
+
+The predictions file is read incrementally and the csv files are written
+chunk by chunk, so memory use does not grow with the size of the test set.
 
 inputs:
     -ccs file.  Use "label_types.json" from process_mimic.py.
-    -input file of integer codes.  Use output from test_doctor_ai.py.
+    -ccs text file.  Use "dxref2015_text.json" from create_ccs_dict.py.
+    -(optional) vocabulary directory.  Use "vocab/" from process_mimic.py
+     in place of the two JSON files above.
+    -input file of integer codes.  Use output from test_doctor_ai.py, either
+     the JSON file or the columnar prediction directory.
     -output file name.
 
 outputs:
     two csv files: one with the descriptions of CCS codes that occurred,
     and the other with a list of predicted codes.
+    With --combined, a single csv file with one row per visit holding both.
 '''
 
 
 import argparse
 import csv
+from itertools import islice
 import json
 import logging
 import sys
 
-def translate_numerics(ccs_label_types_file, inputs_predictions_file):
+import numpy as np
+
+from code_vocab import open_vocabulary
+from prediction_store import is_prediction_store, iter_parts, split_actuals
+
+COMBINED_SEPARATOR = '|'
+
+def iter_json_rows(json_file, key, read_size=1 << 20):
+    '''
+    Yields the elements of the list stored under key in a JSON object one at
+    a time, without loading the whole file.  The elements must be lists, as
+    written by test_doctor_ai.py.
+    '''
+    decoder = json.JSONDecoder()
+    with open(json_file, 'r') as infile:
+        buf = ''
+        pos = -1
+        marker = json.dumps(key)
+        while pos < 0:
+            chunk = infile.read(read_size)
+            if not chunk:
+                raise KeyError(key)
+            # keep the tail in case the key is split across reads
+            buf = buf[-len(marker):] + chunk
+            pos = buf.find(marker)
+        buf = buf[pos + len(marker):]
+        while '[' not in buf:
+            chunk = infile.read(read_size)
+            if not chunk:
+                raise KeyError(key)
+            buf += chunk
+        pos = buf.index('[') + 1
+
+        while True:
+            while pos < len(buf) and buf[pos] in ' \t\r\n,':
+                pos += 1
+            if pos < len(buf) and buf[pos] == ']':
+                return
+            try:
+                row, end = decoder.raw_decode(buf, pos)
+            except ValueError:
+                chunk = infile.read(read_size)
+                if not chunk:
+                    raise
+                buf = buf[pos:] + chunk
+                pos = 0
+                continue
+            yield row
+            pos = end
+            if pos > read_size:
+                buf = buf[pos:]
+                pos = 0
+
+def iter_chunks(rows, chunk_size):
+    '''
+    Groups an iterable of rows into lists of at most chunk_size rows.
+    '''
+    rows = iter(rows)
+    chunk = list(islice(rows, chunk_size))
+    while chunk:
+        yield chunk
+        chunk = list(islice(rows, chunk_size))
+
+def translate_numerics(table, rows):
     '''
-    Converts the test_doctor_ai outputs from numeric codes to ccs codes.
+    Maps every integer in a list of rows through the lookup table with a
+    single indexing operation and returns the translated rows as arrays.
     '''
-    logging.debug("opening {ccs code : int} and [[int, int, int],...] actuals and preds...")
-    # load dicts
-    with open(ccs_label_types_file, 'r') as infile:
-        ccs_dict = json.load(infile)
-    with open(inputs_predictions_file, 'rb') as infile:
-        input_dict = json.load(infile)
-
-    # list of lists containing int codes from labels
-    actuals = input_dict['inputs']
-
-    # list of lists containing 30 prediction ints from labels and model output
-    preds = list(map(list, input_dict['predictions']))
-
-    logging.debug("mapping actual visit ints to ccs...")
-    ccs_actuals = []
-    for seq in actuals:
-        ccs_actuals.append(\
-            [[int(k) for k, val in ccs_dict.items() if val == num][0] for num in seq])
-
-    logging.debug("mapping predicted ints to ccs...")
-    ccs_preds = []
-    for seq in preds:
-        ccs_preds.append(\
-            [[int(k) for k, val in ccs_dict.items() if val == num][0] for num in seq])
-
-    return (ccs_actuals, ccs_preds)
-
-def load_ccs_text_dx(dxref_text_file):
+    if isinstance(rows, np.ndarray):
+        return table[rows]
+    lengths = np.fromiter((len(row) for row in rows), dtype=np.intp, count=len(rows))
+    if len(lengths) > 0 and (lengths == lengths[0]).all():
+        # fixed width rows (the top-k predictions) index as one matrix
+        return list(table[np.asarray(rows, dtype=np.intp).reshape(len(rows), lengths[0])])
+    flat = np.fromiter((code for row in rows for code in row), dtype=np.intp, count=lengths.sum())
+    return np.split(table[flat], np.cumsum(lengths)[:-1])
+
+def load_vocabulary(ccs_label_types_file, dxref_text_file, vocab_dir=''):
     '''
-    Loads the ccs descriptions.
+    Loads the label id -> ccs code -> description tables.
     '''
-    logging.debug("opening ccs text dict...")
+    logging.debug("opening code vocabulary...")
     try:
-        with open(dxref_text_file, 'r') as ccs_text_file:
-            ccs_text_dx = json.load(ccs_text_file)
-        logging.debug("loaded ccs file containing text descriptions.")
-    except FileNotFoundError:
-        logging.error('Could not find %s', dxref_text_file)
+        vocab = open_vocabulary(vocab_dir,\
+            label_types_file=ccs_label_types_file, ccs_text_file=dxref_text_file)
+        logging.debug("loaded code vocabulary.")
+    except FileNotFoundError as err:
+        logging.error('Could not find %s', err.filename)
         sys.exit(2)
 
-    return ccs_text_dx
+    return vocab
 
-def output_text_codes(ccs_codes, ccs_text_dx):
+def iter_prediction_chunks(inputs_predictions_file, chunk_size):
     '''
-    Converts ccs codes to ccs descriptions.
+    Yields (actuals, predictions) lists of at most chunk_size visits each.
+    A columnar prediction directory is read one stored part at a time.
     '''
-    pred_diagnoses = []
-    logging.debug("iterating through lists of ccs codes to map to text...")
-    for seq in ccs_codes:
-        pred_diagnoses.append(list(map(lambda x: ccs_text_dx.get(str(x)), seq)))
-
-    return pred_diagnoses
+    if is_prediction_store(inputs_predictions_file):
+        return ((split_actuals(part), part['codes']) for part in iter_parts(inputs_predictions_file))
+    actuals = iter_chunks(iter_json_rows(inputs_predictions_file, 'inputs'), chunk_size)
+    preds = iter_chunks(iter_json_rows(inputs_predictions_file, 'predictions'), chunk_size)
+    return zip(actuals, preds)
+
+def write_text_codes(vocab, chunks, predictions_output_file, actuals_output_file='',\
+    combined=False):
+    '''
+    Translates each chunk of label ids to descriptions and appends them to
+    the csv outputs.  Returns the number of visits written.
+    '''
+    table = vocab.label_text
+    n_visits = 0
+    with open(predictions_output_file, 'w', newline="") as pfile:
+        pwriter = csv.writer(pfile)
+        afile = None
+        if combined:
+            pwriter.writerow(['visit', 'actual', 'predicted'])
+        else:
+            afile = open(actuals_output_file, 'w', newline="")
+            awriter = csv.writer(afile)
+        try:
+            for actual_chunk, pred_chunk in chunks:
+                actual_text = translate_numerics(table, actual_chunk)
+                pred_text = translate_numerics(table, pred_chunk)
+                if combined:
+                    pwriter.writerows(\
+                        (n_visits + i, COMBINED_SEPARATOR.join(actual), COMBINED_SEPARATOR.join(pred))
+                        for i, (actual, pred) in enumerate(zip(actual_text, pred_text)))
+                else:
+                    pwriter.writerows(pred_text)
+                    awriter.writerows(actual_text)
+                n_visits += len(pred_chunk)
+                logging.debug("translated %d visits", n_visits)
+        finally:
+            if afile is not None:
+                afile.close()
+    return n_visits
 
 def parse_arguments(parser):
     parser.add_argument(\
@@ -88,7 +179,7 @@ def parse_arguments(parser):
     parser.add_argument(\
         'inputs_predictions_file',
         type=str,
-        help='The path to the JSON predictions file from test_doctor_ai.py.')
+        help='The path to the JSON predictions file or the columnar prediction directory from test_doctor_ai.py.')
     parser.add_argument(\
         'predictions_output_file',
         type=str,
@@ -96,10 +187,28 @@ def parse_arguments(parser):
     parser.add_argument(\
         'actuals_output_file',
         type=str,
-        help='The path to the output file that will contain text descriptions for actual codes.')
+        nargs='?',
+        default='',
+        help='The path to the output file that will contain text descriptions for actual codes. Not used with --combined.')
+    parser.add_argument(\
+        '--combined',
+        action='store_true',
+        help='Write a single csv to predictions_output_file with one row per visit: visit, actual codes and predicted codes, each joined by "|".')
+    parser.add_argument(\
+        '--chunk_size',
+        type=int,
+        default=10000,
+        help='The number of visits translated and written at a time (default value: 10000)')
+    parser.add_argument(\
+        '--vocab_dir',
+        type=str,
+        default='',
+        help='The path to the binary vocabulary directory from process_mimic.py. If given, it is used instead of the two JSON files.')
     parser.add_argument('-v', '--verbose', action='store_true',\
         help='Show verbose output.')
     args = parser.parse_args()
+    if not args.combined and not args.actuals_output_file:
+        parser.error('actuals_output_file is required unless --combined is used')
     return args
 
 def main():
@@ -111,24 +220,13 @@ def main():
     else:
         logging.basicConfig(level=logging.INFO)
 
-    logging.info("beginning translation of integers to ccs codes...")
-    actual_ccs_codes, predicted_ccs_codes = translate_numerics(\
-        args.ccs_file, args.inputs_predictions_file)
-    logging.info("loading dxref_text_file...")
-    ccs_text_dx = load_ccs_text_dx(args.dxref_text_file)
-    logging.info("beginning translation of predicted ccs codes to text descriptions...")
-    prediction_descriptions = output_text_codes(predicted_ccs_codes, ccs_text_dx)
-    logging.info("beginning translation of actual ccs codes to text descriptions...")
-    actual_descriptions = output_text_codes(actual_ccs_codes, ccs_text_dx)
-
-    logging.info("writing text descriptions of predictions to csv...")
-    with open(args.predictions_output_file, 'w', newline="") as outfile:
-        pwriter = csv.writer(outfile)
-        pwriter.writerows(prediction_descriptions)
-    with open(args.actuals_output_file, 'w', newline="") as outfile:
-        awriter = csv.writer(outfile)
-        awriter.writerows(actual_descriptions)
-    logging.info("Complete.")
+    logging.info("loading code vocabulary...")
+    vocab = load_vocabulary(args.ccs_file, args.dxref_text_file, args.vocab_dir)
+    logging.info("translating codes to text descriptions and writing csv...")
+    chunks = iter_prediction_chunks(args.inputs_predictions_file, args.chunk_size)
+    n_visits = write_text_codes(vocab, chunks, args.predictions_output_file,\
+        args.actuals_output_file, args.combined)
+    logging.info("Complete. Translated %d visits.", n_visits)
 
 if __name__ == '__main__':
     main()